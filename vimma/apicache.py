@@ -0,0 +1,222 @@
+import celery.signals
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.http import HttpResponse
+import hashlib
+import json
+import logging
+import redis
+import threading
+
+from vimma.actions import Actions
+from vimma.models import (
+    VM, DummyVM, AWSVM, FirewallRule, AWSFirewallRule,
+    Expiration, VMExpiration, FirewallRuleExpiration,
+)
+from vimma.util import can_do, get_project_ids
+
+
+log = logging.getLogger(__name__)
+
+_KEY_PREFIX = 'vimma:apicache:'
+# Incremented when a changed object's project is unknown. Part of all keys.
+_EPOCH_KEY = _KEY_PREFIX + 'epoch'
+# Incremented on every change. Part of the keys for READ_ANY_PROJECT users.
+_ALL_KEY = _KEY_PREFIX + 'all'
+
+# {model: lookups from the model to the id of its VM's Project}
+_PROJECT_LOOKUPS = {
+    DummyVM: ('vm__project',),
+    AWSVM: ('vm__project',),
+    FirewallRule: ('vm__project',),
+    AWSFirewallRule: ('firewallrule__vm__project',),
+    Expiration: ('vmexpiration__vm__project',
+        'firewallruleexpiration__firewallrule__vm__project'),
+    VMExpiration: ('vm__project',),
+    FirewallRuleExpiration: ('firewallrule__vm__project',),
+}
+
+_redis = None
+_local = threading.local()
+
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(settings.API_CACHE_REDIS_URL)
+    return _redis
+
+
+def _project_key(prj_id):
+    return _KEY_PREFIX + 'project:{}'.format(prj_id)
+
+
+def get_changed_project_ids(instance):
+    """
+    Return the set of Project ids instance (a cached model object) is in.
+
+    Returns None if they can't be found, e.g. after the object or its VM have
+    been deleted.
+    """
+    if type(instance) == VM:
+        return {instance.project_id}
+    prj_ids = set()
+    for lookup in _PROJECT_LOOKUPS[type(instance)]:
+        prj_ids.update(type(instance).objects.filter(id=instance.id)
+                .values_list(lookup, flat=True))
+    prj_ids.discard(None)
+    return prj_ids or None
+
+
+def _invalidate(prj_ids):
+    """
+    Invalidate cached responses for prj_ids (set), or all if it's None.
+    """
+    try:
+        pipe = _get_redis().pipeline()
+        pipe.incr(_ALL_KEY)
+        if prj_ids is None:
+            pipe.incr(_EPOCH_KEY)
+        else:
+            for prj_id in prj_ids:
+                pipe.incr(_project_key(prj_id))
+        pipe.execute()
+    except redis.RedisError:
+        log.exception('Can\'t invalidate the API response cache')
+
+
+_CACHED_MODELS = (VM,) + tuple(_PROJECT_LOOKUPS)
+
+
+def _pre_delete(sender, instance, **kwargs):
+    """
+    Remember the object's projects, they can't be looked up after deletion.
+    """
+    if settings.API_RESPONSE_CACHE:
+        instance._vimma_apicache_prj_ids = get_changed_project_ids(instance)
+
+
+def _changed(prj_ids):
+    """
+    Invalidate prj_ids (set, or None for all) now and again in
+    invalidate_pending(), because a concurrent request may cache the old data
+    before the change is committed.
+    """
+    _invalidate(prj_ids)
+
+    if not hasattr(_local, 'pending'):
+        _local.pending = set()
+    if prj_ids is None:
+        _local.pending.add(None)
+    else:
+        _local.pending.update(prj_ids)
+
+
+def _object_changed(sender, instance, **kwargs):
+    if not settings.API_RESPONSE_CACHE:
+        return
+    if hasattr(instance, '_vimma_apicache_prj_ids'):
+        prj_ids = instance._vimma_apicache_prj_ids
+    else:
+        prj_ids = get_changed_project_ids(instance)
+    _changed(prj_ids)
+
+
+def invalidate_projects(prj_ids):
+    """
+    Invalidate the cached responses for prj_ids (Project ids).
+
+    Call this for changes to cached objects which send no post_save or
+    post_delete signals, e.g. QuerySet.update().
+    """
+    if settings.API_RESPONSE_CACHE and prj_ids:
+        _changed(set(prj_ids))
+
+
+for model in _CACHED_MODELS:
+    pre_delete.connect(_pre_delete, sender=model)
+    post_save.connect(_object_changed, sender=model)
+    post_delete.connect(_object_changed, sender=model)
+del model
+
+
+@receiver(request_finished)
+@celery.signals.task_postrun.connect
+def invalidate_pending(*args, **kwargs):
+    """
+    Invalidate the projects changed during the HTTP request or Celery task.
+    """
+    pending = getattr(_local, 'pending', None)
+    if not pending:
+        return
+    _local.pending = set()
+    _invalidate(None if None in pending else pending)
+
+
+class CachedResponseMixin():
+    """
+    Cache a viewset's list and retrieve responses in Redis, if
+    settings.API_RESPONSE_CACHE is True.
+
+    Responses are shared by users with the same projects (or with the
+    READ_ANY_PROJECT permission) and are valid until an object in one of
+    those projects changes, or for settings.API_CACHE_TTL_SECS.
+    Subclasses whose responses depend on other objects can set
+    cache_responses to False.
+    """
+    cache_responses = True
+
+    def get_cache_key(self, request):
+        """
+        Return the Redis key for request's cached response.
+        """
+        user = request.user
+        if can_do(user, Actions.READ_ANY_PROJECT):
+            scope_keys = [_ALL_KEY]
+        else:
+            scope_keys = [_project_key(p)
+                    for p in sorted(get_project_ids(user))]
+        generations = _get_redis().mget([_EPOCH_KEY] + scope_keys)
+        data = [type(self).__name__, scope_keys,
+                [g.decode('ascii') if g else '0' for g in generations],
+                request.get_full_path(), request.META.get('HTTP_ACCEPT', '')]
+        return _KEY_PREFIX + 'response:' + hashlib.sha1(
+                json.dumps(data).encode('utf-8')).hexdigest()
+
+    def _cached(self, view, request, *args, **kwargs):
+        if not (settings.API_RESPONSE_CACHE and self.cache_responses):
+            return view(request, *args, **kwargs)
+
+        try:
+            key = self.get_cache_key(request)
+            cached = _get_redis().hmget(key, 'content', 'content_type')
+        except redis.RedisError:
+            log.exception('Can\'t read from the API response cache')
+            return view(request, *args, **kwargs)
+        if cached[0] is not None:
+            return HttpResponse(cached[0],
+                    content_type=cached[1].decode('utf-8'))
+
+        def store(response):
+            if response.status_code != 200:
+                return
+            try:
+                pipe = _get_redis().pipeline()
+                pipe.hmset(key, {'content': response.content,
+                    'content_type': response['Content-Type']})
+                pipe.expire(key, settings.API_CACHE_TTL_SECS)
+                pipe.execute()
+            except redis.RedisError:
+                log.exception('Can\'t write to the API response cache')
+
+        response = view(request, *args, **kwargs)
+        response.add_post_render_callback(store)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self._cached(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._cached(super().retrieve, request, *args, **kwargs)
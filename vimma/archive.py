@@ -0,0 +1,54 @@
+from django.db import transaction
+import gzip
+import itertools
+import json
+import os
+
+from vimma.models import Audit
+
+
+def archive_file_path(archive_dir, day):
+    """
+    Return the path of the archive file for Audits from day (date).
+    """
+    return os.path.join(archive_dir,
+            'audit-{}.jsonl.gz'.format(day.isoformat()))
+
+
+def archive_audits(before, archive_dir, batch_size=10000):
+    """
+    Move Audit objects older than before (datetime) to archive files.
+
+    Each day's Audits are appended, one JSON object per line, to a gzipped
+    file in archive_dir (see archive_file_path). Rows are archived and deleted
+    in batches of batch_size, each in its own transaction, so the table isn't
+    locked for long. Returns the number of archived Audits.
+
+    A batch is written to the files before its rows are deleted, so if the
+    delete fails the batch may be archived again on the next run.
+    This function must not be called inside a transaction.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    total = 0
+    while True:
+        with transaction.atomic():
+            rows = list(Audit.objects.filter(timestamp__lt=before)
+                    .order_by('id').values('id', 'timestamp', 'level', 'text',
+                        'user_id', 'vm_id')[:batch_size])
+            if not rows:
+                return total
+
+            for day, day_rows in itertools.groupby(
+                    sorted(rows, key=lambda r: r['timestamp']),
+                    key=lambda r: r['timestamp'].date()):
+                with gzip.open(archive_file_path(archive_dir, day), 'at',
+                        encoding='utf-8') as f:
+                    for r in day_rows:
+                        r['timestamp'] = r['timestamp'].isoformat()
+                        f.write(json.dumps(r) + '\n')
+
+            # All rows matching the filter up to the largest id are in
+            # this batch.
+            Audit.objects.filter(timestamp__lt=before,
+                    id__lte=rows[-1]['id']).delete()
+        total += len(rows)
@@ -1,14 +1,116 @@
+import atexit
 import celery.exceptions
+import celery.signals
+import collections
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.signals import request_finished
 from django.db import transaction
 from django.db.utils import OperationalError
+from django.dispatch import receiver
 import logging
+import random
+import threading
 import traceback
 
+from vimma.events import publish_vm_events_on_commit
 from vimma.models import Audit, VM, User
 
 
 log = logging.getLogger(__name__)
 
+# 'DEBUG' → Audit.DEBUG etc.
+_LEVEL_BY_NAME = {name: level for level, name in Audit.LEVEL_CHOICES}
+
+
+class _AuditBuffer():
+    """
+    A bounded buffer of unsaved Audit objects, shared by all Auditors.
+
+    Used when settings.AUDIT_BUFFERED is True. See flush().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = collections.deque()
+        self.dropped = 0
+
+    def add(self, audit):
+        """
+        Add an unsaved Audit object.
+
+        Never touches the DB: when the buffer is full, the oldest item is
+        dropped or (by default) the new one is, according to
+        settings.AUDIT_BUFFER_OVERFLOW, and counted for flush() to report.
+        """
+        with self.lock:
+            if len(self.items) >= settings.AUDIT_BUFFER_MAX_SIZE:
+                self.dropped += 1
+                if settings.AUDIT_BUFFER_OVERFLOW != 'drop-oldest':
+                    return
+                self.items.popleft()
+            self.items.append(audit)
+
+    def take(self):
+        """
+        Empty the buffer, return (list of Audit objects, number dropped).
+        """
+        with self.lock:
+            items, self.items = list(self.items), collections.deque()
+            dropped, self.dropped = self.dropped, 0
+        return items, dropped
+
+
+_buffer = _AuditBuffer()
+
+
+@receiver(request_finished)
+@celery.signals.task_postrun.connect
+@atexit.register
+def flush(*args, **kwargs):
+    """
+    Save all buffered Audit objects to the DB, using bulk_create.
+
+    Runs after each HTTP request, after each Celery task and at exit. Never
+    from Auditor.log(), which may run inside the caller's transaction.
+    """
+    items, dropped = _buffer.take()
+    if dropped:
+        log.warning('Audit buffer full, dropped {} messages'.format(dropped))
+    if not items:
+        return
+
+    try:
+        valid = []
+        for a in items:
+            try:
+                a.clean_fields(exclude=['vm', 'user'])
+                valid.append(a)
+            except ValidationError:
+                log.error(traceback.format_exc())
+
+        # Don't let a missing VM or User fail the whole batch: check them
+        # all in two queries and clear the dangling references.
+        vm_ids = VM.objects.filter(id__in={a.vm_id for a in valid
+            if a.vm_id}).values_list('id', flat=True)
+        user_ids = User.objects.filter(id__in={a.user_id for a in valid
+            if a.user_id}).values_list('id', flat=True)
+        vm_ids, user_ids = set(vm_ids), set(user_ids)
+        for a in valid:
+            if a.vm_id not in vm_ids:
+                a.vm_id = None
+            if a.user_id not in user_ids:
+                a.user_id = None
+
+        with transaction.atomic():
+            Audit.objects.bulk_create(valid)
+        publish_vm_events_on_commit([{'vm': a.vm_id, 'type': 'audit',
+            'level': a.level} for a in valid if a.vm_id])
+    except OperationalError as e:
+        log.warning('OperationalError: ' + str(e))
+    except:
+        log.error(traceback.format_exc())
+
 
 class Auditor():
     """
@@ -31,6 +133,32 @@ class Auditor():
         self.name = name
         self.logger = logging.getLogger(self.name)
 
+    def _min_level(self):
+        """
+        Return the minimum Audit.* level saved to the DB for this Auditor.
+
+        The most specific entry in settings.AUDIT_MIN_LEVEL_OVERRIDES
+        matching our name (e.g. ‘vimma.vmtype’ for ‘vimma.vmtype.aws’) wins,
+        else settings.AUDIT_MIN_LEVEL is used.
+        """
+        overrides = settings.AUDIT_MIN_LEVEL_OVERRIDES
+        name = self.name or ''
+        while name not in overrides:
+            if '.' not in name:
+                return _LEVEL_BY_NAME[settings.AUDIT_MIN_LEVEL]
+            name = name.rsplit('.', 1)[0]
+        return _LEVEL_BY_NAME[overrides[name]]
+
+    def _persist(self, level):
+        """
+        Return True if a message with Audit.* level should go to the DB.
+        """
+        if level < self._min_level():
+            return False
+        if level == Audit.DEBUG:
+            return random.random() < settings.AUDIT_DEBUG_SAMPLE_RATE
+        return True
+
     def _std_log(self, level, msg, *args, vm_id=None, user_id=None):
         """
         Log to Python Standard Logging.
@@ -51,7 +179,10 @@ class Auditor():
         Log audit message with Audit.* level and VM and User with given IDs.
 
         The message goes to both a new Audit object and Python's Standard
-        Logging.
+        Logging. Messages below the configured minimum level, and DEBUG
+        messages left out by sampling, only go to Standard Logging.
+        With settings.AUDIT_BUFFERED the Audit object is saved later, in a
+        batch, by flush().
         This method tries to suppress all exceptions raised from its
         implementation (other than incorrect usage of this method itself).
         """
@@ -59,12 +190,23 @@ class Auditor():
             raise TypeError('{} extra positional args'.format(len(args)))
 
         try:
+            if not self._persist(level):
+                return
             text = '{}: {}'.format(self.name, msg)
+            if settings.AUDIT_BUFFERED:
+                audit = Audit(level=level, text=text,
+                        vm_id=vm_id, user_id=user_id)
+                _buffer.add(audit)
+                return
             #with transaction.atomic():
             vm = VM.objects.get(id=vm_id) if vm_id else None
             user = User.objects.get(id=user_id) if user_id else None
             Audit.objects.create(level=level, text=text,
                     vm=vm, user=user).full_clean()
+            if vm_id:
+                # the caller's transaction may not have committed yet
+                publish_vm_events_on_commit([{'vm': vm_id, 'type': 'audit',
+                    'level': level}])
         except OperationalError as e:
             # Likely the DB is locked. Don't pollute the logs with a stack
             # trace in this case.
@@ -96,8 +238,9 @@ class Auditor():
 
         If the with-block doesn't raise an exception, nothing is audited.
         If the with-block raises an exception, the context manager calls
-        aud.error(…) on this Audit object then lets the exception be re-raised
-        by the with-statement.
+        aud.error(…) on this Audit object (aud.warning(…) for
+        celery.exceptions.Retry) then lets the exception be re-raised by the
+        with-statement.
         """
         if args:
             raise TypeError('{} extra positional args'.format(len(args)))
@@ -117,7 +260,8 @@ class Auditor():
         the with-statement.
 
         If the protected block throws any other exception (E*), the context
-        manager audits it, then calls .retry() on the celery task object.
+        manager audits it, then calls .retry() on the celery task object, with
+        a countdown of 0.5 to 1.5 times the task's default_retry_delay.
         Any exception raised by this call is audited and allowed to propagate.
         If .retry() doesn't raise an exception, the context manager lets (E*)
         be re-raised by the with-statement.
@@ -146,6 +290,10 @@ class _CtxMgr():
         if exc_type is None and exc_value is None and tb is None:
             return
         msg = ''.join(traceback.format_exception(exc_type, exc_value, tb))
+        if issubclass(exc_type, celery.exceptions.Retry):
+            self.auditor.warning('retry\n' + msg, vm_id=self.vm_id,
+                    user_id=self.user_id)
+            return False
         self.auditor.error(msg, vm_id=self.vm_id, user_id=self.user_id)
         return False
 
@@ -186,7 +334,9 @@ class _CeleryRetryCtxMgr():
                 **kw_args)
 
         try:
-            self.task_obj.retry()
+            # spread out the retries of tasks which failed together
+            self.task_obj.retry(countdown=random.uniform(.5, 1.5) *
+                    self.task_obj.default_retry_delay)
             return False
         except celery.exceptions.Retry:
             msg = ''.join(traceback.format_exc())
@@ -1,10 +1,14 @@
 from celery.schedules import crontab
+from kombu import Queue
 import os
 
 _every_20s = 20
 _every_1min = crontab(minute='*')
 _every_5min = crontab(minute='*/5')
+# away from the :00 and :30 schedule boundaries
+_every_30min_offset = crontab(minute='15,45')
 _every_1h = crontab(minute=0)
+_every_day = crontab(minute=30, hour=3)
 
 BROKER_URL = os.getenv('BROKER_URL', "redis://localhost:6379/0")
 CELERY_RESULT_BACKEND = os.getenv('RESULT_BACKEND', "redis://localhost/0")
@@ -13,10 +17,90 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = CELERY_TASK_SERIALIZER
 CELERY_ACCEPT_CONTENT = [CELERY_TASK_SERIALIZER,]
 
+# Each queue has its own workers (see docker/supervisord.conf), so actions
+# started by users don't wait behind the periodic sweeps:
+# interactive: power on/off and reboot
+# provisioning: creating and destroying VMs
+# status-sweep: status updates, power transitions and other periodic work
+# expiry: expiration notifications and grace end actions
+# dns: Route53 records
+CELERY_QUEUES = tuple(Queue(name, routing_key=name) for name in (
+    'interactive', 'provisioning', 'status-sweep', 'expiry', 'dns'))
+CELERY_DEFAULT_QUEUE = 'interactive'
+CELERY_DEFAULT_ROUTING_KEY = CELERY_DEFAULT_QUEUE
+
+# Within a queue, Redis delivers lower priorities first. A task without a
+# priority gets 0, so every route below sets one. Callers may override it,
+# e.g. a status update requested by a user is PRIORITY_INTERACTIVE.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 6
+# Fetch one task at a time, so a worker doesn't hold background tasks while
+# higher priority ones arrive.
+CELERYD_PREFETCH_MULTIPLIER = 1
+
+
+def _routes(queue, priority, *task_names):
+    return {name: {'queue': queue, 'priority': priority}
+            for name in task_names}
+
+CELERY_ROUTES = {}
+CELERY_ROUTES.update(_routes('interactive', PRIORITY_INTERACTIVE,
+    'vimma.vmtype.aws.power_on_vm',
+    'vimma.vmtype.aws.power_off_vm',
+    'vimma.vmtype.aws.reboot_vm',
+    'vimma.vmtype.aws.power_on_vms',
+    'vimma.vmtype.aws.power_off_vms',
+    'vimma.vmtype.aws.reboot_vms',
+    'vimma.vmtype.aws.flush_power_requests',
+    'vimma.vmtype.dummy.power_on_vm',
+    'vimma.vmtype.dummy.power_off_vm',
+    'vimma.vmtype.dummy.reboot_vm',
+))
+CELERY_ROUTES.update(_routes('provisioning', PRIORITY_INTERACTIVE,
+    'vimma.vmtype.aws.do_create_vm',
+    'vimma.vmtype.aws.destroy_vm',
+    'vimma.vmtype.aws.destroy_vms',
+    'vimma.vmtype.aws.terminate_instance',
+    'vimma.vmtype.aws.delete_security_group',
+    'vimma.vmtype.dummy.destroy_vm',
+))
+CELERY_ROUTES.update(_routes('status-sweep', PRIORITY_BACKGROUND,
+    'vimma.vmutil.update_all_vms_status',
+    'vimma.vmutil.update_vm_status',
+    'vimma.vmutil.update_uptime_rollups',
+    'vimma.vmutil.archive_old_audits',
+    'vimma.vmtype.aws.update_vm_status',
+    'vimma.vmtype.aws.update_region_vms_status',
+    'vimma.vmtype.dummy.update_vm_status',
+))
+# quick, and late power transitions are visible to users
+CELERY_ROUTES.update(_routes('status-sweep', PRIORITY_INTERACTIVE,
+    'vimma.vmutil.dispatch_power_transitions',
+))
+CELERY_ROUTES.update(_routes('expiry', PRIORITY_BACKGROUND,
+    'vimma.vmutil.dispatch_all_expiration_notifications',
+    'vimma.vmutil.dispatch_expiration_notification',
+    'vimma.vmutil.expiration_notify',
+    'vimma.vmutil.dispatch_all_expiration_grace_end_actions',
+    'vimma.vmutil.dispatch_expiration_grace_end_action',
+    'vimma.vmutil.expiration_grace_action',
+))
+CELERY_ROUTES.update(_routes('dns', PRIORITY_BACKGROUND,
+    'vimma.vmtype.aws.route53_add',
+    'vimma.vmtype.aws.route53_delete',
+    'vimma.vmtype.aws.flush_route53_adds',
+))
+
 CELERYBEAT_SCHEDULE = {
+    'dispatch-power-transitions': {
+        'task': 'vimma.vmutil.dispatch_power_transitions',
+        'schedule': _every_1min,
+    },
+    # Power transitions are dispatched by the task above. This is a
+    # reconciliation pass, also refreshing state & IP addresses.
     'update-all-vms-status': {
         'task': 'vimma.vmutil.update_all_vms_status',
-        'schedule': _every_5min,
+        'schedule': _every_30min_offset,
     },
     'dispatch-all-expiration-notifications': {
         'task': 'vimma.vmutil.dispatch_all_expiration_notifications',
@@ -26,4 +110,12 @@ CELERYBEAT_SCHEDULE = {
         'task': 'vimma.vmutil.dispatch_all_expiration_grace_end_actions',
         'schedule': _every_1h,
     },
+    'update-uptime-rollups': {
+        'task': 'vimma.vmutil.update_uptime_rollups',
+        'schedule': _every_1h,
+    },
+    'archive-old-audits': {
+        'task': 'vimma.vmutil.archive_old_audits',
+        'schedule': _every_day,
+    },
 }
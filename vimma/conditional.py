@@ -0,0 +1,135 @@
+"""
+Conditional GET (ETag and Last-Modified) for API views of rarely changing
+objects.
+
+A ModelVersion counter per name below is incremented when any object it
+tracks is saved or deleted, in the same transaction. Views compute their
+ETag from the counters, so a client's cached copy can be confirmed with one
+small query and without running the view's queryset or serializer.
+"""
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.http import condition
+import hashlib
+import json
+
+from vimma.models import (
+    ModelVersion, Permission, Role, User, TimeZone, Schedule, Project,
+    Provider, VMConfig, AWSVMConfig,
+)
+
+
+# {version name: models whose save and delete signals increment it}
+TRACKED_MODELS = {
+    'timezone': (TimeZone,),
+    'schedule': (Schedule,),
+    'project': (Project,),
+    'provider': (Provider,),
+    'vmconfig': (VMConfig,),
+    'awsvmconfig': (AWSVMConfig,),
+    'perms': (Permission, Role),
+}
+
+# {version name: m2m ‘through’ models whose m2m_changed signals increment it}
+TRACKED_M2M = {
+    'project': (User.projects.through,),
+    'perms': (Role.permissions.through, User.roles.through),
+}
+
+
+def bump_version(name):
+    """
+    Increment the ModelVersion called name, creating it if needed.
+    """
+    if ModelVersion.objects.filter(name=name).update(
+            version=F('version') + 1, changed_at=timezone.now()):
+        return
+    try:
+        with transaction.atomic():
+            ModelVersion.objects.create(name=name, version=1)
+    except IntegrityError:
+        # created concurrently
+        bump_version(name)
+
+
+def get_versions(names):
+    """
+    Return {name: (version, changed_at)} for names, in one query.
+
+    Names without a ModelVersion get (0, None).
+    """
+    result = {n: (0, None) for n in names}
+    for name, version, changed_at in ModelVersion.objects.filter(
+            name__in=names).values_list('name', 'version', 'changed_at'):
+        result[name] = (version, changed_at)
+    return result
+
+
+def _connect_receivers():
+    def make_receiver(name):
+        def on_change(sender, **kwargs):
+            action = kwargs.get('action')
+            if action is None or action.startswith('post_'):
+                bump_version(name)
+        return on_change
+
+    for name, models in TRACKED_MODELS.items():
+        for model in models:
+            uid = 'vimma.conditional.{}.{}'.format(name, model.__name__)
+            post_save.connect(make_receiver(name), sender=model, weak=False,
+                    dispatch_uid=uid)
+            post_delete.connect(make_receiver(name), sender=model,
+                    weak=False, dispatch_uid=uid)
+    for name, models in TRACKED_M2M.items():
+        for model in models:
+            m2m_changed.connect(make_receiver(name), sender=model,
+                    weak=False, dispatch_uid='vimma.conditional.{}.{}'.format(
+                        name, model.__name__))
+
+_connect_receivers()
+
+
+class ConditionalGetMixin():
+    """
+    Add ETag and Last-Modified to a viewset's list and retrieve responses,
+    and answer with 304 Not Modified if the client's copy is current.
+
+    Set version_names to the TRACKED_MODELS names whose changes may alter
+    the responses. The ETag also depends on the user and the request URL
+    and Accept header, because the output does too.
+    """
+    version_names = ()
+
+    def _get_versions(self):
+        if not hasattr(self, '_versions'):
+            self._versions = get_versions(self.version_names)
+        return self._versions
+
+    def get_etag(self, request, *args, **kwargs):
+        versions = self._get_versions()
+        data = [type(self).__name__, request.user.id,
+                request.get_full_path(), request.META.get('HTTP_ACCEPT', ''),
+                sorted((n, v[0]) for n, v in versions.items())]
+        return hashlib.sha1(json.dumps(data).encode('utf-8')).hexdigest()
+
+    def get_last_modified(self, request, *args, **kwargs):
+        times = [v[1] for v in self._get_versions().values()
+                if v[1] is not None]
+        return max(times) if times else None
+
+    def _conditional(self, view, request, *args, **kwargs):
+        response = condition(etag_func=self.get_etag,
+                last_modified_func=self.get_last_modified)(view)(
+                        request, *args, **kwargs)
+        patch_vary_headers(response, ('Accept', 'Cookie'))
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self._conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._conditional(super().retrieve, request, *args, **kwargs)
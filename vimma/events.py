@@ -0,0 +1,170 @@
+import celery.signals
+import celery.states
+from django.conf import settings
+from django.core.signals import got_request_exception, request_finished
+from django.db import transaction
+from django.dispatch import receiver
+import json
+import logging
+import redis
+import select
+import threading
+import time
+
+from vimma.models import VM
+
+
+log = logging.getLogger(__name__)
+
+_CHANNEL_PREFIX = 'vimma:events:project:'
+# Streams send a comment after this many idle seconds.
+_KEEP_ALIVE_SECS = 15
+
+_redis = None
+_local = threading.local()
+# {vm_id: project_id}, a VM's project never changes
+_vm_project_ids = {}
+
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(settings.EVENT_REDIS_URL)
+    return _redis
+
+
+def publish_vm_events(events):
+    """
+    Publish events, a list of dicts with a ‘vm’ (id) and a ‘type’ key.
+
+    Each event goes to its VM's project channel, so stream subscribers get
+    the events of VMs they may see. Does nothing unless settings.EVENT_STREAM
+    is True. Call it after the transaction making the change has committed,
+    because subscribers react by reloading data.
+    """
+    if not settings.EVENT_STREAM or not events:
+        return
+    missing = {e['vm'] for e in events} - set(_vm_project_ids)
+    if missing:
+        _vm_project_ids.update(VM.objects.filter(id__in=missing)
+                .values_list('id', 'project_id'))
+
+    try:
+        pipe = _get_redis().pipeline(transaction=False)
+        for e in events:
+            if e['vm'] in _vm_project_ids:
+                pipe.publish(_CHANNEL_PREFIX + str(_vm_project_ids[e['vm']]),
+                        json.dumps(e, separators=(',', ':')))
+        pipe.execute()
+    except redis.RedisError:
+        log.exception('Can\'t publish VM events')
+
+
+def publish_vm_event(vm_id, type, **kwargs):
+    """
+    Publish a single event, see publish_vm_events().
+    """
+    publish_vm_events([dict(kwargs, vm=vm_id, type=type)])
+
+
+def publish_vm_events_on_commit(events):
+    """
+    Like publish_vm_events(), but inside a transaction wait until it ends.
+
+    Django 1.8 has no transaction.on_commit(), so inside a transaction the
+    events wait for the end of the HTTP request or Celery task (see
+    publish_pending()). They are dropped if the request or task fails,
+    because its transaction may have rolled back.
+    """
+    if not settings.EVENT_STREAM or not events:
+        return
+    if transaction.get_connection().in_atomic_block:
+        if not hasattr(_local, 'pending'):
+            _local.pending = []
+        _local.pending.extend(events)
+    else:
+        publish_vm_events(events)
+
+
+@receiver(got_request_exception)
+def discard_pending(*args, **kwargs):
+    """
+    Drop the events held by publish_vm_events_on_commit().
+    """
+    _local.pending = []
+
+
+@receiver(request_finished)
+@celery.signals.task_postrun.connect
+def publish_pending(*args, state=None, **kwargs):
+    """
+    Publish the events held by publish_vm_events_on_commit().
+
+    Celery passes the task's state: the events of a task which failed or
+    will be retried are dropped. Requests which raised have already dropped
+    theirs in discard_pending().
+    """
+    pending = getattr(_local, 'pending', None)
+    if not pending:
+        return
+    _local.pending = []
+    if state not in (None, celery.states.SUCCESS):
+        return
+    publish_vm_events(pending)
+
+
+def _get_message(pubsub, timeout):
+    """
+    Return pubsub's next message, waiting up to timeout seconds, or None.
+
+    redis-py 2.10's PubSub.get_message() doesn't block, so this waits for
+    its socket to become readable.
+    """
+    if not pubsub.subscribed:
+        time.sleep(timeout)
+        return None
+    conn = pubsub.connection
+    if not conn.can_read():
+        select.select([conn._sock], [], [], timeout)
+    return pubsub.get_message()
+
+
+def event_stream(project_ids):
+    """
+    Yield Server-Sent Events text for the VM events in project_ids.
+
+    project_ids is a set of Project ids, or None for all projects.
+    Ends after settings.EVENT_STREAM_MAX_SECS, telling the browser to
+    reconnect. Sends a comment after 15 idle seconds to keep the connection
+    open.
+    """
+    pubsub = _get_redis().pubsub(ignore_subscribe_messages=True)
+    try:
+        if project_ids is None:
+            pubsub.psubscribe(_CHANNEL_PREFIX + '*')
+        elif project_ids:
+            pubsub.subscribe(*[_CHANNEL_PREFIX + str(p)
+                for p in project_ids])
+
+        yield 'retry: 3000\n\n'
+        last_sent = time.monotonic()
+        end = last_sent + settings.EVENT_STREAM_MAX_SECS
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                break
+            if now - last_sent >= _KEEP_ALIVE_SECS:
+                last_sent = now
+                yield ': keep-alive\n\n'
+                continue
+            msg = _get_message(pubsub,
+                    min(end, last_sent + _KEEP_ALIVE_SECS) - now)
+            if msg:
+                last_sent = time.monotonic()
+                yield 'event: vm\ndata: {}\n\n'.format(
+                        msg['data'].decode('utf-8'))
+    except redis.RedisError:
+        # the browser reconnects
+        log.exception('VM event stream failed')
+    finally:
+        pubsub.close()
@@ -1,5 +1,7 @@
 import datetime
 from django.conf import settings
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
 from django.utils.timezone import utc
 import pytz
 
@@ -36,21 +38,51 @@ def needs_notification(expires_at, last_notification, notif_intervals):
     return notif_intervals[0] <= now_secs
 
 
+def next_due_at(expires_at, last_notification, notif_intervals,
+        grace_interval):
+    """
+    Returns when the next notification or the grace end action is due.
+
+    Returns a datetime. See needs_notification for the arguments;
+    grace_interval is in seconds.
+    """
+    if last_notification:
+        last_secs = (last_notification - expires_at).total_seconds()
+        notif_intervals = [x for x in notif_intervals if x > last_secs]
+    secs = grace_interval
+    if notif_intervals:
+        secs = min(secs, notif_intervals[0])
+    return expires_at + datetime.timedelta(seconds=secs)
+
+
 def get_controller(expiration_id):
     def call():
         e = Expiration.objects.get(id=expiration_id)
-        if e.type == Expiration.TYPE_VM:
-            return VMExpirationController(expiration_id)
-        elif e.type == Expiration.TYPE_FIREWALL_RULE:
-            return FirewallRuleExpirationController(expiration_id)
-        else:
+        if e.type not in _CONTROLLER_CLASSES:
             raise Exception("Can't find Controller " +
                     "for Expiration object " + str(expiration_id) +
                     " of type " + e.type)
+        return _CONTROLLER_CLASSES[e.type](expiration_id)
 
     return retry_in_transaction(call)
 
 
+@receiver(pre_save, sender=Expiration)
+def _set_next_due_at(sender, instance, **kwargs):
+    """
+    Keep Expiration.next_due_at in sync with the fields it depends on.
+    """
+    if instance.type not in _CONTROLLER_CLASSES:
+        return
+    if instance.grace_end_action_performed:
+        instance.next_due_at = None
+        return
+    c = _CONTROLLER_CLASSES[instance.type](instance.id)
+    instance.next_due_at = next_due_at(instance.expires_at,
+            instance.last_notification, c.get_notification_intervals(),
+            c.get_grace_interval())
+
+
 class ExpirationController:
     """
     Base class showing the common interface.
@@ -157,6 +189,14 @@ class ExpirationController:
     def _do_perform_grace_action(self):
         raise NotImplementedError()
 
+    def update_next_due_at(self):
+        """
+        Recompute and save next_due_at, e.g. after the intervals changed.
+        """
+        def write():
+            Expiration.objects.get(id=self.exp_id).save()
+        retry_in_transaction(write)
+
 
 class VMExpirationController(ExpirationController):
 
@@ -240,3 +280,9 @@ class FirewallRuleExpirationController(ExpirationController):
             return exp.firewallruleexpiration.firewallrule.id
         rule_id = retry_in_transaction(get_fw_id)
         vimma.vmutil.delete_firewall_rule(rule_id)
+
+
+_CONTROLLER_CLASSES = {
+    Expiration.TYPE_VM: VMExpirationController,
+    Expiration.TYPE_FIREWALL_RULE: FirewallRuleExpirationController,
+}
@@ -0,0 +1,32 @@
+import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import utc
+
+from vimma.archive import archive_audits
+
+
+class Command(BaseCommand):
+    help = 'Moves old Audit objects to compressed archive files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                help='Archive Audits older than this many days ' +
+                '(default: settings.AUDIT_RETENTION_SECS)')
+        parser.add_argument('--dir', default=settings.AUDIT_ARCHIVE_DIR,
+                help='Write the archive files to this directory')
+        parser.add_argument('--batch-size', type=int,
+                default=settings.AUDIT_ARCHIVE_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if options['days'] is not None:
+            secs = options['days'] * 60*60*24
+        elif settings.AUDIT_RETENTION_SECS is not None:
+            secs = settings.AUDIT_RETENTION_SECS
+        else:
+            raise CommandError('Pass --days or set AUDIT_RETENTION_SECS')
+
+        now = datetime.datetime.utcnow().replace(tzinfo=utc)
+        before = now - datetime.timedelta(seconds=secs)
+        n = archive_audits(before, options['dir'], options['batch_size'])
+        self.stdout.write('Archived {} Audits older than {}'.format(n, before))
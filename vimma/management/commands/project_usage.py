@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from vimma.projection import project_vms, summarize
+
+
+class Command(BaseCommand):
+    help = 'Prints the projected powered-on hours and cost of the VMs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--weeks', type=int, default=4,
+                help='Project this many weeks ahead (default: 4)')
+        parser.add_argument('--project', type=int, action='append',
+                default=[], help='Only VMs in this project (may be repeated)')
+
+    def handle(self, *args, **options):
+        weeks = options['weeks']
+        if not 0 < weeks <= settings.PROJECTION_MAX_WEEKS:
+            raise CommandError('--weeks must be between 1 and {}'.format(
+                settings.PROJECTION_MAX_WEEKS))
+
+        vm_filter = Q()
+        if options['project']:
+            vm_filter = Q(project__id__in=options['project'])
+        projects, total = summarize(project_vms(vm_filter, weeks))
+        for prj_id, p in sorted(projects.items()):
+            self.stdout.write('Project {}: {:.1f} h, {:.2f}'.format(prj_id,
+                p['hours'], p['cost']))
+        self.stdout.write('Total over {} weeks: {:.1f} h, {:.2f}'.format(
+            weeks, total['hours'], total['cost']))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from vimma.ratelimit import get_stats, reset_stats
+
+
+class Command(BaseCommand):
+    help = 'Shows the calls and wait times of the rate limit token buckets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true',
+                help='Reset the counters after showing them')
+
+    def handle(self, *args, **options):
+        for bucket, stats in sorted(get_stats().items()):
+            avg = stats['wait_secs'] / stats['waits'] if stats['waits'] else 0
+            self.stdout.write('{}: {} calls, {} waited, {:.3f}s total wait, '
+                    '{:.3f}s average wait, {} over the maximum wait'.format(
+                        bucket, stats['calls'], stats['waits'],
+                        stats['wait_secs'], avg, stats['rejects']))
+        if options['reset']:
+            reset_stats()
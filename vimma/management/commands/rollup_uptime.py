@@ -0,0 +1,29 @@
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+
+from vimma.uptime import update_uptime_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the VM and project uptime rollups from PowerLogs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since',
+                help='Recompute from this day, YYYY-MM-DD (default: a few ' +
+                'days before the latest rollup, see ' +
+                'settings.UPTIME_ROLLUP_LOOKBACK_DAYS)')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since'] is not None:
+            try:
+                since = datetime.datetime.strptime(options['since'],
+                        '%Y-%m-%d').date()
+            except ValueError as e:
+                raise CommandError(e)
+
+        since = update_uptime_rollups(since)
+        if since is None:
+            self.stdout.write('No PowerLogs')
+        else:
+            self.stdout.write('Recomputed uptime since {}'.format(since))
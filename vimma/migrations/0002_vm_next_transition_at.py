@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vimma', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vm',
+            name='next_transition_at',
+            field=models.DateTimeField(blank=True, null=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vimma', '0003_audit_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='audit',
+            index_together=set([('user', 'timestamp'), ('vm', 'timestamp'), ('level', 'timestamp')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='powerlog',
+            index_together=set([('vm', 'timestamp')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+def mark_pending_due(apps, schema_editor):
+    """
+    Make the dispatchers check each pending Expiration once; checking saves
+    its real next_due_at.
+    """
+    Expiration = apps.get_model('vimma', 'Expiration')
+    Expiration.objects.filter(grace_end_action_performed=False).update(
+            next_due_at=django.utils.timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vimma', '0005_modelversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expiration',
+            name='next_due_at',
+            field=models.DateTimeField(blank=True, null=True, db_index=True),
+        ),
+        migrations.RunPython(mark_pending_due, migrations.RunPython.noop),
+    ]
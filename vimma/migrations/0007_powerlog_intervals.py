@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+def compact_power_logs(apps, schema_editor):
+    """
+    Merge each VM's consecutive PowerLogs with the same state into one
+    interval, lasting until the last of them.
+    """
+    PowerLog = apps.get_model('vimma', 'PowerLog')
+    vm_ids = (PowerLog.objects.order_by().values_list('vm_id', flat=True)
+            .distinct())
+    for vm_id in list(vm_ids):
+        # [[id, powered_on, last timestamp]]
+        intervals = []
+        redundant_ids = []
+        for pl_id, timestamp, powered_on in (PowerLog.objects
+                .filter(vm_id=vm_id).order_by('timestamp', 'id')
+                .values_list('id', 'timestamp', 'powered_on').iterator()):
+            if intervals and intervals[-1][1] == powered_on:
+                intervals[-1][2] = timestamp
+                redundant_ids.append(pl_id)
+            else:
+                intervals.append([pl_id, powered_on, timestamp])
+
+        for pl_id, powered_on, last in intervals:
+            PowerLog.objects.filter(id=pl_id).update(last_confirmed_at=last)
+        for i in range(0, len(redundant_ids), 500):
+            PowerLog.objects.filter(id__in=redundant_ids[i:i+500]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vimma', '0006_expiration_next_due_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='powerlog',
+            name='last_confirmed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(compact_power_logs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vimma', '0007_powerlog_intervals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProjectUptime',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('day', models.DateField(db_index=True)),
+                ('powered_on_secs', models.BigIntegerField()),
+                ('project', models.ForeignKey(to='vimma.Project')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='VMUptime',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('day', models.DateField(db_index=True)),
+                ('powered_on_secs', models.IntegerField()),
+                ('vm', models.ForeignKey(to='vimma.VM')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='vmuptime',
+            unique_together=set([('vm', 'day')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='projectuptime',
+            unique_together=set([('project', 'day')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vimma', '0008_uptime_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='awsvm',
+            name='instance_type',
+            field=models.CharField(max_length=50, blank=True),
+        ),
+    ]
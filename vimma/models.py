@@ -1,6 +1,7 @@
 from django.contrib.auth.models import User as DefaultUser, AbstractBaseUser, AbstractUser
 from django.core.exceptions import ValidationError
 from django.db import models, transaction
+from django.utils import timezone
 from django.conf import settings
 import json
 import logging
@@ -289,6 +290,10 @@ class VM(models.Model):
     # fields are in the provider-specific VM submodels, but updating the status
     # is a common action for all VMs so the field is here.
     status_updated_at = models.DateTimeField(null=True, blank=True)
+    # When the VM's wanted power state (from schedule, override or expiration)
+    # may next change. Dispatched by vimma.vmutil.dispatch_power_transitions.
+    next_transition_at = models.DateTimeField(null=True, blank=True,
+            db_index=True)
 
     # First a user requests destruction
     destroy_request_at = models.DateTimeField(blank=True, null=True)
@@ -334,6 +339,8 @@ class AWSVM(models.Model):
     security_group_id = models.CharField(max_length=50, blank=True)
     reservation_id = models.CharField(max_length=50, blank=True)
     instance_id = models.CharField(max_length=50, blank=True)
+    # copied from the AWSVMConfig when the VM is created
+    instance_type = models.CharField(max_length=50, blank=True)
     # public IP address
     ip_address = models.CharField(max_length=50, blank=True)
     private_ip_address = models.CharField(max_length=50, blank=True)
@@ -401,7 +408,9 @@ class AWSFirewallRule(models.Model):
         return False
 
 class Audit(models.Model):
-    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Not auto_now_add, which would set the time when buffered Audit objects
+    # are saved instead of when they're created.
+    timestamp = models.DateTimeField(default=timezone.now, db_index=True)
 
     # Imitating https://docs.python.org/3/library/logging.html#logging-levels
     # Sorting level names lexicographically to query by min_level in the API.
@@ -435,19 +444,69 @@ class Audit(models.Model):
     vm = models.ForeignKey(VM, null=True, blank=True,
             on_delete=models.SET_NULL)
 
+    class Meta:
+        # for the API's filters, ordered by -timestamp
+        index_together = (
+            ('vm', 'timestamp'),
+            ('user', 'timestamp'),
+            ('level', 'timestamp'),
+        )
+
 
 class PowerLog(models.Model):
     """
-    The power state (ON or OFF) of a VM at a point in time.
+    An interval during which a VM had the same power state (ON or OFF).
+
+    The interval starts at timestamp, when the state was first seen, and
+    lasts at least until last_confirmed_at, when it was most recently seen.
+    vimma.vmutil.power_log(…) extends the VM's latest PowerLog or starts a
+    new one if the state changed.
 
     If you're not sure what the vm's state is (e.g. you encountered an error
     while checking it) don't create a PowerLog object.
     """
     vm = models.ForeignKey(VM, on_delete=models.CASCADE)
     timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
+    last_confirmed_at = models.DateTimeField(default=timezone.now)
     # True → ON, False → OFF. Can't be None, so the value must be explicit.
     powered_on = models.BooleanField(default=None)
 
+    class Meta:
+        index_together = (
+            ('vm', 'timestamp'),
+        )
+
+
+class VMUptime(models.Model):
+    """
+    How many seconds a VM was powered on during a day (UTC).
+
+    Computed from PowerLogs by vimma.uptime. Days without powered-on time
+    have no row.
+    """
+    vm = models.ForeignKey(VM, on_delete=models.CASCADE)
+    day = models.DateField(db_index=True)
+    powered_on_secs = models.IntegerField()
+
+    class Meta:
+        unique_together = (
+            ('vm', 'day'),
+        )
+
+
+class ProjectUptime(models.Model):
+    """
+    The sum of VMUptime.powered_on_secs for a project's VMs during a day.
+    """
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    day = models.DateField(db_index=True)
+    powered_on_secs = models.BigIntegerField()
+
+    class Meta:
+        unique_together = (
+            ('project', 'day'),
+        )
+
 
 class Expiration(models.Model):
     """
@@ -471,6 +530,10 @@ class Expiration(models.Model):
     # when the most recent notification was sent
     last_notification = models.DateTimeField(blank=True, null=True)
     grace_end_action_performed = models.BooleanField(default=False)
+    # When the next notification or the grace end action is due, None if
+    # there's nothing left to do. Set on save by vimma.expiry.
+    next_due_at = models.DateTimeField(null=True, blank=True,
+            db_index=True)
 
 
 class VMExpiration(models.Model):
@@ -481,3 +544,14 @@ class VMExpiration(models.Model):
 class FirewallRuleExpiration(models.Model):
     expiration = models.OneToOneField(Expiration, on_delete=models.CASCADE)
     firewallrule = models.OneToOneField(FirewallRule, on_delete=models.CASCADE)
+
+
+class ModelVersion(models.Model):
+    """
+    A counter incremented whenever some objects change, e.g. all TimeZones.
+
+    Used to answer conditional HTTP requests without querying the objects.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    version = models.BigIntegerField(default=0)
+    changed_at = models.DateTimeField(default=timezone.now)
@@ -0,0 +1,126 @@
+"""
+Projected powered-on hours and cost of VMs over the coming weeks.
+
+Each Schedule is a 336-bit int (see vimma.schedule.CompiledSchedule), so a
+VM's ON slots over any number of weeks are counted with a few bit operations.
+VMs sharing a schedule and an unchanged time window (no schedule override or
+expiration inside it) share the result, so the cost grows with the number of
+schedules rather than VMs × slots.
+"""
+
+from django.conf import settings
+from django.utils.timezone import utc
+import datetime
+import json
+
+from vimma.models import VM, Schedule, schedule_matrix_validator
+from vimma.schedule import CompiledSchedule, get_compiled_schedule
+
+
+WEEK_SECS = 7 * 24 * 60 * 60
+
+
+def hourly_price(instance_type):
+    """
+    Return the price of running an instance_type VM for an hour.
+
+    instance_type is '' for non-AWS VMs and for AWS VMs created before it
+    was recorded.
+    """
+    return settings.VM_HOURLY_PRICES.get(instance_type,
+            settings.VM_DEFAULT_HOURLY_PRICE)
+
+
+def project_vms(vm_filter, weeks, now=None, schedule_matrices=None):
+    """
+    Estimate the powered-on hours and cost of VMs for the next weeks.
+
+    vm_filter is a Q object or dict of filter kwargs selecting the VMs
+    (destroyed VMs are always excluded). schedule_matrices, {schedule id:
+    7×48 matrix}, replaces saved schedules, e.g. to preview an edit.
+    now is a unix timestamp (default: the current time).
+
+    Returns [{'vm': id, 'project': id, 'hours': float, 'cost': float}],
+    ordered by VM id. A VM is OFF after its expiration date and follows its
+    schedule override until the override ends.
+    """
+    if now is None:
+        now = datetime.datetime.utcnow().replace(tzinfo=utc).timestamp()
+    schedule_matrices = schedule_matrices or {}
+    horizon = now + weeks * WEEK_SECS
+
+    qs = VM.objects.filter(destroyed_at=None)
+    qs = qs.filter(**vm_filter) if type(vm_filter) is dict else qs.filter(
+            vm_filter)
+    rows = list(qs.order_by('id').values_list('id', 'project_id',
+        'schedule_id', 'sched_override_state', 'sched_override_tstamp',
+        'vmexpiration__expiration__expires_at', 'awsvm__instance_type'))
+
+    compiled = {}
+    for schedule in Schedule.objects.filter(
+            id__in={r[2] for r in rows}).select_related('timezone'):
+        if schedule.id in schedule_matrices:
+            compiled[schedule.id] = CompiledSchedule(
+                    schedule_matrices[schedule.id], schedule.timezone.name)
+        else:
+            compiled[schedule.id] = get_compiled_schedule(schedule)
+
+    # {(schedule id, start, slots): ON slots}
+    on_slots = {}
+    result = []
+    for (vm_id, prj_id, sched_id, override_state, override_tstamp,
+            expires_at, instance_type) in rows:
+        start, end = now, horizon
+        if expires_at is not None:
+            end = min(end, expires_at.timestamp())
+
+        on_secs = 0
+        if override_state is not None and override_tstamp >= start:
+            # the override applies up to and including its end timestamp
+            override_end = min(override_tstamp + 1, end)
+            if override_state:
+                on_secs += max(override_end - start, 0)
+            start = override_end
+
+        if end > start:
+            n = int((end - start) // CompiledSchedule.SLOT_SECS)
+            key = sched_id, start, n
+            if key not in on_slots:
+                on_slots[key] = compiled[sched_id].count_on_slots(start, n)
+            on_secs += on_slots[key] * CompiledSchedule.SLOT_SECS
+
+        hours = on_secs / 3600
+        result.append({'vm': vm_id, 'project': prj_id, 'hours': hours,
+            'cost': hours * hourly_price(instance_type or '')})
+    return result
+
+
+def summarize(projections):
+    """
+    Return ({project id: {'hours': …, 'cost': …}}, total {'hours', 'cost'})
+    for the result of project_vms.
+    """
+    projects = {}
+    total = {'hours': 0, 'cost': 0}
+    for p in projections:
+        prj = projects.setdefault(p['project'], {'hours': 0, 'cost': 0})
+        for k in 'hours', 'cost':
+            prj[k] += p[k]
+            total[k] += p[k]
+    return projects, total
+
+
+def parse_schedule_matrices(data):
+    """
+    Parse {schedule id: matrix} from a request, for project_vms.
+
+    Each matrix is a JSON string, like Schedule.matrix, or the parsed list.
+    Raises ValidationError for invalid matrices.
+    """
+    result = {}
+    for sched_id, matrix in data.items():
+        if type(matrix) is not str:
+            matrix = json.dumps(matrix)
+        schedule_matrix_validator(matrix)
+        result[int(sched_id)] = json.loads(matrix)
+    return result
@@ -0,0 +1,145 @@
+"""
+Token buckets in Redis, shared by all processes using the same Redis.
+
+A bucket holds up to ‘burst’ tokens and gains ‘rate’ tokens per second.
+Each call takes a token. When the bucket is empty the call reserves a future
+token (the count goes negative) and sleeps until it is due, so waiting
+callers are served in order without polling Redis. Inside
+raise_over_max_wait(), a call which would wait longer than
+settings.RATE_LIMIT_MAX_WAIT_SECS reserves nothing and raises
+RateLimitExceeded instead.
+"""
+
+import contextlib
+from django.conf import settings
+import logging
+import redis
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+_KEY_PREFIX = 'vimma:ratelimit:'
+_STATS_KEY = _KEY_PREFIX + 'stats'
+
+# Returns the seconds to wait for the reserved token, or minus the seconds
+# it would have to wait if that's over the maximum (ARGV[4], negative for no
+# maximum) and no token was reserved. As a string because Lua numbers are
+# truncated to integers in replies. Uses the Redis clock, so the callers'
+# clocks don't matter.
+_ACQUIRE_SCRIPT = '''
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[4])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(b[1]) or burst
+local ts = tonumber(b[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+redis.call('HINCRBY', KEYS[2], ARGV[3] .. ':calls', 1)
+if max_wait >= 0 and wait > max_wait then
+    redis.call('HINCRBY', KEYS[2], ARGV[3] .. ':rejects', 1)
+    wait = -wait
+else
+    tokens = tokens - 1
+    if wait > 0 then
+        redis.call('HINCRBY', KEYS[2], ARGV[3] .. ':waits', 1)
+        redis.call('HINCRBYFLOAT', KEYS[2], ARGV[3] .. ':wait_secs', wait)
+    end
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate + math.abs(wait)) + 1)
+return tostring(wait)
+'''
+
+_redis = None
+_acquire_script = None
+_local = threading.local()
+
+
+class RateLimitExceeded(Exception):
+    """
+    A token would take longer than the maximum wait.
+    """
+
+
+def _get_redis():
+    global _redis, _acquire_script
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(settings.RATE_LIMIT_REDIS_URL)
+        _acquire_script = _redis.register_script(_ACQUIRE_SCRIPT)
+    return _redis
+
+
+@contextlib.contextmanager
+def raise_over_max_wait():
+    """
+    Make acquire() raise instead of waiting long in the with-block.
+
+    For code which retries later on RateLimitExceeded, e.g. Celery tasks, so
+    they don't hold a worker. Elsewhere acquire() waits as long as needed.
+    """
+    _local.depth = getattr(_local, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _local.depth -= 1
+
+
+def acquire(bucket, rate, burst):
+    """
+    Take a token from bucket (a string), sleeping until one is available.
+
+    Returns the seconds slept. Inside raise_over_max_wait() raises
+    RateLimitExceeded if that would be longer than
+    settings.RATE_LIMIT_MAX_WAIT_SECS (if not None). If Redis is
+    unavailable, doesn't wait.
+    """
+    max_wait = None
+    if getattr(_local, 'depth', 0):
+        max_wait = settings.RATE_LIMIT_MAX_WAIT_SECS
+    try:
+        _get_redis()
+        wait = float(_acquire_script(keys=[_KEY_PREFIX + bucket, _STATS_KEY],
+            args=[rate, burst, bucket, -1 if max_wait is None else max_wait])
+            .decode('ascii'))
+    except redis.RedisError:
+        log.exception('Can\'t acquire a token from {}'.format(bucket))
+        return 0
+    if wait < 0:
+        raise RateLimitExceeded('{}: a token is {:.3f}s away, over {}s'
+                .format(bucket, -wait, max_wait))
+    if wait > 0:
+        time.sleep(wait)
+    return wait
+
+
+def get_stats():
+    """
+    Return {bucket: {'calls': int, 'waits': int, 'wait_secs': float,
+    'rejects': int}}.
+
+    ‘waits’ counts the calls which had to wait, ‘wait_secs’ is their total
+    wait time. ‘rejects’ counts the calls which raised RateLimitExceeded.
+    The counters are kept until reset_stats().
+    """
+    result = {}
+    for field, value in _get_redis().hgetall(_STATS_KEY).items():
+        bucket, name = field.decode('utf-8').rsplit(':', 1)
+        stats = result.setdefault(bucket,
+                {'calls': 0, 'waits': 0, 'wait_secs': 0.0, 'rejects': 0})
+        stats[name] = type(stats[name])(value.decode('ascii'))
+    return result
+
+
+def reset_stats():
+    _get_redis().delete(_STATS_KEY)
@@ -0,0 +1,144 @@
+import datetime
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+import json
+import pytz
+
+from vimma.models import Schedule, TimeZone
+
+
+class CompiledSchedule():
+    """
+    A Schedule's matrix packed into an int, with its timezone resolved.
+
+    Bit (row * 48 + col) is set if the schedule says ON on weekday ‘row’
+    (0 is Monday) during the half-hour ‘col’ (0 is [0:00, 0:30)), in the
+    schedule's timezone. Use get_compiled_schedule(…) to obtain instances.
+    """
+
+    SLOTS_PER_DAY = 48
+    SLOTS = 7 * SLOTS_PER_DAY
+    SLOT_SECS = 30 * 60
+
+    def __init__(self, matrix, tz_name):
+        """
+        matrix is the parsed 7×48 Schedule.matrix, tz_name the TimeZone name.
+        """
+        bits = 0
+        for row_idx, row in enumerate(matrix):
+            for col_idx, val in enumerate(row):
+                if val:
+                    bits |= 1 << (row_idx * self.SLOTS_PER_DAY + col_idx)
+        self.bits = bits
+        self.tz = pytz.timezone(tz_name)
+
+    def _local(self, tstamp):
+        """
+        Return the aware datetime in the schedule's timezone for unix tstamp.
+        """
+        naive = datetime.datetime.utcfromtimestamp(tstamp)
+        return pytz.utc.localize(naive).astimezone(self.tz)
+
+    def _slot(self, aware):
+        """
+        Return the slot index (bit position) for an aware local datetime.
+        """
+        return (aware.weekday() * self.SLOTS_PER_DAY +
+                aware.hour * 2 + aware.minute // 30)
+
+    def _slot_on(self, slot):
+        return bool((self.bits >> (slot % self.SLOTS)) & 1)
+
+    def is_on(self, tstamp):
+        """
+        Return True if the schedule says ON at unix tstamp, else False.
+        """
+        return self._slot_on(self._slot(self._local(tstamp)))
+
+    def count_on_slots(self, tstamp, n):
+        """
+        Return how many of the n slots starting with tstamp's slot are ON.
+
+        Counts whole weeks with one popcount instead of walking the slots.
+        Slots are consecutive in local time, so a DST change shifts the
+        result by at most 2 slots.
+        """
+        weeks, rest = divmod(n, self.SLOTS)
+        first = self._slot(self._local(tstamp))
+        # rotate the week so it starts at the first slot
+        rotated = ((self.bits >> first) |
+                (self.bits << (self.SLOTS - first))) & ((1 << self.SLOTS) - 1)
+        return (weeks * bin(self.bits).count('1') +
+                bin(rotated & ((1 << rest) - 1)).count('1'))
+
+    def next_transition_after(self, tstamp):
+        """
+        Return the first unix timestamp > tstamp where the state changes.
+
+        Returns None if the schedule is always ON or always OFF.
+        """
+        if self.bits == 0 or self.bits == (1 << self.SLOTS) - 1:
+            return None
+
+        t = tstamp
+        aware = self._local(t)
+        state = self._slot_on(self._slot(aware))
+        # A week of slots plus slack for the DST single-stepping below.
+        for i in range(2 * self.SLOTS):
+            slot = self._slot(aware)
+            # slots until the first one with a different state
+            k = 1
+            while self._slot_on(slot + k) == state:
+                k += 1
+
+            into_slot = (aware.minute % 30 * 60 + aware.second +
+                    aware.microsecond / 1e6)
+            to_boundary = self.SLOT_SECS - into_slot
+            t_next = round(t + to_boundary + (k - 1) * self.SLOT_SECS)
+            aware_next = self._local(t_next)
+            if aware_next.utcoffset() != aware.utcoffset():
+                # The UTC offset changes on the way (DST). Local slots are not
+                # contiguous in UTC there, so step one slot at a time.
+                t_next = round(t + to_boundary)
+                aware_next = self._local(t_next)
+
+            if self._slot_on(self._slot(aware_next)) != state:
+                return t_next
+            t, aware = t_next, aware_next
+        return None
+
+
+# {schedule_id: ((matrix, timezone name), CompiledSchedule)}
+_compiled = {}
+
+
+@receiver(post_save, sender=Schedule)
+@receiver(post_delete, sender=Schedule)
+def _discard_compiled(sender, instance, **kwargs):
+    _compiled.pop(instance.id, None)
+
+
+@receiver(post_save, sender=TimeZone)
+@receiver(post_delete, sender=TimeZone)
+def _discard_all_compiled(sender, **kwargs):
+    _compiled.clear()
+
+
+def get_compiled_schedule(schedule):
+    """
+    Return the CompiledSchedule for schedule (Schedule object).
+
+    The result is cached per schedule id and reused while the schedule's
+    matrix and timezone stay the same, so the matrix JSON isn't parsed on
+    every evaluation. Use select_related('timezone') (or ‘schedule__timezone’)
+    when loading the schedule to avoid an extra query here.
+    """
+    key = (schedule.matrix, schedule.timezone.name)
+    cached = _compiled.get(schedule.id)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    compiled = CompiledSchedule(json.loads(schedule.matrix), key[1])
+    if schedule.id is not None:
+        _compiled[schedule.id] = (key, compiled)
+    return compiled
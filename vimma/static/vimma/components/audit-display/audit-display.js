@@ -66,6 +66,12 @@ Polymer({
             value: null
         },
 
+        // The total number of results, only sent with the first page
+        _count: {
+            type: Number,
+            value: 0
+        },
+
         _view: {
             type: String,
             computed: '_computeView(_loading, _error, _data)'
@@ -93,6 +99,20 @@ Polymer({
         }
     },
 
+    attached: function() {
+        this._stopVMEvents = onVMEvent((function(ev) {
+            // only refresh the newest page, not one the user is reading
+            if (ev.type == 'audit' && ev.vm == this.vmid &&
+                    ev.level >= this._minLevel.id && this._firstItemNr == 1) {
+                this._reload();
+            }
+        }).bind(this));
+    },
+
+    detached: function() {
+        this._stopVMEvents();
+    },
+
     // <select> ‘change’ event
     _minLevelChange: function(ev) {
         this._minLevel = this._auditLevels[ev.target.selectedIndex];
@@ -117,6 +137,7 @@ Polymer({
             params.push('user=' + userid);
         }
         params.push(restPageSizeQueryParam + '=' + pageSize);
+        params.push('count=true');
 
         if (params.length) {
             url += '?' + params.join('&');
@@ -153,6 +174,9 @@ Polymer({
         }
 
         this._error = null;
+        if ('count' in ev.detail.response) {
+            this._count = ev.detail.response.count;
+        }
         this.set('_data', ev.detail.response);
     },
 
@@ -28,6 +28,18 @@ Polymer({
         }
     },
 
+    attached: function() {
+        this._stopVMEvents = onVMEvent((function(ev) {
+            if (ev.vm == this.vmid && ev.type == 'powerlog') {
+                this._reload();
+            }
+        }).bind(this));
+    },
+
+    detached: function() {
+        this._stopVMEvents();
+    },
+
     _vmidChanged: function(newV, oldV) {
         this._reload();
     },
@@ -71,37 +83,17 @@ Polymer({
     },
 
     _computeChartData: function(apiData, showOnlyTransitions) {
+        // Each PowerLog is an interval, newest first. Plot its end (when
+        // the state was last confirmed) and its start.
         var dataPoints = [];
         apiData.results.forEach(function(pl) {
-            var x = new Date(pl.timestamp).valueOf(),
-                y = pl.powered_on ? 1 : 0;
-            dataPoints.push([x, y]);
+            var y = pl.powered_on ? 1 : 0;
+            if (!showOnlyTransitions) {
+                dataPoints.push([new Date(pl.last_confirmed_at).valueOf(), y]);
+            }
+            dataPoints.push([new Date(pl.timestamp).valueOf(), y]);
         });
 
-        if (showOnlyTransitions) {
-            dataPoints = (function() {
-                // remove a data point if it has the same y value as both its
-                // left and right neighbours.
-                var idxToRemove = {}, i, crtV, leftV, rightV;
-                for (i = 1; i < dataPoints.length - 1; i++) {
-                    crtV = dataPoints[i][1];
-                    leftV = dataPoints[i-1][1];
-                    rightV = dataPoints[i+1][1];
-                    if (crtV == leftV && crtV == rightV) {
-                        idxToRemove[i] = null;
-                    }
-                }
-
-                var result = [];
-                for (i = 0; i < dataPoints.length; i++) {
-                    if (!(i in idxToRemove)) {
-                        result.push(dataPoints[i]);
-                    }
-                }
-                return result;
-            })();
-        }
-
         return dataPoints.reverse();
     },
 
@@ -76,70 +76,74 @@
     };
 
 
-    /* Load the data model for the VM with vmid.
-     * If anything fails, call errCallback(errorText).
-     * Else call successCallback(vmDataModel).
+    /* Make the data model for vm (from the vmdetails API, with its
+     * provider-specific object and expiration nested).
+     * providers, projects and awsProviders map the ids of Providers, Projects
+     * and (by their provider field) AWSProviders to the objects.
+     * Returns the model or, if something is missing, an error string.
      */
-    function loadVM(vmid, successCallback, errCallback) {
-        apiGet([vimmaApiVMDetailRoot + vmid + '/'], function(resArr) {
-            loadProvPrjVmExp(resArr[0]);
-        }, errCallback);
-
-        function loadProvPrjVmExp(vm) {
-            var provUrl = vimmaApiProviderDetailRoot + vm.provider + '/',
-                prjUrl = vimmaApiProjectDetailRoot + vm.project + '/',
-                vmExpUrl = vimmaApiVMExpirationDetailRoot + '?vm=' + vm.id;
-            apiGet([provUrl, prjUrl, vmExpUrl], function(resArr) {
-                var prov = resArr[0], prj = resArr[1],
-                    vmExp = resArr[2].results[0];
-                loadExp(vm, prov, prj, vmExp);
-            }, errCallback);
+    function makeVMModel(vm, providers, projects, awsProviders) {
+        var provider = providers[vm.provider],
+            project = projects[vm.project];
+        if (!provider || !project || !vm.expiration) {
+            return 'Incomplete data for VM ' + vm.id;
         }
 
-        function loadExp(vm, provider, project, vm_expiration) {
-            var url = vimmaApiExpirationDetailRoot +
-                vm_expiration.expiration + '/';
-            apiGet([url], function(resArr) {
-                makeVMModel(vm, provider, project, resArr[0]);
-            }, errCallback);
+        switch (provider.type) {
+            case 'dummy':
+                return new DummyVMModel(vm, provider, project, vm.expiration,
+                        vm.dummyvm);
+            case 'aws':
+                return new AWSVMModel(vm, provider, project, vm.expiration,
+                        vm.awsvm, awsProviders[provider.id]);
+            default:
+                return 'Unknown Provider type: ' + provider.type;
         }
+    }
 
-        function makeVMModel(vm, provider, project, expiration) {
-            switch (provider.type) {
-                case 'dummy':
-                    makeDummyVMModel(vm, provider, project, expiration);
-                    return;
-                case 'aws':
-                    makeAWSVMModel(vm, provider, project, expiration);
-                    return;
-                default:
-                    errCallback('Unknown Provider type: ' + provider.type);
+    /* Make the data models for vms (from the vmdetails API), loading the
+     * Providers, Projects and AWSProviders once for all of them.
+     * If anything fails, call errCallback(errorText).
+     * Else call successCallback(arrayOfVMDataModels).
+     */
+    function makeVMModels(vms, successCallback, errCallback) {
+        apiGetAll([vimmaApiProviderList, vimmaApiProjectList,
+                vimmaApiAWSProviderList], function(resArr) {
+            var providers = {}, projects = {}, awsProviders = {},
+                models = [], i, model;
+            resArr[0].forEach(function(p) {
+                providers[p.id] = p;
+            });
+            resArr[1].forEach(function(p) {
+                projects[p.id] = p;
+            });
+            resArr[2].forEach(function(p) {
+                awsProviders[p.provider] = p;
+            });
+
+            for (i = 0; i < vms.length; i++) {
+                model = makeVMModel(vms[i], providers, projects,
+                        awsProviders);
+                if (typeof(model) === 'string') {
+                    errCallback(model);
                     return;
+                }
+                models.push(model);
             }
-        }
-
-        function makeDummyVMModel(vm, provider, project, expiration) {
-            var url = vimmaApiDummyVMDetailRoot + '?vm=' + vm.id;
-            apiGet([url], function(resArr) {
-                var dummy_vm = resArr[0].results[0],
-                    model = new DummyVMModel(vm, provider, project, expiration,
-                            dummy_vm);
-                successCallback(model);
-            }, errCallback);
-        }
+            successCallback(models);
+        }, errCallback);
+    }
 
-        function makeAWSVMModel(vm, provider, project, expiration) {
-            var aws_vm_url = vimmaApiAWSVMDetailRoot + '?vm=' + vm.id,
-                aws_prov_url = vimmaApiAWSProviderDetailRoot +
-                    '?provider=' + provider.id;
-            apiGet([aws_vm_url, aws_prov_url], function(resArr) {
-                var aws_vm = resArr[0].results[0],
-                    aws_provider = resArr[1].results[0],
-                    model = new AWSVMModel(vm, provider, project, expiration,
-                            aws_vm, aws_provider);
-                successCallback(model);
+    /* Load the data model for the VM with vmid.
+     * If anything fails, call errCallback(errorText).
+     * Else call successCallback(vmDataModel).
+     */
+    function loadVM(vmid, successCallback, errCallback) {
+        apiGet([vimmaApiVMDetailsDetailRoot + vmid + '/'], function(resArr) {
+            makeVMModels(resArr, function(models) {
+                successCallback(models[0]);
             }, errCallback);
-        }
+        }, errCallback);
     }
 
     /* Like loadVM but vmids is an array and successCallback gets called with
@@ -153,48 +157,26 @@
             return;
         }
 
-        var results = [],
-            // a call has failed
-            failed = false,
-            // how many calls are in flight
-            remaining = 0;
-        vmids.forEach(function(vmid, idx) {
-            results.push(null);
-            loadVM(vmid, function(result) {
-                if (failed) {
-                    return;
-                }
-                results[idx] = result;
-                remaining--;
-                if (!remaining) {
-                    successCallback(results);
-                }
-            }, function(errorText) {
-                if (failed) {
-                    return;
-                }
-                this.failed = true;
-                errCallback(errorText);
-            });
-            remaining++;
-        });
+        apiGet(vmids.map(function(vmid) {
+            return vimmaApiVMDetailsDetailRoot + vmid + '/';
+        }), function(vms) {
+            makeVMModels(vms, successCallback, errCallback);
+        }, errCallback);
     }
 
-    /* Like loadVMs but it loads all VMs.
+    /* Load the data models of all VMs, from the vmdetails list.
      * If destroyed is a Boolean, it only loads destroyed/non-destroyed VMs.
      * Else (e.g. destroyed is ‘undefined’ or ‘null’) it loads all VMs.
      */
     function loadAllVMs(destroyed, successCallback, errCallback) {
-        apiGetAll([vimmaApiVMList], function(resArr) {
+        apiGetAll([vimmaApiVMDetailsList], function(resArr) {
             var vms = resArr[0];
             if (typeof(destroyed) === "boolean") {
                 vms = vms.filter(function(vm) {
                     return (vm.destroyed_at !== null) === destroyed;
                 });
             }
-            loadVMs(vms.map(function(vm) {
-                return vm.id;
-            }), successCallback, errCallback);
+            makeVMModels(vms, successCallback, errCallback);
         }, errCallback);
     }
 
@@ -9,6 +9,13 @@ Polymer({
             observer: '_vmidChanged'
         },
 
+        // Optional: the VM data model, if the parent has already loaded it
+        // (e.g. <vm-list>). Else it's loaded from vmid.
+        vm: {
+            type: Object,
+            observer: '_vmChanged'
+        },
+
         // see <schedule-detail>.selectedViaFrag
         selectedViaFrag: {
             type: Boolean,
@@ -62,9 +69,42 @@ Polymer({
         }
     },
 
+    attached: function() {
+        this._stopVMEvents = onVMEvent((function(ev) {
+            if (ev.vm == this.vmid && ev.type == 'state') {
+                this._reload();
+            }
+        }).bind(this));
+    },
+
+    detached: function() {
+        this._stopVMEvents();
+    },
+
     _vmidChanged: function(newV, oldV) {
         this._expanded = this.properties._expanded.value;
-        this._reload();
+        // the parent may set vm right after vmid
+        this.async(function() {
+            if (this.vm && this.vm.vm.id == this.vmid) {
+                this._useVM(this.vm);
+            } else {
+                this._reload();
+            }
+        });
+    },
+
+    _vmChanged: function(newV, oldV) {
+        if (newV && newV.vm.id == this.vmid) {
+            this._useVM(newV);
+        }
+    },
+
+    _useVM: function(vm) {
+        // discard any load in progress
+        this._loadingToken = {};
+        this._vm = vm;
+        this._error = '';
+        this._loading = false;
     },
 
     _selectedViaFragChanged: function(newV, oldV) {
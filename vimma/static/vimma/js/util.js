@@ -271,3 +271,36 @@ function extend(base) {
     }
     return base;
 }
+
+/*
+ * Call callback(event) for each event from the VM event stream, until the
+ * returned function is called. ‘event’ is an object like
+ * {vm: 12, type: 'state'}, see vimma.views.vm_events.
+ * All callers share one EventSource. Does nothing if the stream is disabled.
+ */
+var onVMEvent = (function() {
+    var source = null,
+        nextId = 0,
+        callbacks = {};
+
+    return function(callback) {
+        if (!vimmaEndpointVMEvents) {
+            return function() {};
+        }
+        if (source === null) {
+            source = new EventSource(vimmaEndpointVMEvents);
+            source.addEventListener('vm', function(ev) {
+                var data = JSON.parse(ev.data);
+                Object.keys(callbacks).forEach(function(id) {
+                    callbacks[id](data);
+                });
+            });
+        }
+
+        var id = nextId++;
+        callbacks[id] = callback;
+        return function() {
+            delete callbacks[id];
+        };
+    };
+})();
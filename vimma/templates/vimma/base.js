@@ -14,6 +14,9 @@ var indexUrl = '{% url "index" %}',
     vimmaApiVMList = '{% url "vm-list" %}',
     vimmaApiVMDetailRoot = apiDetailRootUrl(
             '{% url "vm-detail" 0 %}'),
+    vimmaApiVMDetailsList = '{% url "vmdetail-list" %}',
+    vimmaApiVMDetailsDetailRoot = apiDetailRootUrl(
+            '{% url "vmdetail-detail" 0 %}'),
     vimmaApiDummyVMDetailRoot = apiDetailRootUrl(
             '{% url "dummyvm-detail" 0 %}'),
     vimmaApiAWSVMDetailRoot = apiDetailRootUrl(
@@ -52,6 +55,9 @@ var indexUrl = '{% url "index" %}',
     vimmaEndpointSetExpiration = '{% url "setExpiration" %}',
     vimmaEndpointCreateFirewallRule = '{% url "createFirewallRule" %}',
     vimmaEndpointDeleteFirewallRule = '{% url "deleteFirewallRule" %}',
+    // empty string if the event stream is disabled
+    vimmaEndpointVMEvents =
+        '{% if event_stream %}{% url "vmEvents" %}{% endif %}',
 
     vimmaUserId = {{ user.id }},
 
@@ -1,20 +1,39 @@
+import boto.exception
+from celery.signals import task_postrun
+import contextlib
 import datetime
+import django.apps
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.core.signals import got_request_exception, request_finished
 from django.core.urlresolvers import reverse
-from django.db import transaction
+from django.db import connection, transaction
 from django.db.models.deletion import ProtectedError
+from django.db.models.signals import post_save
 from django.db.utils import IntegrityError, DataError
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import utc
+import gzip
+import importlib
 import json
 import pytz
 import ipaddress
+import os
+import redis
+import tempfile
+import time
+import unittest
+from unittest import mock
 from rest_framework import status
 from rest_framework.test import APITestCase
 
-from vimma import util
+from vimma import (
+    apicache, archive, audit, celeryconfig, events, projection, ratelimit,
+    uptime, util, views, vmutil,
+)
 from vimma.actions import Actions
+from vimma.celery import app
 from vimma import expiry
 from vimma.models import (
     Permission, Role, Project, TimeZone, Schedule,
@@ -22,9 +41,51 @@ from vimma.models import (
     VMConfig, DummyVMConfig, AWSVMConfig,
     User, VM, DummyVM, AWSVM,
     Audit, PowerLog, Expiration, VMExpiration, FirewallRuleExpiration,
-    FirewallRule, AWSFirewallRule,
+    FirewallRule, AWSFirewallRule, VMUptime, ProjectUptime,
 )
 from vimma.perms import ALL_PERMS, Perms
+from vimma.schedule import get_compiled_schedule
+from vimma.vmtype import aws, dummy
+
+
+# Tests using Redis empty this database. They're skipped if it's unreachable.
+TEST_REDIS_URL = os.getenv('TEST_REDIS_URL', 'redis://localhost:6379/15')
+# Nothing listens here, to test the fallbacks for when Redis is down.
+DOWN_REDIS_URL = 'redis://localhost:1/0'
+
+
+def _redis_reachable():
+    try:
+        return redis.StrictRedis.from_url(TEST_REDIS_URL,
+                socket_connect_timeout=1).ping()
+    except redis.RedisError:
+        return False
+
+requires_redis = unittest.skipUnless(_redis_reachable(),
+        'No Redis at ' + TEST_REDIS_URL)
+
+
+@contextlib.contextmanager
+def redis_at(url):
+    """
+    Point all modules' Redis clients at url in the with-block.
+
+    Empties the database first, unless url is DOWN_REDIS_URL.
+    """
+    def reset_clients():
+        for module in (apicache, events, ratelimit, aws, vmutil):
+            module._redis = None
+    if url != DOWN_REDIS_URL:
+        redis.StrictRedis.from_url(url).flushdb()
+    reset_clients()
+    try:
+        with override_settings(**{name: url for name in (
+                'API_CACHE_REDIS_URL', 'EVENT_REDIS_URL',
+                'RATE_LIMIT_REDIS_URL', 'AWS_COALESCE_REDIS_URL',
+                'STATUS_UPDATE_REDIS_URL')}):
+            yield
+    finally:
+        reset_clients()
 
 
 # Django validation doesn't run automatically when saving objects.
@@ -117,6 +178,34 @@ class RoleTests(TestCase):
         check(hubert, 'X', True)
         check(hubert, 'Y', True)
 
+    def test_has_perm_memoized(self):
+        """
+        Permissions are read once per user object, until Roles change.
+        """
+        perm_sched = Permission.objects.create(name=Perms.EDIT_SCHEDULE)
+        perm_omni = Permission.objects.create(name=Perms.OMNIPOTENT)
+        role = Role.objects.create(name='Schedule Editors')
+        fry = util.create_vimma_user('fry', 'f@a.com', 'pass')
+
+        with self.assertNumQueries(1):
+            self.assertIs(util.has_perm(fry, Perms.EDIT_SCHEDULE), False)
+            self.assertIs(util.has_perm(fry, Perms.READ_ALL_AUDITS), False)
+            self.assertIs(util.can_do(fry, Actions.WRITE_SCHEDULES), False)
+
+        fry.roles.add(role)
+        self.assertIs(util.has_perm(fry, Perms.EDIT_SCHEDULE), False)
+        role.permissions.add(perm_sched)
+        self.assertIs(util.has_perm(fry, Perms.EDIT_SCHEDULE), True)
+        self.assertIs(util.has_perm(fry, Perms.OMNIPOTENT), False)
+
+        role.permissions.add(perm_omni)
+        self.assertIs(util.has_perm(fry, 'X'), True)
+        role.permissions.remove(perm_omni)
+        self.assertIs(util.has_perm(fry, 'X'), False)
+
+        role.user_set.remove(fry)
+        self.assertIs(util.has_perm(fry, Perms.EDIT_SCHEDULE), False)
+
 
 class ProjectTests(APITestCase):
 
@@ -338,6 +427,47 @@ class ProfileTest(APITestCase):
         items = response.data['results']
         self.assertEqual(set(i['id'] for i in items), {u_a.id})
 
+    def test_api_conditional_get(self):
+        """
+        The ETag changes when projects or memberships change.
+        """
+        u_a = util.create_vimma_user('a', 'a@example.com', 'p')
+        util.create_vimma_user('b', 'b@example.com', 'p')
+        p1 = Project.objects.create(name='p1', email='p1@a.com')
+        u_a.projects.add(p1)
+
+        def get_list(etag=None):
+            headers = {}
+            if etag:
+                headers['HTTP_IF_NONE_MATCH'] = etag
+            return self.client.get(reverse('project-list'), **headers)
+
+        self.assertTrue(self.client.login(username='a', password='p'))
+        response = get_list()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = get_list(etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertFalse([q for q in ctx.captured_queries
+            if 'vimma_project' in q['sql'] and
+            'vimma_modelversion' not in q['sql']])
+
+        # other users get their own ETag
+        self.assertTrue(self.client.login(username='b', password='p'))
+        self.assertEqual(get_list(etag).status_code, status.HTTP_200_OK)
+
+        self.assertTrue(self.client.login(username='a', password='p'))
+        for change in (lambda: u_a.projects.remove(p1),
+                lambda: Project.objects.create(name='p2', email='p2@a.com')):
+            change()
+            response = get_list(etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(response['ETag'], etag)
+            etag = response['ETag']
+
 
 class ScheduleTests(APITestCase):
 
@@ -534,6 +664,45 @@ class ScheduleTests(APITestCase):
                 tstamp = aware.timestamp()
                 self.assertIs(util.schedule_at_tstamp(s, tstamp), False)
 
+    def test_compiled_schedule(self):
+        """
+        Check CompiledSchedule.next_transition_after and its cache.
+        """
+        tz_name = 'Europe/Helsinki'
+        tz = pytz.timezone(tz_name)
+        tz_obj = TimeZone.objects.create(name=tz_name)
+        matrix = 5*[8*2*[False] + 8*2*[True] + 8*2*[False]]+ 2*[48*[False]]
+        s = Schedule.objects.create(name='Weekdays 8am→4pm',
+                timezone=tz_obj, matrix=json.dumps(matrix))
+        s.full_clean()
+
+        c = get_compiled_schedule(s)
+        self.assertIs(get_compiled_schedule(s), c)
+
+        def check(start, expected):
+            tstamp = tz.localize(start).timestamp()
+            self.assertEqual(c.next_transition_after(tstamp),
+                    tz.localize(expected).timestamp())
+
+        check(datetime.datetime(2015, 3, 9, 7, 10),
+                datetime.datetime(2015, 3, 9, 8))
+        check(datetime.datetime(2015, 3, 9, 8),
+                datetime.datetime(2015, 3, 9, 16))
+        check(datetime.datetime(2015, 3, 13, 17, 59, 30),
+                datetime.datetime(2015, 3, 16, 8))
+        # across the DST change on Sunday 29 March 2015
+        check(datetime.datetime(2015, 3, 27, 16),
+                datetime.datetime(2015, 3, 30, 8))
+        check(datetime.datetime(2015, 10, 23, 20),
+                datetime.datetime(2015, 10, 26, 8))
+
+        # saving the schedule discards the cached object
+        s.matrix = json.dumps(7 * [48 * [True]])
+        s.save()
+        c = get_compiled_schedule(s)
+        self.assertIs(c.is_on(0), True)
+        self.assertIs(c.next_transition_after(0), None)
+
 
 class TimeZoneTests(APITestCase):
 
@@ -695,6 +864,50 @@ class WebViewsPermissionTests(TestCase):
         for viewname in ('test',):
             check_public(viewname)
 
+    def test_vm_events_disabled(self):
+        """
+        The VM event stream needs login and settings.EVENT_STREAM.
+        """
+        util.create_vimma_user('a', 'a@example.com', 'pass')
+        url = reverse('vmEvents')
+        self.assertEqual(self.client.get(url).status_code,
+                status.HTTP_403_FORBIDDEN)
+        self.assertTrue(self.client.login(username='a', password='pass'))
+        with self.settings(EVENT_STREAM=False):
+            self.assertEqual(self.client.get(url).status_code,
+                    status.HTTP_404_NOT_FOUND)
+
+    @requires_redis
+    def test_vm_event_stream(self):
+        """
+        Published VM events reach the event streams of the VM's project.
+        """
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_DUMMY)
+        prj = Project.objects.create(name='Prj', email='a@b.com')
+        prj2 = Project.objects.create(name='Prj2', email='a@b.com')
+        vm = VM.objects.create(provider=prv, project=prj, schedule=s)
+
+        with redis_at(TEST_REDIS_URL), self.settings(EVENT_STREAM=True,
+                EVENT_STREAM_MAX_SECS=1):
+            stream = events.event_stream({prj.id})
+            other = events.event_stream({prj2.id})
+            self.assertEqual(next(stream), 'retry: 3000\n\n')
+            self.assertEqual(next(other), 'retry: 3000\n\n')
+
+            events.publish_vm_event(vm.id, 'state', state='running')
+            start = time.monotonic()
+            event, data = next(stream).split('\n')[:2]
+            # the stream waits for the message, it doesn't poll
+            self.assertLess(time.monotonic() - start, .2)
+            self.assertEqual(event, 'event: vm')
+            self.assertEqual(json.loads(data[len('data: '):]),
+                    {'vm': vm.id, 'type': 'state', 'state': 'running'})
+            # other projects' streams end without it
+            self.assertEqual(list(other), [])
+
 
 class ProviderTests(APITestCase):
 
@@ -938,6 +1151,101 @@ class AWSProviderTests(APITestCase):
                 status.HTTP_405_METHOD_NOT_ALLOWED)
 
 
+    def test_connection_cache(self):
+        """
+        Boto connections are reused per provider, region and service, and
+        replaced after being idle or when the credentials change.
+        """
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_AWS)
+        aws_prov = AWSProvider.objects.create(provider=prv, vpc_id='dummy',
+                access_key_id='id', access_key_secret='secret')
+        clock = [1000.0]
+        modules = {service: mock.Mock() for service in aws._SERVICE_MODULES}
+        for m in modules.values():
+            m.connect_to_region.side_effect = lambda *a, **kw: mock.Mock()
+
+        def get(service='ec2', region='r', secret='secret'):
+            return aws.get_connection(service, aws_prov.id, region, 'id',
+                    secret)
+
+        aws._conn_cache.conns = {}
+        try:
+            with mock.patch.dict(aws._SERVICE_MODULES, modules), \
+                    mock.patch.object(aws.time, 'monotonic',
+                            lambda: clock[0]):
+                conn = get()
+                modules['ec2'].connect_to_region.assert_called_once_with(
+                        'r', aws_access_key_id='id',
+                        aws_secret_access_key='secret')
+                self.assertIs(get(), conn)
+                others = {get('vpc'), get(region='r2'),
+                        aws.get_connection('ec2', aws_prov.id + 1, 'r',
+                            'id', 'secret')}
+                self.assertEqual(len(others | {conn}), 4)
+
+                # used just within the idle time, so kept
+                clock[0] += settings.AWS_CONNECTION_IDLE_SECS
+                self.assertIs(get(), conn)
+                clock[0] += settings.AWS_CONNECTION_IDLE_SECS + 1
+                idle, conn = conn, get()
+                self.assertIsNot(conn, idle)
+                idle.close.assert_called_once_with()
+
+                old, conn = conn, get(secret='new secret')
+                self.assertIsNot(conn, old)
+                old.close.assert_called_once_with()
+
+                # saving the AWSProvider discards its connections
+                aws_prov.save()
+                conn.close.assert_called_once_with()
+                self.assertIsNot(get(secret='new secret'), conn)
+        finally:
+            aws._conn_cache.conns = {}
+
+    @override_settings(AWS_CREDENTIALS_CACHE_SECS=600)
+    def test_credentials_cache(self):
+        """
+        Connecting reads an AWS VM's provider and region and the provider's
+        credentials from the DB only once, until the AWSProvider is saved or
+        the cache time passes.
+        """
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_AWS)
+        aws_prov = AWSProvider.objects.create(provider=prv, vpc_id='dummy',
+                access_key_id='id', access_key_secret='secret')
+        prj = Project.objects.create(name='Prj', email='p@a.com')
+        vm = VM.objects.create(provider=prv, project=prj, schedule=s)
+        aws_vm = AWSVM.objects.create(vm=vm, name='a', region='r')
+        clock = [1000.0]
+
+        with mock.patch.object(aws, 'get_connection') as get_connection, \
+                mock.patch.object(aws.time, 'monotonic', lambda: clock[0]):
+            # 2 SELECTs, each in a savepoint
+            with self.assertNumQueries(6):
+                aws.ec2_connect_to_aws_vm_region(aws_vm.id)
+            with self.assertNumQueries(0):
+                aws.ec2_connect_to_aws_vm_region(aws_vm.id)
+                aws.route53_connect_to_aws_provider(aws_prov.id)
+            get_connection.assert_called_with('route53', aws_prov.id,
+                    'universal', 'id', 'secret')
+
+            aws_prov.access_key_secret = 'new secret'
+            aws_prov.save()
+            aws.ec2_connect_to_aws_vm_region(aws_vm.id)
+            get_connection.assert_called_with('ec2', aws_prov.id, 'r', 'id',
+                    'new secret')
+
+            # e.g. saved by another process
+            AWSProvider.objects.filter(id=aws_prov.id).update(
+                    access_key_id='new id')
+            clock[0] += 601
+            aws.ec2_connect_to_aws_vm_region(aws_vm.id)
+            get_connection.assert_called_with('ec2', aws_prov.id, 'r',
+                    'new id', 'new secret')
+
+
 class VMConfigTests(APITestCase):
 
     def test_required_fields(self):
@@ -1467,6 +1775,258 @@ class VMTests(APITestCase):
         self.assertEqual(response.status_code,
                 status.HTTP_405_METHOD_NOT_ALLOWED)
 
+    def test_api_cache_project_ids(self):
+        """
+        Find the projects whose cached API responses an object change affects.
+        """
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_AWS)
+        prj = Project.objects.create(name='Prj', email='p@a.com')
+        vm = VM.objects.create(provider=prv, project=prj, schedule=s)
+        awsvm = AWSVM.objects.create(vm=vm, name='a', region='a')
+        fw = FirewallRule.objects.create(vm=vm)
+        awsfw = AWSFirewallRule.objects.create(firewallrule=fw,
+                ip_protocol=AWSFirewallRule.PROTO_TCP,
+                from_port=80, to_port=80, cidr_ip='1.2.3.4/32')
+        exp = Expiration.objects.create(type=Expiration.TYPE_FIREWALL_RULE,
+                expires_at=datetime.datetime.now(tz=utc))
+        fw_exp = FirewallRuleExpiration.objects.create(expiration=exp,
+                firewallrule=fw)
+
+        for obj in (vm, awsvm, fw, awsfw, exp, fw_exp):
+            self.assertEqual(apicache.get_changed_project_ids(obj), {prj.id})
+        fw.delete()
+        self.assertIsNone(apicache.get_changed_project_ids(awsfw))
+
+    @requires_redis
+    def test_api_cache_invalidation(self):
+        """
+        Writes by QuerySet.update() invalidate the cached API responses too.
+        """
+        u = util.create_vimma_user('a', 'a@example.com', 'p')
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_AWS)
+        prj = Project.objects.create(name='Prj', email='p@a.com')
+        u.projects.add(prj)
+        now = datetime.datetime.now(tz=utc)
+        vm = VM.objects.create(provider=prv, project=prj, schedule=s,
+                next_transition_at=now)
+        self.assertTrue(self.client.login(username='a', password='p'))
+
+        def get():
+            response = self.client.get(reverse('vm-detail', args=[vm.id]))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return json.loads(response.content.decode('utf-8'))
+
+        with redis_at(TEST_REDIS_URL), self.settings(API_RESPONSE_CACHE=True):
+            self.assertIsNotNone(get()['next_transition_at'])
+            # a change without signals or invalidation isn't seen
+            VM.objects.filter(id=vm.id).update(comment='changed')
+            self.assertEqual(get()['comment'], '')
+
+            with mock.patch.object(vmutil.update_vm_status,
+                    'apply_async') as apply_async:
+                vmutil.dispatch_power_transitions()
+            apply_async.assert_called_once_with(args=(vm.id,), eta=mock.ANY)
+            item = get()
+            self.assertGreater(item['next_transition_at'],
+                    now.isoformat())
+            self.assertEqual(item['comment'], 'changed')
+
+            # saving the schedule marks its VMs for a re-check
+            s.save()
+            self.assertIsNotNone(get()['next_transition_at'])
+
+    @override_settings(POWER_TRANSITION_LOOKAHEAD_SECS=120,
+            POWER_TRANSITION_RETRY_SECS=300)
+    def test_power_transition_retry(self):
+        """
+        A dispatched power transition is dispatched again unless its status
+        update sets the VM's next transition.
+        """
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_AWS)
+        prj = Project.objects.create(name='Prj', email='p@a.com')
+        now = datetime.datetime.now(tz=utc)
+        vm = VM.objects.create(provider=prv, project=prj, schedule=s,
+                next_transition_at=now)
+
+        with mock.patch.object(vmutil.update_vm_status,
+                'apply_async') as apply_async:
+            vmutil.dispatch_power_transitions()
+            vmutil.dispatch_power_transitions()
+        apply_async.assert_called_once_with(args=(vm.id,), eta=mock.ANY)
+        retry_at = VM.objects.get(id=vm.id).next_transition_at
+        self.assertTrue(now + datetime.timedelta(seconds=420) <= retry_at <=
+                datetime.datetime.now(tz=utc) +
+                datetime.timedelta(seconds=420))
+
+        # the retry is due once the update has had time to run and fail
+        VM.objects.filter(id=vm.id).update(next_transition_at=now)
+        with mock.patch.object(vmutil.update_vm_status,
+                'apply_async') as apply_async:
+            vmutil.dispatch_power_transitions()
+        self.assertEqual(apply_async.call_count, 1)
+
+    @requires_redis
+    @override_settings(STATUS_UPDATE_GUARD_SECS=100)
+    def test_status_update_coalescing(self):
+        """
+        At most one status update per VM is queued or running, plus one
+        trailing update for requests made while it runs.
+        """
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov',
+                type=Provider.TYPE_DUMMY)
+        prj = Project.objects.create(name='Prj', email='p@a.com')
+        vm = VM.objects.create(provider=prv, project=prj, schedule=s)
+        DummyVM.objects.create(vm=vm, name='x', poweredon=True)
+        exp = Expiration.objects.create(type=Expiration.TYPE_VM,
+                expires_at=datetime.datetime.now(tz=utc) +
+                datetime.timedelta(days=1))
+        VMExpiration.objects.create(expiration=exp, vm=vm)
+        key = 'vimma:status-update:{}'.format(vm.id)
+        r = redis.StrictRedis.from_url(TEST_REDIS_URL)
+
+        with redis_at(TEST_REDIS_URL), \
+                mock.patch.object(vmutil.update_vm_status,
+                    'apply_async') as queue, \
+                mock.patch.object(dummy.update_vm_status,
+                    'apply_async') as dummy_queue:
+            for i in range(3):
+                vmutil.request_status_update(vm.id)
+            queue.assert_called_once_with(args=(vm.id,),
+                    kwargs={'coalesced': True, 'priority': None},
+                    priority=None)
+            self.assertEqual(r.get(key), b'queued')
+            self.assertEqual(r.ttl(key), 100)
+
+            # the task marks the guard running and passes coalesced on
+            vmutil.update_vm_status(vm.id, coalesced=True)
+            dummy_queue.assert_called_once_with(args=(vm.id,),
+                    kwargs={'coalesced': True}, priority=None)
+            self.assertEqual(r.get(key), b'running')
+
+            # requests meanwhile collapse into one trailing update
+            for i in range(3):
+                vmutil.request_status_update(vm.id)
+            self.assertEqual(r.get(key), b'rerun')
+            self.assertEqual(queue.call_count, 1)
+            dummy.update_vm_status(vm.id, coalesced=True)
+            self.assertEqual(queue.call_count, 2)
+            self.assertEqual(queue.call_args,
+                    mock.call((vm.id,), {'coalesced': True}))
+            self.assertEqual(r.get(key), b'queued')
+
+            # the AWS task releases the guard even if it fails
+            r.set(key, 'running')
+            with mock.patch.object(aws, '_update_vm_status_impl',
+                    side_effect=ValueError), \
+                    self.assertRaises(ValueError):
+                aws.update_vm_status(vm.id, coalesced=True)
+            self.assertFalse(r.exists(key))
+            # uncoalesced (timed) runs leave the guard alone
+            r.set(key, 'queued')
+            dummy.update_vm_status(vm.id)
+            self.assertEqual(r.get(key), b'queued')
+            self.assertEqual(queue.call_count, 2)
+
+            # a lost update's guard expires
+            r.pexpire(key, 1)
+            time.sleep(.01)
+            vmutil.request_status_update(vm.id)
+            self.assertEqual(queue.call_count, 3)
+
+        with redis_at(DOWN_REDIS_URL), \
+                mock.patch.object(vmutil.update_vm_status,
+                    'apply_async') as queue:
+            for i in range(2):
+                vmutil.request_status_update(vm.id)
+            self.assertEqual(queue.call_args_list, 2 * [mock.call(
+                args=(vm.id,), kwargs={'priority': None}, priority=None)])
+            vmutil.status_update_finished(vm.id)
+
+    def test_api_details(self):
+        """
+        The vmdetails API nests related objects in a fixed number of queries.
+        """
+        u = util.create_vimma_user('a', 'a@example.com', 'p')
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_AWS)
+        p1 = Project.objects.create(name='Prj 1', email='p1@a.com')
+        p2 = Project.objects.create(name='Prj 2', email='p2@a.com')
+        u.projects.add(p1)
+        now = datetime.datetime.now(tz=utc)
+
+        def make_vm(project):
+            vm = VM.objects.create(provider=prv, project=project, schedule=s)
+            AWSVM.objects.create(vm=vm, name=str(vm.id), region='a')
+            exp = Expiration.objects.create(type=Expiration.TYPE_VM,
+                    expires_at=now)
+            VMExpiration.objects.create(expiration=exp, vm=vm)
+            for i in range(2):
+                fw = FirewallRule.objects.create(vm=vm)
+                AWSFirewallRule.objects.create(firewallrule=fw,
+                        ip_protocol=AWSFirewallRule.PROTO_TCP,
+                        from_port=80, to_port=80, cidr_ip='1.2.3.4/32')
+                exp = Expiration.objects.create(
+                        type=Expiration.TYPE_FIREWALL_RULE, expires_at=now)
+                FirewallRuleExpiration.objects.create(expiration=exp,
+                        firewallrule=fw)
+            PowerLog.objects.create(vm=vm, powered_on=False)
+            PowerLog.objects.create(vm=vm, powered_on=True)
+            return vm
+
+        vm1 = make_vm(p1)
+        make_vm(p2)
+        vm3 = VM.objects.create(provider=prv, project=p1, schedule=s)
+
+        self.assertTrue(self.client.login(username='a', password='p'))
+
+        def count_list_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(reverse('vmdetail-list'))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return len(ctx.captured_queries), response.data['results']
+
+        n_queries, items = count_list_queries()
+        self.assertEqual({x['id'] for x in items}, {vm1.id, vm3.id})
+        item = [x for x in items if x['id'] == vm1.id][0]
+        self.assertEqual(item['awsvm']['name'], str(vm1.id))
+        self.assertIsNone(item['dummyvm'])
+        self.assertEqual(item['expiration']['id'],
+                vm1.vmexpiration.expiration.id)
+        self.assertEqual(len(item['firewallrules']), 2)
+        for fw in item['firewallrules']:
+            self.assertEqual(fw['awsfirewallrule']['cidr_ip'], '1.2.3.4/32')
+            self.assertEqual(fw['expiration']['id'],
+                    FirewallRule.objects.get(id=fw['id'])
+                    .firewallruleexpiration.expiration.id)
+        self.assertTrue(item['latest_powerlog']['powered_on'])
+
+        item = [x for x in items if x['id'] == vm3.id][0]
+        for k in ('awsvm', 'expiration', 'latest_powerlog'):
+            self.assertIsNone(item[k])
+        self.assertEqual(item['firewallrules'], [])
+
+        for i in range(3):
+            make_vm(p1)
+        self.assertEqual(count_list_queries()[0], n_queries)
+
+        response = self.client.get(reverse('vmdetail-detail', args=[vm1.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['latest_powerlog']['powered_on'])
+
 
 class DummyVMTests(APITestCase):
 
@@ -1838,6 +2398,368 @@ class AWSVMTests(APITestCase):
                 status.HTTP_405_METHOD_NOT_ALLOWED)
 
 
+    def test_batch_status_sweep(self):
+        """
+        The batched status sweep saves each AWS VM's state from one
+        DescribeInstances call, including missing and terminated instances.
+        """
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_AWS)
+        aws_prov = AWSProvider.objects.create(provider=prv, vpc_id='dummy')
+        prj = Project.objects.create(name='Prj', email='p@a.com')
+        later = datetime.datetime.now(tz=utc) + datetime.timedelta(days=1)
+
+        vm_ids = {}
+        for name in ('running', 'terminated', 'missing', 'uncreated',
+                'stopped'):
+            vm = VM.objects.create(provider=prv, project=prj, schedule=s)
+            AWSVM.objects.create(vm=vm, name=name, region='r',
+                    instance_id='' if name == 'uncreated' else 'i-' + name,
+                    ip_address='1.1.1.1')
+            exp = Expiration.objects.create(type=Expiration.TYPE_VM,
+                    expires_at=later)
+            VMExpiration.objects.create(expiration=exp, vm=vm)
+            vm_ids[name] = vm.id
+
+        with mock.patch.object(aws, 'ec2_connect_to_aws_provider_region'
+                ) as connect, \
+                mock.patch.object(aws, 'invalidate_projects') as invalidate, \
+                mock.patch.object(aws.power_on_vms, 'apply_async') as power_on, \
+                CaptureQueriesContext(connection) as queries:
+            describe = connect.return_value.get_only_instances
+            describe.return_value = [
+                mock.Mock(id='i-running', state='running',
+                    ip_address='1.2.3.4', private_ip_address='10.0.0.1',
+                    instance_type='t2.small'),
+                mock.Mock(id='i-terminated', state='terminated',
+                    ip_address=None, private_ip_address=None,
+                    instance_type='t2.micro'),
+                mock.Mock(id='i-stopped', state='stopped',
+                    ip_address=None, private_ip_address='10.0.0.2',
+                    instance_type=None),
+            ]
+            aws.update_region_vms_status(aws_prov.id, 'r')
+
+        connect.assert_called_once_with(aws_prov.id, 'r')
+        describe.assert_called_once_with(instance_ids=mock.ANY)
+        self.assertEqual(set(describe.call_args[1]['instance_ids']),
+                {'i-running', 'i-terminated', 'i-missing', 'i-stopped'})
+
+        # bulk writes: one UPDATE for all AWSVMs and one API cache
+        # invalidation per batch
+        self.assertEqual(len([q for q in queries.captured_queries
+            if 'UPDATE "vimma_awsvm"' in q['sql']]), 1)
+        invalidate.assert_called_once_with({prj.id})
+        # the schedule says ON
+        power_on.assert_called_once_with((aws_prov.id, 'r',
+            [vm_ids['stopped']]), {'user_id': None})
+
+        def check(name, state, ip_address, private_ip_address, powerlogs):
+            vm = VM.objects.get(id=vm_ids[name])
+            self.assertEqual((vm.awsvm.state, vm.awsvm.ip_address,
+                vm.awsvm.private_ip_address),
+                (state, ip_address, private_ip_address))
+            self.assertEqual(list(PowerLog.objects.filter(vm=vm)
+                .values_list('powered_on', flat=True)), powerlogs)
+            if name != 'uncreated':
+                self.assertIsNotNone(vm.status_updated_at)
+            if name in ('running', 'stopped'):
+                self.assertEqual(vm.next_transition_at,
+                        later + datetime.timedelta(seconds=1))
+        check('running', 'running', '1.2.3.4', '10.0.0.1', [True])
+        check('terminated', 'terminated', '', '', [False])
+        check('missing', 'Error', '', '', [])
+        check('uncreated', '', '1.1.1.1', '', [])
+        check('stopped', 'stopped', '', '10.0.0.2', [False])
+        # the sweep fills in the instance type, e.g. of VMs created before
+        # it was saved
+        self.assertEqual(dict(AWSVM.objects.values_list('name',
+            'instance_type')), {'running': 't2.small',
+                'terminated': 't2.micro', 'missing': '', 'uncreated': '',
+                'stopped': ''})
+        self.assertIsNone(VM.objects.get(
+            id=vm_ids['uncreated']).status_updated_at)
+
+    def test_batch_destroy(self):
+        """
+        destroy_vms terminates instances in one call. VMs whose instance
+        isn't in the result get the terminate_instance task.
+        """
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_AWS)
+        aws_prov = AWSProvider.objects.create(provider=prv, vpc_id='dummy')
+        prj = Project.objects.create(name='Prj', email='p@a.com')
+
+        vm_ids = {}
+        for name in ('returned', 'unreturned', 'uncreated', 'elsewhere'):
+            vm = VM.objects.create(provider=prv, project=prj, schedule=s)
+            AWSVM.objects.create(vm=vm, name=name,
+                    region='r2' if name == 'elsewhere' else 'r',
+                    instance_id='' if name == 'uncreated' else 'i-' + name)
+            vm_ids[name] = vm.id
+
+        with mock.patch.object(aws, 'ec2_connect_to_aws_provider_region'
+                ) as connect, \
+                mock.patch.object(aws.terminate_instance,
+                    'apply_async') as terminate, \
+                mock.patch.object(aws.delete_security_group, 'apply_async'), \
+                mock.patch.object(aws.route53_delete, 'apply_async'):
+            call = connect.return_value.terminate_instances
+            call.return_value = [mock.Mock(id='i-returned')]
+            aws.destroy_vms(aws_prov.id, 'r', list(vm_ids.values()))
+
+        self.assertEqual(set(call.call_args[1]['instance_ids']),
+                {'i-returned', 'i-unreturned'})
+        self.assertEqual({c[0][0][0] for c in terminate.call_args_list},
+                {vm_ids[n] for n in ('unreturned', 'uncreated', 'elsewhere')})
+        self.assertEqual(terminate.call_count, 3)
+        self.assertEqual(dict(AWSVM.objects.values_list('name',
+            'instance_terminated')), {'returned': True, 'unreturned': False,
+                'uncreated': False, 'elsewhere': False})
+
+        # any failure of a batch falls back to the per-VM task, which retries
+        with mock.patch.object(aws, 'ec2_connect_to_aws_provider_region'
+                ) as connect, \
+                mock.patch.object(aws.terminate_instance,
+                    'apply_async') as terminate, \
+                mock.patch.object(aws.delete_security_group, 'apply_async'), \
+                mock.patch.object(aws.route53_delete, 'apply_async'):
+            connect.return_value.terminate_instances.side_effect = OSError
+            aws.destroy_vms(aws_prov.id, 'r', [vm_ids['unreturned']])
+        terminate.assert_called_once_with((vm_ids['unreturned'],),
+                {'user_id': None})
+
+    @requires_redis
+    @override_settings(AWS_POWER_COALESCE_SECS=5)
+    def test_power_request_coalescing(self):
+        """
+        Power requests within the coalescing window make one API call.
+        Without Redis each VM gets the single-VM task.
+        """
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_AWS)
+        aws_prov = AWSProvider.objects.create(provider=prv, vpc_id='dummy')
+        prj = Project.objects.create(name='Prj', email='p@a.com')
+        vm_ids = []
+        for i in range(3):
+            vm = VM.objects.create(provider=prv, project=prj, schedule=s)
+            AWSVM.objects.create(vm=vm, name=str(i), region='r',
+                    instance_id='i-{}'.format(i))
+            vm_ids.append(vm.id)
+        flush_args = (aws_prov.id, 'r', 'power_off')
+        flush_key = 'vimma:aws:buffer:power:{}:r:power_off:flush'.format(
+                aws_prov.id)
+
+        with redis_at(TEST_REDIS_URL), \
+                mock.patch.object(aws.flush_power_requests,
+                    'apply_async') as flush, \
+                mock.patch.object(aws.power_off_vm, 'apply_async') as single:
+            for vm_id in vm_ids:
+                aws.request_power_action(vm_id, 'power_off', user_id=None)
+            # only the first request schedules a flush
+            flush.assert_called_once_with(args=flush_args, countdown=5)
+            r = redis.StrictRedis.from_url(TEST_REDIS_URL)
+            self.assertTrue(0 < r.ttl(flush_key) <= 60)
+
+            # the flush queues one batch task, kept by the broker
+            with mock.patch.object(aws.power_off_vms,
+                    'apply_async') as batch:
+                aws.flush_power_requests(*flush_args)
+            batch.assert_called_once_with((aws_prov.id, 'r', vm_ids),
+                    {'user_id': None})
+            with mock.patch.object(aws,
+                    'ec2_connect_to_aws_provider_region') as connect:
+                stop = connect.return_value.stop_instances
+                stop.return_value = [mock.Mock(id='i-{}'.format(i))
+                        for i in range(3)]
+                aws.power_off_vms(*batch.call_args[0][0],
+                        **batch.call_args[0][1])
+            stop.assert_called_once_with(instance_ids=mock.ANY)
+            self.assertEqual(sorted(stop.call_args[1]['instance_ids']),
+                    ['i-0', 'i-1', 'i-2'])
+            self.assertFalse(r.exists(flush_key))
+
+            # the buffer is empty, the next request schedules a new flush
+            aws.request_power_action(vm_ids[0], 'power_off', user_id=None)
+            self.assertEqual(flush.call_count, 2)
+            self.assertFalse(single.called)
+
+        with redis_at(DOWN_REDIS_URL), \
+                mock.patch.object(aws.flush_power_requests,
+                    'apply_async') as flush, \
+                mock.patch.object(aws.power_off_vm, 'apply_async') as single:
+            aws.request_power_action(vm_ids[0], 'power_off', user_id=None)
+            self.assertFalse(flush.called)
+            single.assert_called_once_with((vm_ids[0],), {'user_id': None})
+
+    def test_rate_limit_retry(self):
+        """
+        Tasks retry API calls over the maximum rate limit wait.
+        """
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_AWS)
+        AWSProvider.objects.create(provider=prv, vpc_id='dummy')
+        prj = Project.objects.create(name='Prj', email='p@a.com')
+        vm = VM.objects.create(provider=prv, project=prj, schedule=s)
+        AWSVM.objects.create(vm=vm, name='x', region='r', instance_id='i-x')
+
+        def stop_instances(**kwargs):
+            self.assertTrue(ratelimit._local.depth)
+            if stop.call_count == 1:
+                raise ratelimit.RateLimitExceeded()
+        with mock.patch.object(aws, 'ec2_connect_to_aws_vm_region'
+                ) as connect:
+            stop = connect.return_value.stop_instances
+            stop.side_effect = stop_instances
+            # eager tasks retry at once
+            aws.power_off_vm.apply(args=(vm.id,))
+        self.assertEqual(stop.call_count, 2)
+
+    def test_route53_upsert_batches(self):
+        """
+        Route53 change batches are split at the record count and the total
+        value length limits.
+        """
+        def split(records):
+            return [[r[0] for r in b]
+                    for b in aws._route53_upsert_batches(records)]
+        self.assertEqual(split([]), [])
+        with mock.patch.object(aws, 'ROUTE53_MAX_UPSERTS_PER_BATCH', 2), \
+                mock.patch.object(aws, 'ROUTE53_MAX_BATCH_VALUE_CHARS', 10):
+            self.assertEqual(split([(i, 'x') for i in range(5)]),
+                    [[0, 1], [2, 3], [4]])
+            self.assertEqual(split([(0, 'x'*6), (1, 'x'*4), (2, 'x'),
+                (3, 'x'*20), (4, 'x')]), [[0, 1], [2], [3], [4]])
+
+    @override_settings(AWS_ROUTE53_ZONE_CACHE_SECS=600)
+    def test_route53_zone_cache(self):
+        """
+        Route53 zone ids are listed once per provider until they expire.
+        """
+        conn = mock.Mock()
+        conn.get_zones.return_value = [
+            mock.Mock(id='pub', config={'PrivateZone': 'false'}),
+            mock.Mock(id='priv', config={'PrivateZone': 'true'}),
+            mock.Mock(id='other', config={'PrivateZone': 'false'}),
+        ]
+        for z, name in zip(conn.get_zones.return_value, ('a.', 'a.', 'b.')):
+            z.name = name
+
+        with mock.patch.dict(aws._route53_zone_ids, clear=True), \
+                mock.patch.object(aws.time, 'monotonic') as monotonic:
+            monotonic.return_value = 1000
+            self.assertEqual(aws.get_route53_zone_ids(conn, 1, 'a.'),
+                    ('pub', 'priv'))
+            monotonic.return_value = 1599
+            self.assertEqual(aws.get_route53_zone_ids(conn, 1, 'a.'),
+                    ('pub', 'priv'))
+            self.assertEqual(conn.get_zones.call_count, 1)
+
+            monotonic.return_value = 1601
+            self.assertEqual(aws.get_route53_zone_ids(conn, 1, 'a.'),
+                    ('pub', 'priv'))
+            self.assertEqual(conn.get_zones.call_count, 2)
+
+            # other providers and zone names aren't cached
+            self.assertEqual(aws.get_route53_zone_ids(conn, 2, 'a.'),
+                    ('pub', 'priv'))
+            self.assertEqual(aws.get_route53_zone_ids(conn, 1, 'b.'),
+                    ('other', None))
+            self.assertEqual(conn.get_zones.call_count, 4)
+
+    @requires_redis
+    @override_settings(AWS_ROUTE53_COALESCE_SECS=15)
+    def test_route53_coalescing(self):
+        """
+        Route53 requests are written in batches. The VMs of a failed batch
+        get the route53_add task, so do all VMs without Redis.
+        """
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_AWS)
+        aws_prov = AWSProvider.objects.create(provider=prv, vpc_id='dummy',
+                route_53_zone='example.com.')
+        prj = Project.objects.create(name='Prj', email='p@a.com')
+        vm_ids = []
+        for i in range(3):
+            vm = VM.objects.create(provider=prv, project=prj, schedule=s)
+            AWSVM.objects.create(vm=vm, name='vm{}'.format(i), region='r',
+                    instance_id='i-{}'.format(i))
+            vm_ids.append(vm.id)
+
+        with redis_at(TEST_REDIS_URL), \
+                mock.patch.object(aws.flush_route53_adds,
+                    'apply_async') as flush, \
+                mock.patch.object(aws.route53_add, 'apply_async') as single:
+            for vm_id in vm_ids:
+                aws.request_route53_add(vm_id, user_id=None)
+            flush.assert_called_once_with(args=(aws_prov.id,), countdown=15)
+
+            zones = [mock.Mock(id='pub', config={'PrivateZone': 'false'}),
+                    mock.Mock(id='priv', config={'PrivateZone': 'true'})]
+            for z in zones:
+                z.name = 'example.com.'
+            instances = [mock.Mock(id='i-{}'.format(i),
+                public_dns_name='ec2-{}.aws.com'.format(i),
+                private_ip_address='10.0.0.{}'.format(i)) for i in range(3)]
+            def upsert(conn, zone_id, records):
+                if zone_id == 'pub' and records[0][0] == 'vm0.example.com.':
+                    raise boto.exception.BotoServerError(400, 'Bad Request')
+            with mock.patch.dict(aws._route53_zone_ids, clear=True), \
+                    mock.patch.object(aws,
+                        'ROUTE53_MAX_UPSERTS_PER_BATCH', 2), \
+                    mock.patch.object(aws,
+                        'ec2_connect_to_aws_provider_region') as ec2, \
+                    mock.patch.object(aws,
+                        'route53_connect_to_aws_provider') as r53, \
+                    mock.patch.object(aws, '_route53_upsert',
+                        side_effect=upsert) as upsert_mock:
+                ec2.return_value.get_only_instances.return_value = instances
+                r53.return_value.get_zones.return_value = zones
+                aws.flush_route53_adds(aws_prov.id)
+                # a failed batch may mean the cached zone ids are stale
+                self.assertNotIn(aws_prov.id, aws._route53_zone_ids)
+
+            self.assertEqual([(c[0][1], c[0][2])
+                for c in upsert_mock.call_args_list], [
+                    ('pub', [('vm0.example.com.', 'CNAME', 'ec2-0.aws.com'),
+                        ('vm1.example.com.', 'CNAME', 'ec2-1.aws.com')]),
+                    ('pub', [('vm2.example.com.', 'CNAME', 'ec2-2.aws.com')]),
+                    ('priv', [('vm2.example.com.', 'A', '10.0.0.2')]),
+                ])
+            self.assertEqual(sorted(c[0][0][0]
+                for c in single.call_args_list), vm_ids[:2])
+
+            # if the flush fails, the drained requests aren't lost
+            single.reset_mock()
+            for vm_id in vm_ids:
+                aws.request_route53_add(vm_id, user_id=None)
+            with mock.patch.object(aws,
+                    'ec2_connect_to_aws_provider_region') as ec2:
+                ec2.return_value.get_only_instances.side_effect = OSError
+                with self.assertRaises(OSError):
+                    aws.flush_route53_adds(aws_prov.id)
+            self.assertEqual(sorted(c[0][0][0]
+                for c in single.call_args_list), vm_ids)
+
+        with redis_at(DOWN_REDIS_URL), \
+                mock.patch.object(aws.flush_route53_adds,
+                    'apply_async') as flush, \
+                mock.patch.object(aws.route53_add, 'apply_async') as single:
+            aws.request_route53_add(vm_ids[0], user_id=None)
+            self.assertFalse(flush.called)
+            single.assert_called_once_with((vm_ids[0],), {'user_id': None})
+
+
 class CreatePowerOnOffRebootDestroyVMTests(TestCase):
     """
     Test the above operations on a VM, as the permissions are related.
@@ -2081,6 +3003,88 @@ class CreatePowerOnOffRebootDestroyVMTests(TestCase):
             self.assertEqual(response.status_code, status.HTTP_200_OK)
 
 
+    def test_bulk_vm_action(self):
+        """
+        Test the bulkVMAction endpoint's per-VM permissions and results.
+        """
+        response = self.client.post(reverse('bulkVMAction'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        u = util.create_vimma_user('a', 'a@example.com', 'pass')
+        self.assertTrue(self.client.login(username='a', password='pass'))
+        prj1 = Project.objects.create(name='prj1', email='prj1@x.com')
+        prj1.full_clean()
+        prj2 = Project.objects.create(name='prj2', email='prj2@x.com')
+        prj2.full_clean()
+        u.projects.add(prj1)
+
+        prov = Provider.objects.create(name='My Provider',
+                type=Provider.TYPE_DUMMY)
+        prov.full_clean()
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        tz.full_clean()
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [False]]))
+        s.full_clean()
+
+        vm1a = VM.objects.create(provider=prov, project=prj1, schedule=s)
+        vm1b = VM.objects.create(provider=prov, project=prj1, schedule=s)
+        vm2 = VM.objects.create(provider=prov, project=prj2, schedule=s)
+
+        url = reverse('bulkVMAction')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code,
+                status.HTTP_405_METHOD_NOT_ALLOWED)
+        for data in (
+                json.dumps({'action': 'explode', 'vmids': [vm1a.id]}),
+                json.dumps({'vmids': [vm1a.id]}),
+                json.dumps({'action': 'reboot'}),
+                json.dumps({'action': 'reboot', 'vmids': ['x']}),
+                json.dumps({'action': 'reboot', 'vmids': [[1]]}),
+                json.dumps({'action': 'reboot', 'vmids': 5}),
+                json.dumps({'action': 'reboot', 'project': None}),
+                json.dumps(['reboot']),
+                '{not json',
+                ):
+            response = self.client.post(url, content_type='application/json',
+                    data=data)
+            self.assertEqual(response.status_code,
+                    status.HTTP_400_BAD_REQUEST, data)
+
+        response = self.client.post(url, content_type='application/json',
+                data=json.dumps({'action': 'reboot',
+                    'vmids': [vm1a.id, vm2.id, 100]}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content.decode('utf-8')), {
+            'results': {
+                str(vm1a.id): None,
+                str(vm2.id): 'You may not reboot VMs in this project',
+                '100': 'Not found',
+            }})
+
+        response = self.client.post(url, content_type='application/json',
+                data=json.dumps({'action': 'destroy', 'project': prj1.id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content.decode('utf-8')), {
+            'results': {str(vm1a.id): None, str(vm1b.id): None}})
+        for vm in vm1a, vm1b:
+            vm = VM.objects.get(id=vm.id)
+            self.assertIsNotNone(vm.destroy_request_at)
+            self.assertEqual(vm.destroy_request_by, u)
+        self.assertIsNone(VM.objects.get(id=vm2.id).destroy_request_at)
+
+        # destroyed VMs are left alone
+        VM.objects.filter(id=vm1a.id).update(
+                destroyed_at=datetime.datetime.utcnow().replace(tzinfo=utc))
+        response = self.client.post(url, content_type='application/json',
+                data=json.dumps({'action': 'power-on',
+                    'vmids': [vm1a.id, vm1b.id]}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content.decode('utf-8')), {
+            'results': {str(vm1a.id): 'Already destroyed',
+                str(vm1b.id): None}})
+
+
 class OverrideScheduleTests(TestCase):
     """
     Test the overrideSchedule endpoint and util.* helper.
@@ -2257,6 +3261,54 @@ class OverrideScheduleTests(TestCase):
         vm.full_clean()
         self.assertFalse(util.vm_at_now(vm.id))
 
+    def test_next_transition_at(self):
+        """
+        Test the util.next_transition_at helper.
+        """
+        prj = Project.objects.create(name='prj', email='prj@x.com')
+        prov = Provider.objects.create(name='My Provider',
+                type=Provider.TYPE_DUMMY, max_override_seconds=3600)
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        matrix = 7 * [24 * [False] + 24 * [True]]
+        s = Schedule.objects.create(name='Afternoons', timezone=tz,
+                matrix=json.dumps(matrix))
+        vm = VM.objects.create(provider=prov, project=prj, schedule=s)
+
+        now = datetime.datetime.utcnow().replace(tzinfo=utc)
+        exp = Expiration.objects.create(type=Expiration.TYPE_VM,
+                expires_at=now + datetime.timedelta(days=30))
+        VMExpiration.objects.create(expiration=exp, vm=vm)
+
+        def check(expected_tstamp):
+            util.set_vm_next_transition_at(vm.id)
+            got = VM.objects.get(id=vm.id).next_transition_at
+            if expected_tstamp is None:
+                self.assertIsNone(got)
+            else:
+                self.assertEqual(got.timestamp(), expected_tstamp)
+
+        # from the schedule
+        sched_tstamp = get_compiled_schedule(s).next_transition_after(
+                now.timestamp())
+        check(sched_tstamp)
+
+        # the override ends before the next schedule change
+        end = now + datetime.timedelta(minutes=1)
+        vm.sched_override_state = True
+        vm.sched_override_tstamp = int(end.timestamp())
+        vm.save()
+        check(int(end.timestamp()) + 1)
+
+        # the expiration comes first
+        exp.expires_at = now + datetime.timedelta(seconds=20)
+        exp.save()
+        check(exp.expires_at.timestamp() + 1)
+
+        # the VM has expired, it stays OFF
+        exp.expires_at = now - datetime.timedelta(seconds=20)
+        exp.save()
+        check(None)
+
 
 class ChangeVMScheduleTests(TestCase):
     """
@@ -2720,6 +3772,37 @@ class CanDoTests(TestCase):
         self.assertTrue(util.can_do(u1, Actions.CREATE_VM_IN_PROJECT, prj1))
         self.assertTrue(util.can_do(u1, Actions.CREATE_VM_IN_PROJECT, prj2))
 
+    def test_project_checks_memoized(self):
+        """
+        Project membership is read once per user object, until it changes.
+        """
+        prj1 = Project.objects.create(name='prj1', email='prj1@x.com')
+        prj2 = Project.objects.create(name='prj2', email='prj2@x.com')
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        sched = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prov = Provider.objects.create(name='My Prov', type=Provider.TYPE_DUMMY)
+        vm1 = VM.objects.create(provider=prov, project=prj1, schedule=sched)
+        vm2 = VM.objects.create(provider=prov, project=prj2, schedule=sched)
+        u = util.create_vimma_user('a', 'a@example.com', 'pass')
+        u.projects.add(prj1)
+
+        vm1 = VM.objects.get(id=vm1.id)
+        vm2 = VM.objects.get(id=vm2.id)
+        # one query for the permissions, one for the projects
+        with self.assertNumQueries(2):
+            for vm in (vm1, vm2):
+                util.can_do(u, Actions.OVERRIDE_VM_SCHEDULE, vm)
+                util.can_do(u,
+                        Actions.POWER_ONOFF_REBOOT_DESTROY_VM_IN_PROJECT, prj1)
+        self.assertTrue(util.can_do(u, Actions.OVERRIDE_VM_SCHEDULE, vm1))
+        self.assertFalse(util.can_do(u, Actions.OVERRIDE_VM_SCHEDULE, vm2))
+
+        prj2.user_set.add(u)
+        self.assertTrue(util.can_do(u, Actions.OVERRIDE_VM_SCHEDULE, vm2))
+        u.projects.remove(prj1)
+        self.assertFalse(util.can_do(u, Actions.OVERRIDE_VM_SCHEDULE, vm1))
+
 
 class AuditTests(TestCase):
 
@@ -2791,6 +3874,145 @@ class AuditTests(TestCase):
         delta = now - a.timestamp
         self.assertTrue(delta <= datetime.timedelta(minutes=1))
 
+    def test_archive(self):
+        """
+        Old Audits are moved to daily archive files.
+        """
+        now = datetime.datetime.utcnow().replace(tzinfo=utc)
+        day = datetime.timedelta(days=1)
+        for i, delta in enumerate((3*day, 3*day, 2*day, 0*day)):
+            Audit.objects.create(level=Audit.INFO, text=str(i),
+                    timestamp=now - delta)
+
+        with tempfile.TemporaryDirectory() as archive_dir:
+            n = archive.archive_audits(now - day, archive_dir, batch_size=2)
+            self.assertEqual(n, 3)
+            self.assertEqual(list(Audit.objects.values_list('text',
+                flat=True)), ['3'])
+
+            def read(delta):
+                path = archive.archive_file_path(archive_dir,
+                        (now - delta).date())
+                with gzip.open(path, 'rt', encoding='utf-8') as f:
+                    return [json.loads(line)['text'] for line in f]
+            self.assertEqual(read(3*day), ['0', '1'])
+            self.assertEqual(read(2*day), ['2'])
+
+            self.assertEqual(archive.archive_audits(now - day, archive_dir),
+                    0)
+
+    @override_settings(AUDIT_MIN_LEVEL='INFO',
+            AUDIT_MIN_LEVEL_OVERRIDES={'a': 'WARNING', 'b.c': 'DEBUG'})
+    def test_min_level_setting(self):
+        """
+        Audit messages below the configured level aren't saved.
+        """
+        def check(name, level, saved):
+            Audit.objects.all().delete()
+            audit.Auditor(name).log(level, 'msg')
+            self.assertEqual(Audit.objects.count(), 1 if saved else 0)
+
+        check('x', Audit.DEBUG, False)
+        check('x', Audit.INFO, True)
+        check('a', Audit.INFO, False)
+        check('a.x', Audit.INFO, False)
+        check('a.x', Audit.WARNING, True)
+        check('ab', Audit.INFO, True)
+        check('b', Audit.DEBUG, False)
+        check('b.c', Audit.DEBUG, True)
+        check('b.c.d', Audit.DEBUG, True)
+
+        with override_settings(AUDIT_DEBUG_SAMPLE_RATE=0):
+            check('b.c', Audit.DEBUG, False)
+            check('b.c', Audit.INFO, True)
+
+    @override_settings(AUDIT_BUFFERED=True, AUDIT_BUFFER_MAX_SIZE=4)
+    def test_buffered(self):
+        """
+        Buffered Audit messages are saved in batches, only by flush().
+        """
+        u = util.create_vimma_user('a', 'a@example.com', 'pass')
+        aud = audit.Auditor('buffered')
+
+        # logging never touches the DB
+        with self.assertNumQueries(0):
+            aud.info('one', user_id=u.id)
+            aud.debug('two', user_id=u.id + 100)
+            aud.warning('three', vm_id=1000)
+        self.assertEqual(Audit.objects.count(), 0)
+        # 2 lookups for VMs and Users and a single insert, in a savepoint
+        with self.assertNumQueries(5):
+            request_finished.send(sender=None)
+        self.assertEqual(Audit.objects.count(), 3)
+        a1, a2, a3 = Audit.objects.order_by('id')
+        self.assertEqual((a1.text, a1.user_id), ('buffered: one', u.id))
+        # missing users and VMs are cleared, the message is kept
+        self.assertEqual((a2.text, a2.user_id), ('buffered: two', None))
+        self.assertEqual((a3.text, a3.vm_id), ('buffered: three', None))
+
+        # when the buffer is full, new messages are dropped
+        for i in range(6):
+            aud.debug(str(i))
+        self.assertEqual(Audit.objects.count(), 3)
+        audit.flush()
+        self.assertEqual(list(Audit.objects.order_by('-id')
+            .values_list('text', flat=True)[:5]),
+            ['buffered: 3', 'buffered: 2', 'buffered: 1', 'buffered: 0',
+                'buffered: three'])
+
+        # or the oldest ones
+        with override_settings(AUDIT_BUFFER_OVERFLOW='drop-oldest'):
+            for i in range(6, 12):
+                aud.debug(str(i))
+            audit.flush()
+        self.assertEqual(list(Audit.objects.order_by('-id')
+            .values_list('text', flat=True)[:5]),
+            ['buffered: 11', 'buffered: 10', 'buffered: 9', 'buffered: 8',
+                'buffered: 3'])
+
+    @requires_redis
+    def test_event_after_transaction(self):
+        """
+        The 'audit' VM event of a message logged in a transaction is
+        published after the transaction, at the end of the request or task.
+        """
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_DUMMY)
+        prj = Project.objects.create(name='Prj', email='a@b.com')
+        vm = VM.objects.create(provider=prv, project=prj, schedule=s)
+
+        with redis_at(TEST_REDIS_URL), self.settings(EVENT_STREAM=True):
+            pubsub = redis.StrictRedis.from_url(TEST_REDIS_URL).pubsub(
+                    ignore_subscribe_messages=True)
+            pubsub.subscribe('vimma:events:project:{}'.format(prj.id))
+            pubsub.get_message()
+
+            with transaction.atomic():
+                audit.Auditor('aud').warning('hi', vm_id=vm.id)
+                time.sleep(.1)
+                self.assertIsNone(pubsub.get_message())
+            # TestCase runs in a transaction, so request_finished publishes
+            request_finished.send(sender=None)
+            time.sleep(.1)
+            msg = pubsub.get_message()
+            self.assertEqual(json.loads(msg['data'].decode('utf-8')),
+                    {'vm': vm.id, 'type': 'audit', 'level': Audit.WARNING})
+
+            # the transaction may have rolled back if the task or request
+            # failed, so its events are dropped
+            with transaction.atomic():
+                audit.Auditor('aud').warning('hi', vm_id=vm.id)
+            task_postrun.send(sender=None, state='FAILURE')
+            with transaction.atomic():
+                audit.Auditor('aud').warning('hi', vm_id=vm.id)
+            got_request_exception.send(sender=None, request=None)
+            request_finished.send(sender=None)
+            time.sleep(.1)
+            self.assertIsNone(pubsub.get_message())
+            pubsub.close()
+
 
     def test_api_permissions(self):
         """
@@ -2864,6 +4086,12 @@ class AuditTests(TestCase):
         items = response.data['results']
         self.assertEqual({x['text'] for x in items}, {'vms-fry'})
 
+        self.assertTrue(self.client.login(username='Hubert', password='-'))
+        response = self.client.get(reverse('audit-list') + '?vm=' + str(vmS.id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        items = response.data['results']
+        self.assertEqual({x['text'] for x in items}, {'vms-fry', 'vms-'})
+
         # filter by .user field
         self.assertTrue(self.client.login(username='Bender', password='-'))
         response = self.client.get(reverse('audit-list') +
@@ -2984,6 +4212,302 @@ class PowerLogTests(TestCase):
         with self.assertRaises(PowerLog.DoesNotExist):
             PowerLog.objects.get(id=pl_id)
 
+    def test_power_log_intervals(self):
+        """
+        power_log extends the latest interval or starts a new one, and the
+        0007 migration merges old PowerLogs into intervals.
+        """
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_DUMMY)
+        prj = Project.objects.create(name='Prj', email='a@b.com')
+        vm = VM.objects.create(provider=prv, project=prj, schedule=s)
+
+        for powered_on in (True, True, True, False, False, True):
+            vmutil.power_log(vm.id, powered_on)
+        logs = list(PowerLog.objects.filter(vm=vm).order_by('id'))
+        self.assertEqual([pl.powered_on for pl in logs], [True, False, True])
+        self.assertGreater(logs[0].last_confirmed_at, logs[0].timestamp)
+
+        PowerLog.objects.filter(vm=vm).delete()
+        now = datetime.datetime.utcnow().replace(tzinfo=utc)
+        states = [True, True, False, True, True, True]
+        for i, powered_on in enumerate(states):
+            pl = PowerLog.objects.create(vm=vm, powered_on=powered_on)
+            PowerLog.objects.filter(id=pl.id).update(
+                    timestamp=now + datetime.timedelta(minutes=i))
+        migration = importlib.import_module(
+                'vimma.migrations.0007_powerlog_intervals')
+        migration.compact_power_logs(django.apps.apps, None)
+        self.assertEqual([(pl.powered_on, pl.timestamp, pl.last_confirmed_at)
+            for pl in PowerLog.objects.filter(vm=vm).order_by('timestamp')], [
+                (True, now, now + datetime.timedelta(minutes=1)),
+                (False, now + datetime.timedelta(minutes=2),
+                    now + datetime.timedelta(minutes=2)),
+                (True, now + datetime.timedelta(minutes=3),
+                    now + datetime.timedelta(minutes=5)),
+            ])
+
+    def test_power_log_and_switch_many(self):
+        """
+        power_log_many and switch_on_off_many do what power_log and
+        switch_on_off do, for several VMs at once.
+        """
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_DUMMY)
+        prj = Project.objects.create(name='Prj', email='a@b.com')
+        later = datetime.datetime.now(tz=utc) + datetime.timedelta(days=1)
+        vm_ids = []
+        for i in range(3):
+            vm = VM.objects.create(provider=prv, project=prj, schedule=s)
+            exp = Expiration.objects.create(type=Expiration.TYPE_VM,
+                    expires_at=later)
+            VMExpiration.objects.create(expiration=exp, vm=vm)
+            vm_ids.append(vm.id)
+        vmutil.power_log(vm_ids[0], True)
+        vmutil.power_log(vm_ids[1], True)
+        # expired override
+        VM.objects.filter(id=vm_ids[2]).update(sched_override_state=False,
+                sched_override_tstamp=int(time.time()) - 10)
+
+        with self.assertRaises(ValueError):
+            vmutil.power_log_many({vm_ids[0]: None})
+        states = {vm_ids[0]: True, vm_ids[1]: False, vm_ids[2]: False}
+        vmutil.power_log_many(states)
+        self.assertEqual([list(PowerLog.objects.filter(vm_id=vm_id)
+            .order_by('id').values_list('powered_on', flat=True))
+            for vm_id in vm_ids], [[True], [True, False], [False]])
+
+        with mock.patch.object(dummy.power_on_vm, 'apply_async') as power_on:
+            vmutil.switch_on_off_many(states)
+        self.assertEqual({c[0][0][0] for c in power_on.call_args_list},
+                {vm_ids[1], vm_ids[2]})
+        vm = VM.objects.get(id=vm_ids[2])
+        self.assertIsNone(vm.sched_override_state)
+        self.assertEqual(vm.next_transition_at,
+                later + datetime.timedelta(seconds=1))
+
+    def test_uptime_rollups(self):
+        """
+        Test the uptime rollups computed from PowerLogs and the uptime API.
+        """
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_DUMMY)
+        prj1 = Project.objects.create(name='Prj1', email='a@b.com')
+        prj2 = Project.objects.create(name='Prj2', email='a@b.com')
+        vm1a = VM.objects.create(provider=prv, project=prj1, schedule=s)
+        vm1b = VM.objects.create(provider=prv, project=prj1, schedule=s)
+        vm2 = VM.objects.create(provider=prv, project=prj2, schedule=s)
+
+        day1 = datetime.date(2015, 1, 31)
+        day2 = datetime.date(2015, 2, 1)
+        start = uptime.day_start(day1)
+        hour = datetime.timedelta(hours=1)
+        for vm, begin, confirmed, powered_on in (
+                # on 22:00 → 02:00 (across midnight), off after that
+                (vm1a, 22, 23, True),
+                (vm1a, 26, 30, False),
+                # on 1 hour on day1
+                (vm1b, 10, 11, True),
+                # unknown state after 20:00
+                (vm2, 12, 20, True),
+                ):
+            pl = PowerLog.objects.create(vm=vm, powered_on=powered_on)
+            PowerLog.objects.filter(id=pl.id).update(
+                    timestamp=start + begin*hour,
+                    last_confirmed_at=start + confirmed*hour)
+
+        self.assertEqual(uptime.update_uptime_rollups(), day1)
+        self.assertEqual({(u.vm_id, u.day, u.powered_on_secs)
+            for u in VMUptime.objects.all()}, {
+                (vm1a.id, day1, 2*3600), (vm1a.id, day2, 2*3600),
+                (vm1b.id, day1, 3600), (vm2.id, day1, 8*3600),
+            })
+        self.assertEqual({(u.project_id, u.day, u.powered_on_secs)
+            for u in ProjectUptime.objects.all()}, {
+                (prj1.id, day1, 3*3600), (prj1.id, day2, 2*3600),
+                (prj2.id, day1, 8*3600),
+            })
+        # recomputing gives the same rows
+        uptime.update_uptime_rollups(day1)
+        self.assertEqual(VMUptime.objects.count(), 4)
+
+        u = util.create_vimma_user('a', 'a@example.com', 'pass')
+        u.projects.add(prj1)
+        self.assertTrue(self.client.login(username='a', password='pass'))
+
+        def get(query):
+            response = self.client.get(reverse('uptime') + query)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return json.loads(response.content.decode('utf-8'))['results']
+
+        self.assertEqual(get(''), [
+            {'project': prj1.id, 'day': '2015-01-31',
+                'powered_on_secs': 3*3600},
+            {'project': prj1.id, 'day': '2015-02-01',
+                'powered_on_secs': 2*3600},
+        ])
+        self.assertEqual(get('?group=month&to=2015-01-31'), [
+            {'project': prj1.id, 'month': '2015-01',
+                'powered_on_secs': 3*3600},
+        ])
+        self.assertEqual(get('?scope=vm&group=total&vm={}&vm={}'.format(
+            vm1a.id, vm2.id)), [
+                {'vm': vm1a.id, 'powered_on_secs': 4*3600},
+            ])
+        self.assertEqual(get('?scope=vm&group=total&project={}'.format(
+            prj1.id)), [
+                {'vm': vm1a.id, 'powered_on_secs': 4*3600},
+                {'vm': vm1b.id, 'powered_on_secs': 3600},
+            ])
+        self.assertEqual(get('?scope=vm&group=total&project={}'.format(
+            prj2.id)), [])
+        for query in ('?from=yesterday', '?scope=project&vm={}'.format(
+                vm1a.id)):
+            response = self.client.get(reverse('uptime') + query)
+            self.assertEqual(response.status_code,
+                    status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(VM_HOURLY_PRICES={'t2.micro': 0.5},
+            VM_DEFAULT_HOURLY_PRICE=2)
+    def test_projection(self):
+        """
+        Test the projected VM hours and cost, and the projection API.
+        """
+        tz = TimeZone.objects.create(name='UTC')
+        # ON on Mondays 08:00–10:00
+        matrix = 7 * [48 * [False]]
+        matrix[0] = 16 * [False] + 4 * [True] + 28 * [False]
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(matrix))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_AWS)
+        prj1 = Project.objects.create(name='Prj1', email='a@b.com')
+        prj2 = Project.objects.create(name='Prj2', email='a@b.com')
+        # a Monday
+        now = datetime.datetime(2015, 1, 5, tzinfo=utc).timestamp()
+        hour = 3600
+
+        compiled = get_compiled_schedule(s)
+        for start, n in ((now, 3000), (now + 7*hour + 1234, 700),
+                (now - 5*hour, 336*3 + 17)):
+            self.assertEqual(compiled.count_on_slots(start, n),
+                    sum(compiled.is_on(start + i * 1800) for i in range(n)))
+
+        vm1 = VM.objects.create(provider=prv, project=prj1, schedule=s)
+        AWSVM.objects.create(vm=vm1, name='1', region='a',
+                instance_type='t2.micro')
+        # override ON for the first hour
+        vm2 = VM.objects.create(provider=prv, project=prj1, schedule=s,
+                sched_override_state=True,
+                sched_override_tstamp=now + hour - 1)
+        # expires on the second Monday at 09:00
+        vm3 = VM.objects.create(provider=prv, project=prj2, schedule=s)
+        exp = Expiration.objects.create(type=Expiration.TYPE_VM,
+                expires_at=datetime.datetime.fromtimestamp(
+                    now + (7*24 + 9)*hour, tz=utc))
+        VMExpiration.objects.create(expiration=exp, vm=vm3)
+        VM.objects.create(provider=prv, project=prj2, schedule=s,
+                destroyed_at=datetime.datetime.now(tz=utc))
+
+        result = projection.project_vms({}, 2, now=now)
+        self.assertEqual(result, [
+            {'vm': vm1.id, 'project': prj1.id, 'hours': 4, 'cost': 2},
+            {'vm': vm2.id, 'project': prj1.id, 'hours': 5, 'cost': 10},
+            {'vm': vm3.id, 'project': prj2.id, 'hours': 3, 'cost': 6},
+        ])
+        self.assertEqual(projection.summarize(result), ({
+                prj1.id: {'hours': 9, 'cost': 12},
+                prj2.id: {'hours': 3, 'cost': 6},
+            }, {'hours': 12, 'cost': 18}))
+        # preview the schedule always ON
+        result = projection.project_vms({'project': prj2}, 2, now=now,
+                schedule_matrices=projection.parse_schedule_matrices(
+                    {str(s.id): 7 * [48 * [True]]}))
+        self.assertEqual([x['hours'] for x in result], [7*24 + 9])
+        with self.assertRaises(ValidationError):
+            projection.parse_schedule_matrices({s.id: [[True]]})
+
+        u = util.create_vimma_user('a', 'a@example.com', 'pass')
+        u.projects.add(prj1)
+        self.assertTrue(self.client.login(username='a', password='pass'))
+        response = self.client.get(reverse('projection') + '?weeks=2')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([x['vm'] for x in data['vms']], [vm1.id, vm2.id])
+        self.assertEqual(list(data['projects']), [str(prj1.id)])
+
+        response = self.client.post(reverse('projection'), content_type=
+                'application/json', data=json.dumps({'weeks': 2,
+                    'project': [prj1.id, prj2.id],
+                    'schedules': {s.id: json.dumps(7 * [48 * [False]])}}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(response.content.decode('utf-8'))
+        # the API projects from the current time, after vm2's override
+        self.assertEqual(data['total'], {'hours': 0, 'cost': 0})
+
+        for query in ('?weeks=0', '?weeks=many', '?project=x'):
+            response = self.client.get(reverse('projection') + query)
+            self.assertEqual(response.status_code,
+                    status.HTTP_400_BAD_REQUEST)
+
+    def test_api_pagination(self):
+        """
+        Walk the PowerLog pages forward and back using the API cursors.
+        """
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_DUMMY)
+        prj = Project.objects.create(name='Prj', email='a@b.com')
+        vm = VM.objects.create(provider=prv, project=prj, schedule=s)
+        u = util.create_vimma_user('Fry', 'fry@pe.com', '-')
+        u.projects.add(prj)
+
+        # several items share a timestamp, so the id breaks the ties
+        now = datetime.datetime.now(tz=utc)
+        pl_ids = []
+        for i in range(7):
+            pl_id = PowerLog.objects.create(vm=vm, powered_on=True).id
+            PowerLog.objects.filter(id=pl_id).update(
+                    timestamp=now - datetime.timedelta(seconds=i // 3))
+            pl_ids.append(pl_id)
+        # newest first, higher ids first for the same timestamp
+        pl_ids = pl_ids[2::-1] + pl_ids[5:2:-1] + pl_ids[6:]
+
+        self.assertTrue(self.client.login(username='Fry', password='-'))
+        response = self.client.get(reverse('powerlog-list') +
+                '?page_size=3&count=true')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 7)
+        self.assertEqual([x['id'] for x in response.data['results']],
+                pl_ids[:3])
+        self.assertIsNone(response.data['previous'])
+
+        response = self.client.get(response.data['next'])
+        self.assertNotIn('count', response.data)
+        self.assertEqual([x['id'] for x in response.data['results']],
+                pl_ids[3:6])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([x['id'] for x in response.data['results']],
+                pl_ids[6:])
+        self.assertIsNone(response.data['next'])
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([x['id'] for x in response.data['results']],
+                pl_ids[3:6])
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([x['id'] for x in response.data['results']],
+                pl_ids[:3])
+        self.assertIsNone(response.data['previous'])
+
+        response = self.client.get(reverse('powerlog-list') + '?cursor=abc')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_api_permissions(self):
         """
         Users can read PowerLog objects if the VM is in one of their projects.
@@ -3087,6 +4611,48 @@ class PowerLogTests(TestCase):
         self.assertEqual(response.status_code,
                 status.HTTP_405_METHOD_NOT_ALLOWED)
 
+    def test_api_vm_param_without_filter_backend(self):
+        """
+        The ?vm= shortcut in the Audit and PowerLog APIs filters by the VM
+        itself, so it doesn't rely on the filter backend for permissions.
+        """
+        u = util.create_vimma_user('Fry', 'fry@pe.com', '-')
+        tz = TimeZone.objects.create(name='Europe/Helsinki')
+        s = Schedule.objects.create(name='s', timezone=tz,
+                matrix=json.dumps(7 * [48 * [True]]))
+        prv = Provider.objects.create(name='My Prov', type=Provider.TYPE_DUMMY)
+        pD = Project.objects.create(name='Prj Delivery', email='p-d@pe.com')
+        pS = Project.objects.create(name='Prj Smelloscope', email='p-s@pe.com')
+        vmD = VM.objects.create(provider=prv, project=pD, schedule=s)
+        vmD2 = VM.objects.create(provider=prv, project=pD, schedule=s)
+        vmS = VM.objects.create(provider=prv, project=pS, schedule=s)
+        u.projects.add(pD)
+
+        pl_ids, audit_ids = {}, {}
+        for vm in (vmD, vmD2, vmS):
+            pl_ids[vm.id] = PowerLog.objects.create(vm=vm,
+                    powered_on=True).id
+            audit_ids[vm.id] = Audit.objects.create(level=Audit.INFO, vm=vm,
+                    text='x').id
+
+        self.assertTrue(self.client.login(username='Fry', password='-'))
+        with mock.patch.object(views.PowerLogViewSet, 'filter_backends', ()), \
+                mock.patch.object(views.AuditViewSet, 'filter_backends', ()):
+            for viewname, ids in (('powerlog-list', pl_ids),
+                    ('audit-list', audit_ids)):
+                response = self.client.get(reverse(viewname) +
+                        '?vm=' + str(vmD.id))
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual([x['id'] for x in response.data['results']],
+                        [ids[vmD.id]])
+
+                # a VM in another project
+                response = self.client.get(reverse(viewname) +
+                        '?vm=' + str(vmS.id))
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertNotIn(ids[vmS.id],
+                        {x['id'] for x in response.data['results']})
+
 
 class ExpirationTests(TestCase):
 
@@ -3121,6 +4687,40 @@ class ExpirationTests(TestCase):
             ):
             self.assertFalse(expiry.needs_notification(exp, last_notif, ints))
 
+    def test_next_due_at(self):
+        """
+        Test expiry.next_due_at and the Expiration.next_due_at field.
+        """
+        now = datetime.datetime.utcnow().replace(tzinfo=utc)
+        sec = datetime.timedelta(seconds=1)
+        for last_notif, ints, grace, due in (
+                (None, [], 100, now + 100*sec),
+                (None, [-10, 5], 100, now - 10*sec),
+                (now - 10*sec, [-10, 5], 100, now + 5*sec),
+                (now + 5*sec, [-10, 5], 100, now + 100*sec),
+                (None, [200], 100, now + 100*sec),
+                ):
+            self.assertEqual(expiry.next_due_at(now, last_notif, ints, grace),
+                    due)
+
+        exp = Expiration.objects.create(type=Expiration.TYPE_FIREWALL_RULE,
+                expires_at=now)
+        exp.full_clean()
+        self.assertEqual(exp.next_due_at, now)
+        exp.expires_at = now + 10*sec
+        exp.save()
+        self.assertEqual(Expiration.objects.get(id=exp.id).next_due_at,
+                now + 10*sec)
+        exp.grace_end_action_performed = True
+        exp.save()
+        self.assertIsNone(Expiration.objects.get(id=exp.id).next_due_at)
+
+        exp2 = Expiration.objects.create(type=Expiration.TYPE_FIREWALL_RULE,
+                expires_at=now - sec)
+        Expiration.objects.create(type=Expiration.TYPE_FIREWALL_RULE,
+                expires_at=now + 100*sec)
+        self.assertEqual(list(vmutil._due_expiration_ids()), [exp2.id])
+
     def test_api_permissions_vm(self):
         """
         Users can read Expiration and VMExpiration objects
@@ -3466,3 +5066,121 @@ class FirewallRule_AWSFirewallRule_Tests(TestCase):
                 aws_fw_item, format='json')
         self.assertEqual(response.status_code,
                 status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@requires_redis
+class RateLimitTests(TestCase):
+    """
+    Test the token buckets against Redis. Time passes in Redis, so the waits
+    are approximate.
+    """
+
+    def setUp(self):
+        self.redis_at = redis_at(TEST_REDIS_URL)
+        self.redis_at.__enter__()
+        patcher = mock.patch.object(ratelimit, 'time')
+        self.sleep = patcher.start().sleep
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.redis_at.__exit__, None, None, None)
+
+    @override_settings(RATE_LIMIT_MAX_WAIT_SECS=None)
+    def test_burst_and_reservations(self):
+        """
+        A full bucket serves ‘burst’ calls at once, then reserves tokens in
+        order.
+        """
+        for i in range(3):
+            self.assertEqual(ratelimit.acquire('b', 2, 3), 0)
+        self.assertFalse(self.sleep.called)
+        for expected in (.5, 1, 1.5):
+            self.assertAlmostEqual(ratelimit.acquire('b', 2, 3), expected,
+                    delta=.05)
+        self.assertAlmostEqual(self.sleep.call_args[0][0], 1.5, delta=.05)
+        # other buckets are independent
+        self.assertEqual(ratelimit.acquire('c', 2, 3), 0)
+
+        stats = ratelimit.get_stats()
+        self.assertEqual({k: v['calls'] for k, v in stats.items()},
+                {'b': 6, 'c': 1})
+        self.assertEqual(stats['b']['waits'], 3)
+        self.assertAlmostEqual(stats['b']['wait_secs'], 3, delta=.15)
+        ratelimit.reset_stats()
+        self.assertEqual(ratelimit.get_stats(), {})
+
+    def test_refill(self):
+        """
+        An empty bucket refills at ‘rate’ tokens per second, up to ‘burst’.
+        """
+        self.assertEqual(ratelimit.acquire('b', 20, 1), 0)
+        self.assertGreater(ratelimit.acquire('b', 20, 1), 0)
+        time.sleep(.2)
+        # 4 tokens' worth of time, but the bucket holds 1
+        self.assertEqual(ratelimit.acquire('b', 20, 1), 0)
+        self.assertGreater(ratelimit.acquire('b', 20, 1), 0)
+
+    @override_settings(RATE_LIMIT_MAX_WAIT_SECS=1.2)
+    def test_max_wait(self):
+        """
+        A call which would wait too long raises and reserves no token, in
+        code which retries on it.
+        """
+        with ratelimit.raise_over_max_wait():
+            self.assertEqual(ratelimit.acquire('b', 1, 1), 0)
+            self.assertAlmostEqual(ratelimit.acquire('b', 1, 1), 1,
+                    delta=.05)
+            with self.assertRaises(ratelimit.RateLimitExceeded):
+                ratelimit.acquire('b', 1, 1)
+            self.assertEqual(ratelimit.get_stats()['b']['rejects'], 1)
+            with override_settings(RATE_LIMIT_MAX_WAIT_SECS=None):
+                self.assertAlmostEqual(ratelimit.acquire('b', 1, 1), 2,
+                        delta=.05)
+        # elsewhere calls wait as long as needed
+        self.assertAlmostEqual(ratelimit.acquire('b', 1, 1), 3, delta=.05)
+
+    def test_redis_down(self):
+        """
+        Without Redis calls aren't limited.
+        """
+        with redis_at(DOWN_REDIS_URL):
+            for i in range(3):
+                self.assertEqual(ratelimit.acquire('b', 1, 1), 0)
+
+    def test_aws_connections(self):
+        """
+        AWS connections take a token before each API call, unless their API
+        family is mapped to None.
+        """
+        conn = mock.Mock()
+        make_request = conn.make_request
+        with override_settings(AWS_RATE_LIMITS={'ec2': None}):
+            aws._rate_limit(conn, 'vpc', 'r', 'key')
+        self.assertIs(conn.make_request, make_request)
+
+        with override_settings(AWS_RATE_LIMITS={'route53': (4, 5)}), \
+                mock.patch.object(ratelimit, 'acquire') as acquire:
+            aws._rate_limit(conn, 'route53', 'r', 'key')
+            conn.make_request('GET', '/')
+        acquire.assert_called_once_with('aws:route53:key:global', 4, 5)
+        make_request.assert_called_once_with('GET', '/')
+
+
+class CeleryConfigTests(TestCase):
+
+    def test_task_routes(self):
+        """
+        Every Vimma task is routed to a declared queue, with a priority.
+        """
+        queues = {q.name for q in celeryconfig.CELERY_QUEUES}
+        task_names = {name for name in app.tasks if name.startswith('vimma.')}
+        self.assertIn('vimma.vmtype.aws.power_on_vm', task_names)
+        self.assertEqual(task_names, set(celeryconfig.CELERY_ROUTES))
+        for name, route in celeryconfig.CELERY_ROUTES.items():
+            self.assertIn(route['queue'], queues, name)
+            self.assertIn(route['priority'], (
+                celeryconfig.PRIORITY_INTERACTIVE,
+                celeryconfig.PRIORITY_BACKGROUND), name)
+
+        queue = app.amqp.router.route({}, 'vimma.vmtype.aws.do_create_vm')
+        self.assertEqual(queue['queue'].name, 'provisioning')
+        self.assertEqual(app.amqp.router.route({'priority': 0},
+            'vimma.vmutil.update_vm_status')['priority'], 0)
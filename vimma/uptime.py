@@ -0,0 +1,101 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Min, Q
+from django.utils.timezone import utc
+import datetime
+import itertools
+
+from vimma.models import VM, PowerLog, VMUptime, ProjectUptime
+
+
+def day_start(day):
+    """
+    Return the aware datetime when day (date) starts in UTC.
+    """
+    return datetime.datetime.combine(day, datetime.time()).replace(tzinfo=utc)
+
+
+def powered_on_secs_by_day(intervals, start, end):
+    """
+    Return {day (date): seconds} a VM was powered on between start and end.
+
+    intervals are the VM's PowerLogs as (timestamp, last_confirmed_at,
+    powered_on) tuples sorted by timestamp. A state lasts until the next
+    PowerLog starts (it changed at some point before that) and the last
+    state until its last_confirmed_at. Days are in UTC.
+    """
+    result = {}
+    for i, (begin, confirmed, powered_on) in enumerate(intervals):
+        if not powered_on:
+            continue
+        finish = intervals[i+1][0] if i + 1 < len(intervals) else confirmed
+        begin, finish = max(begin, start), min(finish, end)
+        while begin < finish:
+            day = begin.date()
+            chunk_end = min(finish, day_start(day + datetime.timedelta(days=1)))
+            result[day] = (result.get(day, 0) +
+                    (chunk_end - begin).total_seconds())
+            begin = chunk_end
+    return result
+
+
+def update_uptime_rollups(since=None):
+    """
+    Recompute the VMUptime and ProjectUptime rows from day since (date) to
+    today.
+
+    If since is None, start settings.UPTIME_ROLLUP_LOOKBACK_DAYS before the
+    latest rolled-up day (to include PowerLogs confirmed late), or at the
+    first PowerLog. Returns the first recomputed day, or None if there are no
+    PowerLogs.
+    This function must not be called inside a transaction.
+    """
+    now = datetime.datetime.utcnow().replace(tzinfo=utc)
+    if since is None:
+        latest = VMUptime.objects.aggregate(Max('day'))['day__max']
+        if latest is not None:
+            since = latest - datetime.timedelta(
+                    days=settings.UPTIME_ROLLUP_LOOKBACK_DAYS)
+        else:
+            first = PowerLog.objects.aggregate(
+                    Min('timestamp'))['timestamp__min']
+            if first is None:
+                return None
+            since = first.date()
+    start = day_start(since)
+
+    # each VM's state at start comes from its latest earlier PowerLog
+    prev_ids = (PowerLog.objects.filter(timestamp__lt=start)
+            .values('vm_id').annotate(latest_id=Max('id'))
+            .values_list('latest_id', flat=True))
+    rows = (PowerLog.objects.filter(Q(id__in=prev_ids) |
+                Q(timestamp__gte=start))
+            .order_by('vm_id', 'timestamp', 'id')
+            .values_list('vm_id', 'timestamp', 'last_confirmed_at',
+                'powered_on'))
+
+    vm_secs = {}
+    for vm_id, vm_rows in itertools.groupby(rows.iterator(),
+            key=lambda r: r[0]):
+        by_day = powered_on_secs_by_day([r[1:] for r in vm_rows], start, now)
+        for day, secs in by_day.items():
+            vm_secs[vm_id, day] = round(secs)
+    project_ids = dict(VM.objects.filter(id__in={k[0] for k in vm_secs})
+            .values_list('id', 'project_id'))
+    prj_secs = {}
+    for (vm_id, day), secs in vm_secs.items():
+        key = project_ids[vm_id], day
+        prj_secs[key] = prj_secs.get(key, 0) + secs
+
+    with transaction.atomic():
+        VMUptime.objects.filter(day__gte=since).delete()
+        VMUptime.objects.bulk_create([VMUptime(vm_id=vm_id, day=day,
+            powered_on_secs=secs)
+            for (vm_id, day), secs in vm_secs.items() if secs],
+            batch_size=1000)
+        ProjectUptime.objects.filter(day__gte=since).delete()
+        ProjectUptime.objects.bulk_create([ProjectUptime(project_id=prj_id,
+            day=day, powered_on_secs=secs)
+            for (prj_id, day), secs in prj_secs.items() if secs],
+            batch_size=1000)
+    return since
@@ -9,12 +9,13 @@ from vimma.views import (
     TimeZoneViewSet, ScheduleViewSet, ProjectViewSet,
     ProviderViewSet, DummyProviderViewSet, AWSProviderViewSet,
     VMConfigViewSet, DummyVMConfigViewSet, AWSVMConfigViewSet,
-    VMViewSet, DummyVMViewSet, AWSVMViewSet,
+    VMViewSet, VMDetailViewSet, DummyVMViewSet, AWSVMViewSet,
     FirewallRuleViewSet, AWSFirewallRuleViewSet,
     AuditViewSet, PowerLogViewSet, ExpirationViewSet, VMExpirationViewSet,
     FirewallRuleExpirationViewSet,
-    index, base_js, test,
+    index, base_js, vm_events, uptime, projection, test,
     create_vm, power_on_vm, power_off_vm, reboot_vm, destroy_vm,
+    bulk_vm_action,
     override_schedule, change_vm_schedule, set_expiration,
     create_firewall_rule, delete_firewall_rule,
 )
@@ -32,6 +33,7 @@ router.register(r'vmconfigs', VMConfigViewSet, 'vmconfig')
 router.register(r'dummyvmconfigs', DummyVMConfigViewSet)
 router.register(r'awsvmconfigs', AWSVMConfigViewSet)
 router.register(r'vms', VMViewSet, 'vm')
+router.register(r'vmdetails', VMDetailViewSet, 'vmdetail')
 router.register(r'dummyvms', DummyVMViewSet, 'dummyvm')
 router.register(r'awsvm', AWSVMViewSet, 'awsvm')
 router.register(r'audit', AuditViewSet, 'audit')
@@ -48,6 +50,9 @@ urlpatterns = [
 
     url(r'^$', index, name='index'),
     url(r'^base.js$', base_js, name='base_js'),
+    url(r'^vm-events$', vm_events, name='vmEvents'),
+    url(r'^uptime$', uptime, name='uptime'),
+    url(r'^projection$', projection, name='projection'),
     url(r'^test$', test, name='test'),
 
     url(r'^createvm$', create_vm, name='createVM'),
@@ -55,6 +60,7 @@ urlpatterns = [
     url(r'^poweroffvm$', power_off_vm, name='powerOffVM'),
     url(r'^rebootvm$', reboot_vm, name='rebootVM'),
     url(r'^destroyvm$', destroy_vm, name='destroyVM'),
+    url(r'^bulk-vm-action$', bulk_vm_action, name='bulkVMAction'),
 
     url(r'^override-schedule$', override_schedule, name='overrideSchedule'),
     url(r'^change-vm-schedule$', change_vm_schedule, name='changeVMSchedule'),
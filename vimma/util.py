@@ -1,18 +1,21 @@
 import datetime
 from django.core.exceptions import PermissionDenied
 from django.db import transaction
+from django.db.models import Case, Value, When
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.db.utils import OperationalError
+from django.dispatch import receiver
 from django.http import HttpResponse
 from django.utils.timezone import utc
 import json
-import pytz
 import random
 import time
 
 from vimma.actions import Actions
 from vimma.audit import Auditor
-from vimma.models import VM, User
+from vimma.models import VM, User, Role, Permission, Project
 from vimma.perms import Perms
+from vimma.schedule import get_compiled_schedule
 
 
 aud = Auditor(__name__)
@@ -28,18 +31,78 @@ def create_vimma_user(username, email, password, first_name='', last_name=''):
     return user
 
 
+# Incremented whenever Roles, Permissions or the roles of a User change.
+# Permission sets memoized with an older version are recomputed.
+_perms_version = 0
+
+
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+@receiver(m2m_changed, sender=Role.permissions.through)
+@receiver(m2m_changed, sender=User.roles.through)
+def _invalidate_perms(sender, **kwargs):
+    global _perms_version
+    if kwargs.get('action', 'post_').startswith('post_'):
+        _perms_version += 1
+
+
+def get_perms(user):
+    """
+    Return a frozenset with the names of all permissions user (User) has.
+
+    The set is computed in a single query and memoized on the user object,
+    which Django creates for each request, so repeated permission checks
+    while handling a request don't hit the DB again.
+    """
+    memo = getattr(user, '_vimma_perms', None)
+    if memo is not None and memo[0] == _perms_version:
+        return memo[1]
+
+    version = _perms_version
+    perms = frozenset(Permission.objects.filter(role__user=user)
+            .values_list('name', flat=True))
+    user._vimma_perms = (version, perms)
+    return perms
+
+
+# Incremented whenever the projects of a User change or a Project is deleted.
+_projects_version = 0
+
+
+@receiver(post_delete, sender=Project)
+@receiver(m2m_changed, sender=User.projects.through)
+def _invalidate_project_ids(sender, **kwargs):
+    global _projects_version
+    if kwargs.get('action', 'post_').startswith('post_'):
+        _projects_version += 1
+
+
+def get_project_ids(user):
+    """
+    Return a frozenset with the ids of the projects user (User) is a member of.
+
+    Memoized on the user object, like get_perms.
+    """
+    memo = getattr(user, '_vimma_project_ids', None)
+    if memo is not None and memo[0] == _projects_version:
+        return memo[1]
+
+    version = _projects_version
+    prj_ids = frozenset(user.projects.values_list('id', flat=True))
+    user._vimma_project_ids = (version, prj_ids)
+    return prj_ids
+
+
 def has_perm(user, perm):
     """
     Return True if user (User object) has perm (string), False otherwise.
 
     The omnipotent permission grants any perm.
     """
-    for r in user.roles.filter():
-        if r.permissions.filter(name=Perms.OMNIPOTENT).exists():
-            return True
-        if r.permissions.filter(name=perm).exists():
-            return True
-    return False
+    perms = get_perms(user)
+    return Perms.OMNIPOTENT in perms or perm in perms
 
 
 def login_required_or_forbidden(view_func):
@@ -80,7 +143,7 @@ def can_do(user, what, data=None):
         return has_perm(user, Perms.READ_ANY_PROJECT)
     elif what == Actions.CREATE_VM_IN_PROJECT:
         prj = data
-        return user.projects.filter(id=prj.id).count() > 0
+        return prj.id in get_project_ids(user)
     elif what == Actions.USE_PROVIDER:
         prov = data
         return (not prov.is_special or
@@ -91,7 +154,7 @@ def can_do(user, what, data=None):
                 has_perm(user, Perms.USE_SPECIAL_VM_CONFIG))
     elif what == Actions.POWER_ONOFF_REBOOT_DESTROY_VM_IN_PROJECT:
         prj = data
-        return user.projects.filter(id=prj.id).count() > 0
+        return prj.id in get_project_ids(user)
     elif what == Actions.USE_SCHEDULE:
         schedule = data
         if not schedule.is_special:
@@ -103,17 +166,18 @@ def can_do(user, what, data=None):
         return has_perm(user, Perms.READ_ALL_POWER_LOGS)
     elif what == Actions.OVERRIDE_VM_SCHEDULE:
         vm = data
-        return user.projects.filter(id=vm.project.id).count() > 0
+        # use project_id, not project.id, to avoid loading the Project
+        return vm.project_id in get_project_ids(user)
     elif what == Actions.CHANGE_VM_SCHEDULE:
         vm, schedule = data['vm'], data['schedule']
-        if user.projects.filter(id=vm.project.id).count() == 0:
+        if vm.project_id not in get_project_ids(user):
             return False
         return can_do(user, Actions.USE_SCHEDULE, schedule)
     elif what == Actions.SET_ANY_EXPIRATION:
         # only omnipotent users can do this
         return False
     else:
-        aud.warning('Unknown action “{}”'.format(action))
+        aud.warning('Unknown action “{}”'.format(what))
         return False
 
 
@@ -121,13 +185,7 @@ def schedule_at_tstamp(schedule, tstamp):
     """
     Returns True if schedule says ON at unix tstamp, else False.
     """
-    tz = pytz.timezone(schedule.timezone.name)
-    naive = datetime.datetime.utcfromtimestamp(tstamp)
-    aware = pytz.utc.localize(naive)
-    aware = aware.astimezone(tz)
-    row = aware.weekday()
-    col = aware.hour * 2 + aware.minute // 30
-    return json.loads(schedule.matrix)[row][col]
+    return get_compiled_schedule(schedule).is_on(tstamp)
 
 
 def discard_expired_schedule_override(vm_id):
@@ -166,16 +224,64 @@ def vm_at_now(vm_id):
     """
     def call():
         now = datetime.datetime.utcnow().replace(tzinfo=utc).timestamp()
-        vm = VM.objects.get(id=vm_id)
+        vm = (VM.objects.select_related('schedule__timezone',
+            'vmexpiration__expiration').get(id=vm_id))
+        return vm_at_tstamp(vm, now)
+    return retry_in_transaction(call)
 
-        if now > vm.vmexpiration.expiration.expires_at.timestamp():
-            return False
 
-        if (vm.sched_override_state != None and
-                vm.sched_override_tstamp >= now):
-            return vm.sched_override_state
-        return schedule_at_tstamp(vm.schedule, now)
-    return retry_in_transaction(call)
+def vm_at_tstamp(vm, tstamp):
+    """
+    Return True/False if vm (VM object) should be powered ON/OFF at tstamp.
+
+    See vm_at_now(…). This function must be called inside a transaction.
+    """
+    if tstamp > vm.vmexpiration.expiration.expires_at.timestamp():
+        return False
+
+    if (vm.sched_override_state != None and
+            vm.sched_override_tstamp >= tstamp):
+        return vm.sched_override_state
+    return schedule_at_tstamp(vm.schedule, tstamp)
+
+
+def next_transition_at(vm):
+    """
+    Return the datetime when vm_at_now for vm (VM object) may next change.
+
+    Returns None if it won't change anymore, because the VM has expired.
+    This function must be called inside a transaction.
+    """
+    now = datetime.datetime.utcnow().replace(tzinfo=utc).timestamp()
+    # vm_at_now says OFF once now > expires_at
+    expiry_tstamp = vm.vmexpiration.expiration.expires_at.timestamp() + 1
+    if now >= expiry_tstamp:
+        return None
+
+    if (vm.sched_override_state != None and
+            vm.sched_override_tstamp >= now):
+        # the override applies up to and including its end timestamp
+        tstamp = vm.sched_override_tstamp + 1
+    else:
+        tstamp = get_compiled_schedule(vm.schedule).next_transition_after(now)
+
+    if tstamp is None or tstamp > expiry_tstamp:
+        tstamp = expiry_tstamp
+    return datetime.datetime.utcfromtimestamp(tstamp).replace(tzinfo=utc)
+
+
+def set_vm_next_transition_at(vm_id):
+    """
+    Compute and save the next_transition_at field for vm_id.
+
+    This method must not be called inside a transaction.
+    """
+    def call():
+        vm = (VM.objects.select_related('schedule__timezone',
+            'vmexpiration__expiration').get(id=vm_id))
+        vm.next_transition_at = next_transition_at(vm)
+        vm.save(update_fields=['next_transition_at'])
+    retry_in_transaction(call)
 
 
 def set_vm_status_updated_at_now(vm_id):
@@ -193,6 +299,18 @@ def set_vm_status_updated_at_now(vm_id):
     retry_in_transaction(call)
 
 
+def case_by_id(values_by_id, output_field, default=None):
+    """
+    Return a Case expression for QuerySet.update(), giving each object the
+    value from values_by_id (dict) for its id, or default.
+
+    This writes different values to many objects in one query.
+    """
+    return Case(*[When(id=obj_id, then=Value(v, output_field=output_field))
+        for obj_id, v in values_by_id.items()],
+        default=default, output_field=output_field)
+
+
 def retry_in_transaction(call, max_retries=5, start_delay_millis=100):
     """
     Call ‘call’ inside a transaction and return its result.
@@ -1,8 +1,8 @@
 import datetime
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Q
-from django.http import HttpResponse
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db.models import Max, Prefetch, Q, Sum
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.utils.timezone import utc
 import json
@@ -16,20 +16,25 @@ import traceback
 
 from vimma import vmutil
 from vimma.actions import Actions
+from vimma.apicache import CachedResponseMixin, invalidate_projects
 from vimma.audit import Auditor
+from vimma.celeryconfig import PRIORITY_INTERACTIVE
+from vimma.conditional import ConditionalGetMixin
+import vimma.events
 import vimma.expiry
+import vimma.projection
 from vimma.models import (
     Schedule, TimeZone, Project, Provider, DummyProvider, AWSProvider,
     VMConfig, DummyVMConfig, AWSVMConfig,
     User, VM, DummyVM, AWSVM,
     Audit, PowerLog, Expiration, VMExpiration, FirewallRuleExpiration,
-    FirewallRule, AWSFirewallRule,
+    FirewallRule, AWSFirewallRule, VMUptime, ProjectUptime,
 )
 from vimma.util import (
-        can_do, login_required_or_forbidden, get_http_json_err,
-        retry_in_transaction,
+        can_do, get_project_ids, login_required_or_forbidden,
+        get_http_json_err, retry_in_transaction,
 )
-from vimmasite.pagination import VimmaPagination
+from vimmasite.pagination import TimestampKeysetPagination, VimmaPagination
 
 
 aud = Auditor(__name__)
@@ -51,7 +56,8 @@ class TimeZoneSerializer(serializers.ModelSerializer):
     class Meta:
         model = TimeZone
 
-class TimeZoneViewSet(viewsets.ReadOnlyModelViewSet):
+class TimeZoneViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
+    version_names = ('timezone',)
     serializer_class = TimeZoneSerializer
     queryset = TimeZone.objects.all()
     filter_backends = (filters.OrderingFilter,)
@@ -71,7 +77,8 @@ class ScheduleSerializer(serializers.ModelSerializer):
     class Meta:
         model = Schedule
 
-class ScheduleViewSet(viewsets.ModelViewSet):
+class ScheduleViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
+    version_names = ('schedule',)
     serializer_class = ScheduleSerializer
     queryset = Schedule.objects.all()
     permission_classes = (IsAuthenticated, SchedulePermission,)
@@ -83,7 +90,8 @@ class ProjectSerializer(serializers.ModelSerializer):
     class Meta:
         model = Project
 
-class ProjectViewSet(viewsets.ReadOnlyModelViewSet):
+class ProjectViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
+    version_names = ('project', 'perms')
     serializer_class = ProjectSerializer
     filter_backends = (filters.OrderingFilter,)
     ordering = ('name',)
@@ -99,7 +107,8 @@ class ProviderSerializer(serializers.ModelSerializer):
     class Meta:
         model = Provider
 
-class ProviderViewSet(viewsets.ReadOnlyModelViewSet):
+class ProviderViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
+    version_names = ('provider',)
     serializer_class = ProviderSerializer
     queryset = Provider.objects.all()
     filter_backends = (filters.OrderingFilter,)
@@ -129,7 +138,8 @@ class VMConfigSerializer(serializers.ModelSerializer):
     class Meta:
         model = VMConfig
 
-class VMConfigViewSet(viewsets.ReadOnlyModelViewSet):
+class VMConfigViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
+    version_names = ('vmconfig',)
     serializer_class = VMConfigSerializer
     queryset = VMConfig.objects.all()
     filter_backends = (filters.OrderingFilter,)
@@ -147,7 +157,9 @@ class AWSVMConfigSerializer(serializers.ModelSerializer):
     class Meta:
         model = AWSVMConfig
 
-class AWSVMConfigViewSet(viewsets.ReadOnlyModelViewSet):
+class AWSVMConfigViewSet(ConditionalGetMixin,
+        viewsets.ReadOnlyModelViewSet):
+    version_names = ('awsvmconfig',)
     serializer_class = AWSVMConfigSerializer
     queryset = AWSVMConfig.objects.all()
     filter_backends = (filters.DjangoFilterBackend,)
@@ -158,7 +170,7 @@ class VMSerializer(serializers.ModelSerializer):
     class Meta:
         model = VM
 
-class VMViewSet(viewsets.ReadOnlyModelViewSet):
+class VMViewSet(CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = VMSerializer
     filter_backends = (filters.DjangoFilterBackend,)
     filter_fields = ('project',)
@@ -172,8 +184,7 @@ class VMViewSet(viewsets.ReadOnlyModelViewSet):
         # by comparing objects instead of integers:
         #return VM.objects.filter(project__in=user.projects.filter())
 
-        projects = user.projects.all()
-        prj_ids = [p.id for p in projects]
+        prj_ids = get_project_ids(user)
         return VM.objects.filter(project__id__in=prj_ids)
 
 
@@ -181,7 +192,7 @@ class DummyVMSerializer(serializers.ModelSerializer):
     class Meta:
         model = DummyVM
 
-class DummyVMViewSet(viewsets.ReadOnlyModelViewSet):
+class DummyVMViewSet(CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = DummyVMSerializer
     filter_backends = (filters.DjangoFilterBackend,)
     filter_fields = ('vm',)
@@ -191,8 +202,7 @@ class DummyVMViewSet(viewsets.ReadOnlyModelViewSet):
         if can_do(user, Actions.READ_ANY_PROJECT):
             return DummyVM.objects.filter()
 
-        projects = user.projects.all()
-        prj_ids = [p.id for p in projects]
+        prj_ids = get_project_ids(user)
         return DummyVM.objects.filter(vm__project__id__in=prj_ids)
 
 
@@ -200,7 +210,7 @@ class AWSVMSerializer(serializers.ModelSerializer):
     class Meta:
         model = AWSVM
 
-class AWSVMViewSet(viewsets.ReadOnlyModelViewSet):
+class AWSVMViewSet(CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = AWSVMSerializer
     filter_backends = (filters.DjangoFilterBackend,)
     filter_fields = ('vm', 'name')
@@ -210,30 +220,56 @@ class AWSVMViewSet(viewsets.ReadOnlyModelViewSet):
         if can_do(user, Actions.READ_ANY_PROJECT):
             return AWSVM.objects.filter()
 
-        projects = user.projects.all()
-        prj_ids = [p.id for p in projects]
+        prj_ids = get_project_ids(user)
         return AWSVM.objects.filter(vm__project__id__in=prj_ids)
 
 
+def get_permitted_vm_param(request, prj_ids):
+    """
+    Return the ‘vm’ query param as an int if it's a VM in prj_ids, else None.
+
+    When the list is filtered to a single VM the user may see, the project
+    filters can be skipped so the DB can scan the (vm, timestamp) index.
+    """
+    try:
+        vm_id = int(request.QUERY_PARAMS.get('vm', ''))
+    except ValueError:
+        return None
+    if VM.objects.filter(id=vm_id, project__id__in=prj_ids).exists():
+        return vm_id
+    return None
+
+
 class AuditSerializer(serializers.ModelSerializer):
     class Meta:
         model = Audit
 
 class AuditViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = AuditSerializer
-    filter_backends = (filters.DjangoFilterBackend, filters.OrderingFilter)
+    filter_backends = (filters.DjangoFilterBackend,)
     filter_fields = ('vm', 'user')
-    ordering = ('-timestamp')
+    # orders by (-timestamp, -id)
+    pagination_class = TimestampKeysetPagination
 
     def get_queryset(self):
         user = self.request.user
         if can_do(user, Actions.READ_ALL_AUDITS):
             queryset = Audit.objects.filter()
         else:
-            projects = user.projects.all()
-            prj_ids = [p.id for p in projects]
-            queryset = Audit.objects.filter(Q(vm__project__id__in=prj_ids) |
-                    Q(user__id=user.id))
+            prj_ids = sorted(get_project_ids(user))
+            vm_id = get_permitted_vm_param(self.request, prj_ids)
+            if vm_id is not None:
+                # filter here too, not only in the filter backend, so the
+                # permission check can't be bypassed
+                queryset = Audit.objects.filter(vm__id=vm_id)
+            else:
+                # A subquery on VM instead of joining it, so each side of the
+                # OR can use its own (vm, timestamp) or (user, timestamp)
+                # index.
+                vm_ids = VM.objects.filter(project__id__in=prj_ids).values(
+                        'id')
+                queryset = Audit.objects.filter(Q(vm__id__in=vm_ids) |
+                        Q(user__id=user.id))
 
         min_lvl = self.request.QUERY_PARAMS.get('min_level', None)
         if min_lvl is not None:
@@ -251,17 +287,22 @@ class PowerLogSerializer(serializers.ModelSerializer):
 
 class PowerLogViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = PowerLogSerializer
-    filter_backends = (filters.DjangoFilterBackend, filters.OrderingFilter)
+    filter_backends = (filters.DjangoFilterBackend,)
     filter_fields = ('vm',)
-    ordering = ('-timestamp',)
+    # orders by (-timestamp, -id)
+    pagination_class = TimestampKeysetPagination
 
     def get_queryset(self):
         user = self.request.user
         if can_do(user, Actions.READ_ALL_POWER_LOGS):
             return PowerLog.objects.filter()
         else:
-            projects = user.projects.all()
-            prj_ids = [p.id for p in projects]
+            prj_ids = sorted(get_project_ids(user))
+            vm_id = get_permitted_vm_param(self.request, prj_ids)
+            if vm_id is not None:
+                # filter here too, not only in the filter backend, so the
+                # permission check can't be bypassed
+                return PowerLog.objects.filter(vm__id=vm_id)
             return PowerLog.objects.filter(vm__project__id__in=prj_ids)
 
 
@@ -274,7 +315,7 @@ class ExpirationSerializer(serializers.ModelSerializer):
                 'grace_end_action_performed',
                 'vmexpiration', 'firewallruleexpiration')
 
-class ExpirationViewSet(viewsets.ReadOnlyModelViewSet):
+class ExpirationViewSet(CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = ExpirationSerializer
 
     def get_vm_Q(self):
@@ -285,8 +326,7 @@ class ExpirationViewSet(viewsets.ReadOnlyModelViewSet):
         if can_do(user, Actions.READ_ANY_PROJECT):
             return Q(type=Expiration.TYPE_VM)
 
-        projects = user.projects.all()
-        prj_ids = [p.id for p in projects]
+        prj_ids = get_project_ids(user)
         return Q(type=Expiration.TYPE_VM,
                 vmexpiration__vm__project__id__in=prj_ids)
 
@@ -298,8 +338,7 @@ class ExpirationViewSet(viewsets.ReadOnlyModelViewSet):
         if can_do(user, Actions.READ_ANY_PROJECT):
             return Q(type=Expiration.TYPE_FIREWALL_RULE)
 
-        projects = user.projects.all()
-        prj_ids = [p.id for p in projects]
+        prj_ids = get_project_ids(user)
         return Q(type=Expiration.TYPE_FIREWALL_RULE,
                 firewallruleexpiration__firewallrule__vm__project__id__in=prj_ids)
 
@@ -312,7 +351,7 @@ class VMExpirationSerializer(serializers.ModelSerializer):
     class Meta:
         model = VMExpiration
 
-class VMExpirationViewSet(viewsets.ReadOnlyModelViewSet):
+class VMExpirationViewSet(CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = VMExpirationSerializer
     filter_backends = (filters.DjangoFilterBackend,)
     filter_fields = ('vm',)
@@ -323,8 +362,7 @@ class VMExpirationViewSet(viewsets.ReadOnlyModelViewSet):
         if can_do(user, Actions.READ_ANY_PROJECT):
             return VMExpiration.objects.filter()
 
-        projects = user.projects.all()
-        prj_ids = [p.id for p in projects]
+        prj_ids = get_project_ids(user)
         return VMExpiration.objects.filter(vm__project__id__in=prj_ids)
 
 
@@ -332,7 +370,8 @@ class FirewallRuleExpirationSerializer(serializers.ModelSerializer):
     class Meta:
         model = FirewallRuleExpiration
 
-class FirewallRuleExpirationViewSet(viewsets.ReadOnlyModelViewSet):
+class FirewallRuleExpirationViewSet(CachedResponseMixin,
+        viewsets.ReadOnlyModelViewSet):
     serializer_class = FirewallRuleExpirationSerializer
     filter_backends = (filters.DjangoFilterBackend,)
     filter_fields = ('firewallrule',)
@@ -343,8 +382,7 @@ class FirewallRuleExpirationViewSet(viewsets.ReadOnlyModelViewSet):
         if can_do(user, Actions.READ_ANY_PROJECT):
             return FirewallRuleExpiration.objects.filter()
 
-        projects = user.projects.all()
-        prj_ids = [p.id for p in projects]
+        prj_ids = get_project_ids(user)
         return FirewallRuleExpiration.objects.filter(
                 firewallrule__vm__project__id__in=prj_ids)
 
@@ -353,7 +391,7 @@ class FirewallRuleSerializer(serializers.ModelSerializer):
     class Meta:
         model = FirewallRule
 
-class FirewallRuleViewSet(viewsets.ReadOnlyModelViewSet):
+class FirewallRuleViewSet(CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = FirewallRuleSerializer
     filter_backends = (filters.DjangoFilterBackend,)
     filter_fields = ('vm',)
@@ -363,8 +401,7 @@ class FirewallRuleViewSet(viewsets.ReadOnlyModelViewSet):
         if can_do(user, Actions.READ_ANY_PROJECT):
             return FirewallRule.objects.filter()
 
-        projects = user.projects.all()
-        prj_ids = [p.id for p in projects]
+        prj_ids = get_project_ids(user)
         return FirewallRule.objects.filter(vm__project__id__in=prj_ids)
 
 
@@ -372,7 +409,8 @@ class AWSFirewallRuleSerializer(serializers.ModelSerializer):
     class Meta:
         model = AWSFirewallRule
 
-class AWSFirewallRuleViewSet(viewsets.ReadOnlyModelViewSet):
+class AWSFirewallRuleViewSet(CachedResponseMixin,
+        viewsets.ReadOnlyModelViewSet):
     serializer_class = AWSFirewallRuleSerializer
     filter_backends = (filters.DjangoFilterBackend,)
     filter_fields = ('firewallrule',)
@@ -382,8 +420,7 @@ class AWSFirewallRuleViewSet(viewsets.ReadOnlyModelViewSet):
         if can_do(user, Actions.READ_ANY_PROJECT):
             return AWSFirewallRule.objects.filter()
 
-        projects = user.projects.all()
-        prj_ids = [p.id for p in projects]
+        prj_ids = get_project_ids(user)
         return AWSFirewallRule.objects.filter(
                 firewallrule__vm__project__id__in=prj_ids)
 
@@ -392,6 +429,79 @@ aws_firewall_rule_protocol_choices_json = json.dumps([
     for c in AWSFirewallRule.IP_PROTOCOL_CHOICES])
 
 
+class NestedExpirationSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Expiration
+        fields = ('id', 'expires_at', 'last_notification',
+                'grace_end_action_performed')
+
+class FirewallRuleDetailSerializer(serializers.ModelSerializer):
+    awsfirewallrule = AWSFirewallRuleSerializer(read_only=True)
+    expiration = NestedExpirationSerializer(
+            source='firewallruleexpiration.expiration', read_only=True)
+
+    class Meta:
+        model = FirewallRule
+
+class VMDetailSerializer(serializers.ModelSerializer):
+    """
+    A VM with its provider-specific object, expiration, firewall rules and
+    latest PowerLog (null if any of these don't exist).
+    """
+    dummyvm = DummyVMSerializer(read_only=True)
+    awsvm = AWSVMSerializer(read_only=True)
+    expiration = NestedExpirationSerializer(
+            source='vmexpiration.expiration', read_only=True)
+    firewallrules = FirewallRuleDetailSerializer(source='firewallrule_set',
+            many=True, read_only=True)
+    latest_powerlog = PowerLogSerializer(read_only=True)
+
+    class Meta:
+        model = VM
+
+class VMDetailViewSet(VMViewSet):
+    """
+    VMs with their related objects, in a fixed number of queries per page.
+
+    Saves clients from fetching the awsvm, vmexpiration, firewallrule etc.
+    endpoints for each VM.
+    """
+    serializer_class = VMDetailSerializer
+    # the latest PowerLog changes too often
+    cache_responses = False
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('dummyvm', 'awsvm',
+                'vmexpiration__expiration').prefetch_related(
+                        Prefetch('firewallrule_set',
+                            queryset=FirewallRule.objects.select_related(
+                                'awsfirewallrule',
+                                'firewallruleexpiration__expiration')))
+
+    def set_latest_powerlogs(self, vms):
+        """
+        Set .latest_powerlog (PowerLog or None) on each VM in vms.
+        """
+        latest_ids = [x['latest_id'] for x in PowerLog.objects.filter(
+            vm__id__in=[vm.id for vm in vms]).values('vm').annotate(
+                latest_id=Max('id'))]
+        by_vm = {pl.vm_id: pl for pl in PowerLog.objects.filter(
+            id__in=latest_ids)}
+        for vm in vms:
+            vm.latest_powerlog = by_vm.get(vm.id)
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None:
+            self.set_latest_powerlogs(page)
+        return page
+
+    def get_object(self):
+        vm = super().get_object()
+        self.set_latest_powerlogs([vm])
+        return vm
+
+
 @login_required_or_forbidden
 def index(request):
     """
@@ -410,9 +520,160 @@ def base_js(request):
         'audit_level_choices_json': audit_levels_json,
         'aws_firewall_rule_protocol_choices_json':
         aws_firewall_rule_protocol_choices_json,
+        'event_stream': settings.EVENT_STREAM,
     }, content_type='application/javascript; charset=utf-8')
 
 
+@login_required_or_forbidden
+def vm_events(request):
+    """
+    Server-Sent Events stream of changes to VMs the user may see.
+
+    Each ‘vm’ event's data is JSON with a ‘vm’ id and a ‘type’:
+    ‘state’, ‘powerlog’ or ‘audit’. See vimma.events.
+    """
+    if not settings.EVENT_STREAM:
+        return get_http_json_err('The event stream is disabled',
+                status.HTTP_404_NOT_FOUND)
+    if request.method != 'GET':
+        return get_http_json_err('Method “' + request.method +
+            '” not allowed. Use GET instead.',
+            status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    if can_do(request.user, Actions.READ_ANY_PROJECT):
+        prj_ids = None
+    else:
+        prj_ids = get_project_ids(request.user)
+    response = StreamingHttpResponse(vimma.events.event_stream(prj_ids),
+            content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # don't let nginx buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@login_required_or_forbidden
+def uptime(request):
+    """
+    Powered-on seconds per VM or project, from the daily uptime rollups.
+
+    GET parameters:
+    scope: ‘vm’ or ‘project’ (default)
+    from, to: first and last day (inclusive), YYYY-MM-DD, UTC
+    group: ‘day’ (default), ‘month’ or ‘total’ for the whole date range
+    vm, project: only these VMs (scope ‘vm’ only) or projects (may be
+    repeated)
+
+    Responds with {results: [{vm or project: id, day: 'YYYY-MM-DD' or
+    month: 'YYYY-MM' (unless group is total), powered_on_secs: int}]}.
+    """
+    if request.method != 'GET':
+        return get_http_json_err('Method “' + request.method +
+            '” not allowed. Use GET instead.',
+            status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    scope = request.GET.get('scope', 'project')
+    group = request.GET.get('group', 'day')
+    if scope not in ('vm', 'project') or group not in ('day', 'month',
+            'total'):
+        return get_http_json_err('Invalid scope or group',
+                status.HTTP_400_BAD_REQUEST)
+
+    if scope == 'vm':
+        qs = VMUptime.objects.filter()
+        lookups = {'vm': 'vm__id__in', 'project': 'vm__project__id__in'}
+    else:
+        if 'vm' in request.GET:
+            return get_http_json_err('Filtering by vm needs scope=vm',
+                    status.HTTP_400_BAD_REQUEST)
+        qs = ProjectUptime.objects.filter()
+        lookups = {'project': 'project__id__in'}
+    try:
+        if 'from' in request.GET:
+            qs = qs.filter(day__gte=datetime.datetime.strptime(
+                request.GET['from'], '%Y-%m-%d').date())
+        if 'to' in request.GET:
+            qs = qs.filter(day__lte=datetime.datetime.strptime(
+                request.GET['to'], '%Y-%m-%d').date())
+        for param, lookup in lookups.items():
+            ids = [int(x) for x in request.GET.getlist(param)]
+            if ids:
+                qs = qs.filter(**{lookup: ids})
+    except ValueError as e:
+        return get_http_json_err('{}'.format(e), status.HTTP_400_BAD_REQUEST)
+    if not can_do(request.user, Actions.READ_ALL_POWER_LOGS):
+        qs = qs.filter(**{lookups['project']: get_project_ids(request.user)})
+
+    key = scope + '_id'
+    if group == 'total':
+        results = [{scope: r[key], 'powered_on_secs': r['total']}
+                for r in qs.values(key).annotate(total=Sum('powered_on_secs'))
+                .order_by(key)]
+    else:
+        sums = {}
+        for obj_id, day, secs in qs.order_by(key, 'day').values_list(key,
+                'day', 'powered_on_secs').iterator():
+            period = (day.isoformat() if group == 'day'
+                    else day.strftime('%Y-%m'))
+            sums[obj_id, period] = sums.get((obj_id, period), 0) + secs
+        results = [{scope: obj_id, group: period, 'powered_on_secs': secs}
+                for (obj_id, period), secs in sorted(sums.items())]
+
+    return HttpResponse(json.dumps({'results': results}),
+            content_type='application/json')
+
+
+@login_required_or_forbidden
+def projection(request):
+    """
+    Projected powered-on hours and cost of VMs for the coming weeks.
+
+    GET parameters: weeks (default 4), project (may be repeated).
+    Or a JSON POST body, to preview schedule changes:
+    {
+        weeks: int,
+        project: [int, …],
+        schedules: {scheduleid: matrix, …},  // instead of the saved ones
+    }
+
+    Responds with {weeks: int, vms: [{vm, project, hours, cost}],
+    projects: {projectid: {hours, cost}}, total: {hours, cost}}.
+    """
+    if request.method == 'GET':
+        params = {'weeks': request.GET.get('weeks', 4),
+                'project': request.GET.getlist('project')}
+    elif request.method == 'POST':
+        params = json.loads(request.read().decode('utf-8'))
+    else:
+        return get_http_json_err('Method “' + request.method +
+            '” not allowed. Use GET or POST instead.',
+            status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    try:
+        weeks = int(params.get('weeks', 4))
+        project_ids = {int(x) for x in params.get('project', [])}
+        matrices = vimma.projection.parse_schedule_matrices(
+                params.get('schedules', {}))
+    except (ValueError, TypeError, AttributeError, ValidationError) as e:
+        return get_http_json_err('{}'.format(e), status.HTTP_400_BAD_REQUEST)
+    if not 0 < weeks <= settings.PROJECTION_MAX_WEEKS:
+        return get_http_json_err('weeks must be between 1 and {}'.format(
+            settings.PROJECTION_MAX_WEEKS), status.HTTP_400_BAD_REQUEST)
+
+    vm_filter = Q()
+    if project_ids:
+        vm_filter &= Q(project__id__in=project_ids)
+    if not can_do(request.user, Actions.READ_ANY_PROJECT):
+        vm_filter &= Q(project__id__in=get_project_ids(request.user))
+
+    vms = vimma.projection.project_vms(vm_filter, weeks,
+            schedule_matrices=matrices)
+    projects, total = vimma.projection.summarize(vms)
+    return HttpResponse(json.dumps({'weeks': weeks, 'vms': vms,
+        'projects': projects, 'total': total}),
+        content_type='application/json')
+
+
 # Allow unauthenticated access in order to easily test with browser automation
 #@login_required_or_forbidden
 def test(request):
@@ -667,6 +928,86 @@ def destroy_vm(request):
         return get_http_json_err(msg, status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@login_required_or_forbidden
+def bulk_vm_action(request):
+    """
+    Power on, power off, reboot or destroy several VMs.
+
+    JSON request body, with either vmids or project:
+    {
+        action: 'power-on', 'power-off', 'reboot' or 'destroy',
+        vmids: [int, …],
+        project: int,   // all VMs in the project which aren't destroyed
+    }
+
+    Responds with {results: {vmid: null if OK, else an error string}}.
+    """
+    if request.method != 'POST':
+        return get_http_json_err('Method “' + request.method +
+            '” not allowed. Use POST instead.',
+            status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    try:
+        body = json.loads(request.read().decode('utf-8'))
+        action = body['action']
+        if 'vmids' in body:
+            vm_ids = {int(x) for x in body['vmids']}
+            vms = VM.objects.filter(id__in=vm_ids)
+        else:
+            vm_ids = set()
+            vms = VM.objects.filter(project__id=int(body['project']),
+                    destroyed_at=None)
+    except KeyError as e:
+        return get_http_json_err('Missing {}'.format(e),
+                status.HTTP_400_BAD_REQUEST)
+    except (ValueError, TypeError, AttributeError) as e:
+        return get_http_json_err('{}'.format(e), status.HTTP_400_BAD_REQUEST)
+    if action not in vmutil.BULK_VM_ACTIONS:
+        return get_http_json_err('Unknown action “{}”'.format(action),
+                status.HTTP_400_BAD_REQUEST)
+
+    results = {vm_id: 'Not found' for vm_id in vm_ids}
+    ok_ids = []
+    for vm in vms.select_related('project'):
+        if vm.destroyed_at:
+            results[vm.id] = 'Already destroyed'
+        elif can_do(request.user,
+                Actions.POWER_ONOFF_REBOOT_DESTROY_VM_IN_PROJECT,
+                vm.project):
+            results[vm.id] = None
+            ok_ids.append(vm.id)
+        else:
+            results[vm.id] = 'You may not {} VMs in this project'.format(
+                    action.replace('-', ' '))
+
+    if action == 'destroy' and ok_ids:
+        def mark_destroy_request():
+            now = datetime.datetime.utcnow().replace(tzinfo=utc)
+            # save() each VM, not update(), so post_save receivers run
+            for vm in VM.objects.filter(id__in=ok_ids):
+                vm.destroy_request_at = now
+                vm.destroy_request_by = request.user
+                vm.full_clean()
+                vm.save()
+        retry_in_transaction(mark_destroy_request)
+
+    if ok_ids and request.META['SERVER_NAME'] != "testserver":
+        # Don't perform the action when running tests
+        try:
+            aud.debug('Request to {} {} VMs'.format(action, len(ok_ids)),
+                    user_id=request.user.id)
+            vmutil.bulk_vm_action(action, ok_ids, user_id=request.user.id)
+        except:
+            lines = traceback.format_exception_only(*sys.exc_info()[:2])
+            msg = ''.join(lines)
+            aud.error(msg, user_id=request.user.id)
+            return get_http_json_err(msg,
+                    status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    return HttpResponse(json.dumps({'results': results}),
+            content_type='application/json')
+
+
 @login_required_or_forbidden
 def override_schedule(request):
     """
@@ -728,7 +1069,7 @@ def override_schedule(request):
             return HttpResponse()
 
         # the update task triggers a power on/off if needed
-        vmutil.update_vm_status.delay(vm.id)
+        vmutil.request_status_update(vm.id, priority=PRIORITY_INTERACTIVE)
 
         return HttpResponse()
     except:
@@ -792,7 +1133,8 @@ def change_vm_schedule(request):
         # Just in case this lambda could cause retry_in_transaction(…)
         # to re-execute this function, don't run the lambda here but return it
         # to our caller.
-        return HttpResponse(), lambda: vmutil.update_vm_status.delay(vm_id)
+        return HttpResponse(), lambda: vmutil.request_status_update(vm_id,
+                priority=PRIORITY_INTERACTIVE)
 
     try:
         response, callback = retry_in_transaction(call)
@@ -845,7 +1187,13 @@ def set_expiration(request):
             exp = Expiration.objects.get(id=exp_id)
             exp.expires_at = aware
             if exp.type == Expiration.TYPE_VM:
-                vm_id = exp.vmexpiration.vm.id
+                vm = exp.vmexpiration.vm
+                vm_id = vm.id
+                # let vmutil.dispatch_power_transitions re-check the VM
+                VM.objects.filter(id=vm_id).update(
+                        next_transition_at=datetime.datetime.utcnow()
+                        .replace(tzinfo=utc))
+                invalidate_projects([vm.project_id])
             exp.save()
         retry_in_transaction(call)
 
@@ -1,77 +1,229 @@
-import boto.ec2, boto.route53, boto.vpc
+import boto.ec2, boto.exception, boto.route53, boto.vpc
+from boto.exception import EC2ResponseError
+from boto.route53.record import ResourceRecordSets
+from boto.route53.zone import Zone
 import celery.exceptions
+import contextlib
 import datetime
 from django.conf import settings
 from django.db import transaction
+from django.db.models import CharField, F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.timezone import utc
+import json
 import random
+import redis
 import sys
+import threading
+import time
 import traceback
 
+from vimma.apicache import invalidate_projects
 from vimma.audit import Auditor
 from vimma.celery import app
+from vimma.events import publish_vm_event, publish_vm_events
 from vimma.models import (
     VM,
-    AWSVMConfig, AWSVM,
+    AWSProvider, AWSVMConfig, AWSVM,
     FirewallRule, AWSFirewallRule,
     Expiration, FirewallRuleExpiration,
 )
-from vimma.util import retry_in_transaction, set_vm_status_updated_at_now
+import vimma.ratelimit
+from vimma.util import (
+    case_by_id, retry_in_transaction, set_vm_status_updated_at_now,
+)
 import vimma.vmutil
 
 
 aud = Auditor(__name__)
 
 
+_SERVICE_MODULES = {
+    'ec2': boto.ec2,
+    'route53': boto.route53,
+    'vpc': boto.vpc,
+}
+
+# {service: the API family whose rate limit it counts against}
+_RATE_LIMIT_FAMILIES = {
+    'ec2': 'ec2',
+    'route53': 'route53',
+    'vpc': 'ec2',
+}
+
+# Boto connections aren't thread-safe, so each thread has its own cache:
+# {(aws_prov_id, region, service): [(key_id, key_secret), conn, last_used]}
+_conn_cache = threading.local()
+
+
+@receiver(post_save, sender=AWSProvider)
+@receiver(post_delete, sender=AWSProvider)
+def _discard_provider_connections(sender, instance, **kwargs):
+    conns = getattr(_conn_cache, 'conns', {})
+    for k in [k for k in conns if k[0] == instance.id]:
+        conns.pop(k)[1].close()
+
+
+def _rate_limit(conn, service, region, access_key_id):
+    """
+    Make conn take a token from its (API family, account, region) bucket
+    before each API call, see settings.AWS_RATE_LIMITS.
+    """
+    family = _RATE_LIMIT_FAMILIES[service]
+    limit = settings.AWS_RATE_LIMITS.get(family)
+    if limit is None:
+        return
+    if family == 'route53':
+        # Route53 is global, its limits are per account
+        region = 'global'
+    bucket = 'aws:{}:{}:{}'.format(family, access_key_id, region)
+
+    make_request = conn.make_request
+    def rate_limited_make_request(*args, **kwargs):
+        vimma.ratelimit.acquire(bucket, *limit)
+        return make_request(*args, **kwargs)
+    # every boto API call goes through make_request
+    conn.make_request = rate_limited_make_request
+
+
+def get_connection(service, aws_prov_id, region,
+        access_key_id, access_key_secret):
+    """
+    Return a boto connection to service (‘ec2’, ‘route53’ or ‘vpc’) in region.
+
+    Connections are reused (with their HTTP keep-alive connections) across
+    calls and tasks in the same thread. A connection is replaced when the
+    AWSProvider's credentials change and closed after being idle for
+    settings.AWS_CONNECTION_IDLE_SECS.
+    """
+    conns = getattr(_conn_cache, 'conns', None)
+    if conns is None:
+        conns = _conn_cache.conns = {}
+
+    now = time.monotonic()
+    for k, (creds, conn, last_used) in list(conns.items()):
+        if now - last_used > settings.AWS_CONNECTION_IDLE_SECS:
+            del conns[k]
+            conn.close()
+
+    key = (aws_prov_id, region, service)
+    creds = (access_key_id, access_key_secret)
+    entry = conns.get(key)
+    if entry is not None and entry[0] != creds:
+        del conns[key]
+        entry[1].close()
+        entry = None
+    if entry is None:
+        conn = _SERVICE_MODULES[service].connect_to_region(region,
+                aws_access_key_id=access_key_id,
+                aws_secret_access_key=access_key_secret)
+        if conn is None:
+            # unknown region
+            return None
+        _rate_limit(conn, service, region, access_key_id)
+        entry = conns[key] = [creds, conn, now]
+    entry[2] = now
+    return entry[1]
+
+
+# {aws_prov_id: (expires at (time.monotonic()), access key id, secret)}
+_provider_credentials = {}
+# {aws_vm_id: (aws_prov_id, region)}, these never change
+_aws_vm_locations = {}
+
+
+@receiver(post_save, sender=AWSProvider)
+@receiver(post_delete, sender=AWSProvider)
+def _discard_provider_credentials(sender, instance, **kwargs):
+    _provider_credentials.pop(instance.id, None)
+
+
+@receiver(post_save, sender=AWSVM)
+@receiver(post_delete, sender=AWSVM)
+def _discard_aws_vm_location(sender, instance, **kwargs):
+    _aws_vm_locations.pop(instance.id, None)
+
+
+def get_provider_credentials(aws_prov_id):
+    """
+    Return (access key id, access key secret) of the AWSProvider.
+
+    They're cached for settings.AWS_CREDENTIALS_CACHE_SECS, or until the
+    AWSProvider is saved in this process.
+    """
+    now = time.monotonic()
+    entry = _provider_credentials.get(aws_prov_id)
+    if entry is not None and entry[0] > now:
+        return entry[1:]
+
+    def read_data():
+        aws_prov = AWSProvider.objects.get(id=aws_prov_id)
+        return aws_prov.access_key_id, aws_prov.access_key_secret
+    creds = retry_in_transaction(read_data)
+    _provider_credentials[aws_prov_id] = (
+            (now + settings.AWS_CREDENTIALS_CACHE_SECS,) + creds)
+    return creds
+
+
+def _connect_to_aws_vm_region(service, aws_vm_id):
+    """
+    Return a boto connection to service in the given AWS VM's region.
+    """
+    location = _aws_vm_locations.get(aws_vm_id)
+    if location is None:
+        def read_data():
+            return (AWSVM.objects.filter(id=aws_vm_id).values_list(
+                'vm__provider__awsprovider__id', 'region').get())
+        location = _aws_vm_locations[aws_vm_id] = retry_in_transaction(
+                read_data)
+    return _connect_to_aws_provider_region(service, *location)
+
+
 def ec2_connect_to_aws_vm_region(aws_vm_id):
     """
     Return a boto EC2Connection to the given AWS VM's region.
     """
-    def read_data():
-        aws_vm = AWSVM.objects.get(id=aws_vm_id)
-        aws_prov = aws_vm.vm.provider.awsprovider
+    return _connect_to_aws_vm_region('ec2', aws_vm_id)
 
-        return (aws_prov.access_key_id, aws_prov.access_key_secret,
-                aws_vm.region)
-    access_key_id, access_key_secret, region = retry_in_transaction(read_data)
 
-    return boto.ec2.connect_to_region(region,
-            aws_access_key_id=access_key_id,
-            aws_secret_access_key=access_key_secret)
+def _connect_to_aws_provider_region(service, aws_prov_id, region):
+    """
+    Return a boto connection to service in region using the AWSProvider.
+    """
+    return get_connection(service, aws_prov_id, region,
+            *get_provider_credentials(aws_prov_id))
 
 
-def route53_connect_to_aws_vm_region(aws_vm_id):
+def ec2_connect_to_aws_provider_region(aws_prov_id, region):
     """
-    Return a boto Route53Connection to the given AWS VM's region.
+    Return a boto EC2Connection to region using the given AWSProvider.
     """
-    def read_data():
-        aws_vm = AWSVM.objects.get(id=aws_vm_id)
-        aws_prov = aws_vm.vm.provider.awsprovider
+    return _connect_to_aws_provider_region('ec2', aws_prov_id, region)
 
-        return (aws_prov.access_key_id, aws_prov.access_key_secret,
-                aws_vm.region)
-    access_key_id, access_key_secret, region = retry_in_transaction(read_data)
 
-    return boto.route53.connect_to_region(region,
-            aws_access_key_id=access_key_id,
-            aws_secret_access_key=access_key_secret)
+def route53_connect_to_aws_provider(aws_prov_id):
+    """
+    Return a boto Route53Connection using the given AWSProvider.
+
+    Route53 is global, so all regions share this connection.
+    """
+    return _connect_to_aws_provider_region('route53', aws_prov_id,
+            'universal')
 
 
-def vpc_connect_to_aws_vm_region(aws_vm_id):
+def route53_connect_to_aws_vm_region(aws_vm_id):
     """
-    Return a boto VPCConnection to the given AWS VM's region.
+    Return a boto Route53Connection to the given AWS VM's region.
     """
-    def read_data():
-        aws_vm = AWSVM.objects.get(id=aws_vm_id)
-        aws_prov = aws_vm.vm.provider.awsprovider
+    return _connect_to_aws_vm_region('route53', aws_vm_id)
 
-        return (aws_prov.access_key_id, aws_prov.access_key_secret,
-                aws_vm.region)
-    access_key_id, access_key_secret, region = retry_in_transaction(read_data)
 
-    return boto.vpc.connect_to_region(region,
-            aws_access_key_id=access_key_id,
-            aws_secret_access_key=access_key_secret)
+def vpc_connect_to_aws_vm_region(aws_vm_id):
+    """
+    Return a boto VPCConnection to the given AWS VM's region.
+    """
+    return _connect_to_aws_vm_region('vpc', aws_vm_id)
 
 
 def create_vm(vmconfig, vm, data, user_id):
@@ -89,7 +241,8 @@ def create_vm(vmconfig, vm, data, user_id):
     aws_vm_config = vmconfig.awsvmconfig
 
     aws_vm = AWSVM.objects.create(vm=vm, name=data['name'],
-            region=aws_vm_config.region)
+            region=aws_vm_config.region,
+            instance_type=aws_vm_config.instance_type)
     aws_vm.full_clean()
 
     callables = [lambda: do_create_vm.delay(aws_vm_config.id,
@@ -213,49 +366,68 @@ def do_create_vm_impl(aws_vm_config_id, root_device_size,
             'VimmaSpawned': str(True),
         })
 
-    route53_add.delay(vm_id, user_id=user_id)
+    request_route53_add(vm_id, user_id=user_id)
 
 
-@app.task
-def power_on_vm(vm_id, user_id=None):
+@contextlib.contextmanager
+def _retry_when_rate_limited(task):
+    """
+    Let rate limited API calls in the with-block raise instead of waiting
+    long (see vimma.ratelimit.raise_over_max_wait) and retry the bound task
+    later if they do.
+    """
+    with vimma.ratelimit.raise_over_max_wait():
+        try:
+            yield
+        except vimma.ratelimit.RateLimitExceeded as e:
+            # spread out the retries of tasks which failed together
+            raise task.retry(exc=e, countdown=random.uniform(.5, 1.5) *
+                    task.default_retry_delay)
+
+
+@app.task(bind=True, max_retries=12, default_retry_delay=10)
+def power_on_vm(self, vm_id, user_id=None):
     def read_vars():
         aws_vm = VM.objects.get(id=vm_id).awsvm
         aws_vm_id = aws_vm.id
         inst_id = aws_vm.instance_id
         return aws_vm_id, inst_id
 
-    with aud.ctx_mgr(vm_id=vm_id, user_id=user_id):
+    with aud.ctx_mgr(vm_id=vm_id, user_id=user_id), \
+            _retry_when_rate_limited(self):
         aws_vm_id, inst_id = retry_in_transaction(read_vars)
         conn = ec2_connect_to_aws_vm_region(aws_vm_id)
         conn.start_instances(instance_ids=[inst_id])
         aud.info('Started instance', vm_id=vm_id, user_id=user_id)
-        route53_add.delay(vm_id, user_id=user_id)
+        request_route53_add(vm_id, user_id=user_id)
 
 
-@app.task
-def power_off_vm(vm_id, user_id=None):
+@app.task(bind=True, max_retries=12, default_retry_delay=10)
+def power_off_vm(self, vm_id, user_id=None):
     def read_vars():
         aws_vm = VM.objects.get(id=vm_id).awsvm
         aws_vm_id = aws_vm.id
         inst_id = aws_vm.instance_id
         return aws_vm_id, inst_id
 
-    with aud.ctx_mgr(vm_id=vm_id, user_id=user_id):
+    with aud.ctx_mgr(vm_id=vm_id, user_id=user_id), \
+            _retry_when_rate_limited(self):
         aws_vm_id, inst_id = retry_in_transaction(read_vars)
         conn = ec2_connect_to_aws_vm_region(aws_vm_id)
         conn.stop_instances(instance_ids=[inst_id])
         aud.info('Stopped instance', vm_id=vm_id, user_id=user_id)
 
 
-@app.task
-def reboot_vm(vm_id, user_id=None):
+@app.task(bind=True, max_retries=12, default_retry_delay=10)
+def reboot_vm(self, vm_id, user_id=None):
     def read_vars():
         aws_vm = VM.objects.get(id=vm_id).awsvm
         aws_vm_id = aws_vm.id
         inst_id = aws_vm.instance_id
         return aws_vm_id, inst_id
 
-    with aud.ctx_mgr(vm_id=vm_id, user_id=user_id):
+    with aud.ctx_mgr(vm_id=vm_id, user_id=user_id), \
+            _retry_when_rate_limited(self):
         aws_vm_id, inst_id = retry_in_transaction(read_vars)
         conn = ec2_connect_to_aws_vm_region(aws_vm_id)
         conn.reboot_instances(instance_ids=[inst_id])
@@ -288,7 +460,8 @@ def delete_security_group(self, vm_id, user_id=None):
         mark_vm_destroyed_if_needed(aws_vm)
 
     aud_kw = {'vm_id': vm_id, 'user_id': user_id}
-    with aud.celery_retry_ctx_mgr(self, 'delete security group', **aud_kw):
+    with aud.celery_retry_ctx_mgr(self, 'delete security group', **aud_kw), \
+            vimma.ratelimit.raise_over_max_wait():
         aws_vm_id, sec_grp_id = retry_in_transaction(read_vars)
         # check if the VM creation failed to create the security group
         if sec_grp_id:
@@ -314,7 +487,8 @@ def terminate_instance(self, vm_id, user_id=None):
         mark_vm_destroyed_if_needed(aws_vm)
 
     aud_kw = {'vm_id': vm_id, 'user_id': user_id}
-    with aud.celery_retry_ctx_mgr(self, 'terminate instance', **aud_kw):
+    with aud.celery_retry_ctx_mgr(self, 'terminate instance', **aud_kw), \
+            vimma.ratelimit.raise_over_max_wait():
         aws_vm_id, inst_id = retry_in_transaction(read_vars)
         # check if the VM creation failed to create the instance
         if inst_id:
@@ -324,10 +498,19 @@ def terminate_instance(self, vm_id, user_id=None):
     aud.info('Terminated instance {}'.format(inst_id), **aud_kw)
 
 
-@app.task
-def update_vm_status(vm_id):
-    with aud.ctx_mgr(vm_id=vm_id):
-        _update_vm_status_impl(vm_id)
+@app.task(bind=True, max_retries=3, default_retry_delay=30)
+def update_vm_status(self, vm_id, coalesced=False):
+    retrying = False
+    try:
+        with aud.ctx_mgr(vm_id=vm_id), _retry_when_rate_limited(self):
+            _update_vm_status_impl(vm_id)
+    except celery.exceptions.Retry:
+        # the retry keeps the guard and releases it when it finishes
+        retrying = True
+        raise
+    finally:
+        if coalesced and not retrying:
+            vimma.vmutil.status_update_finished(vm_id)
 
 def _update_vm_status_impl(vm_id):
     """
@@ -350,29 +533,48 @@ def _update_vm_status_impl(vm_id):
         new_state = 'Error'
         new_ip_address = None
         new_private_ip_address = None
+        new_instance_type = None
     else:
         inst = instances[0]
         new_state = inst.state
         new_ip_address = inst.ip_address
         new_private_ip_address = inst.private_ip_address
+        new_instance_type = inst.instance_type
 
     def write_data():
         aws_vm = AWSVM.objects.get(id=aws_vm_id)
         aws_vm.state = new_state
         aws_vm.ip_address = new_ip_address or ''
         aws_vm.private_ip_address = new_private_ip_address or ''
+        # fills in VMs created before instance_type was saved
+        aws_vm.instance_type = new_instance_type or aws_vm.instance_type
         aws_vm.save()
     retry_in_transaction(write_data)
     aud.debug('Update state ‘{}’'.format(new_state), vm_id=vm_id)
+    publish_vm_event(vm_id, 'state', state=new_state)
 
     set_vm_status_updated_at_now(vm_id)
+    _power_log_and_switch(vm_id, new_state)
+
+
+def _powered_on_in_state(state):
+    """
+    Return True/False if an instance in AWS state is powered ON/OFF, or None
+    for unknown states.
+    """
+    if state in {'pending', 'running', 'stopping', 'shutting-down'}:
+        return True
+    if state in {'stopped', 'terminated'}:
+        return False
+    return None
 
-    on_states = {'pending', 'running', 'stopping', 'shutting-down'}
-    off_states = {'stopped', 'terminated'}
-    powered_on = (True if new_state in on_states
-            else False if new_state in off_states
-            else None)
-    if type(powered_on) is not bool:
+
+def _power_log_and_switch(vm_id, new_state):
+    """
+    PowerLog the vm and power it on/off if needed, given its AWS state.
+    """
+    powered_on = _powered_on_in_state(new_state)
+    if powered_on is None:
         aud.info('Unknown vm state ‘{}’'.format(new_state), vm_id=vm_id)
         return
     vimma.vmutil.power_log(vm_id, powered_on)
@@ -380,6 +582,200 @@ def _update_vm_status_impl(vm_id):
         vimma.vmutil.switch_on_off(vm_id, powered_on)
 
 
+# The maximum number of instance ids in one DescribeInstances call.
+DESCRIBE_INSTANCES_BATCH_SIZE = 1000
+
+
+@app.task(bind=True, max_retries=3, default_retry_delay=30)
+def update_region_vms_status(self, aws_prov_id, region):
+    """
+    Update the status of all non-destroyed VMs of an AWSProvider in a region.
+
+    Instead of an API call per VM (see update_vm_status) this makes one
+    DescribeInstances call and one DB transaction per batch of VMs.
+    """
+    with aud.ctx_mgr(), _retry_when_rate_limited(self):
+        _update_region_vms_status_impl(aws_prov_id, region)
+
+def _update_region_vms_status_impl(aws_prov_id, region):
+    """
+    The implementation for the similarly named task.
+    """
+    def read_data():
+        return list(AWSVM.objects.filter(vm__destroyed_at=None,
+            vm__provider__awsprovider__id=aws_prov_id, region=region)
+            .values_list('vm_id', 'id', 'instance_id'))
+    rows = retry_in_transaction(read_data)
+
+    for vm_id, aws_vm_id, inst_id in rows:
+        if not inst_id:
+            aud.warning('missing instance_id', vm_id=vm_id)
+    rows = [r for r in rows if r[2]]
+    if not rows:
+        return
+
+    conn = ec2_connect_to_aws_provider_region(aws_prov_id, region)
+    for i in range(0, len(rows), DESCRIBE_INSTANCES_BATCH_SIZE):
+        batch = rows[i:i+DESCRIBE_INSTANCES_BATCH_SIZE]
+        try:
+            instances = conn.get_only_instances(
+                    instance_ids=[r[2] for r in batch])
+        except EC2ResponseError as e:
+            # E.g. InvalidInstanceID.NotFound fails the whole call.
+            # Fall back to updating each VM in this batch separately.
+            aud.warning('DescribeInstances for {} instances failed: {}'
+                    .format(len(batch), e))
+            for vm_id, aws_vm_id, inst_id in batch:
+                vimma.vmutil.request_status_update(vm_id)
+            continue
+        _write_batch_status(batch, {inst.id: inst for inst in instances})
+
+
+def _write_batch_status(batch, instances_by_id):
+    """
+    Save the state of a batch of (vm_id, aws_vm_id, instance_id) rows.
+
+    instances_by_id maps instance ids to the boto Instances returned by AWS.
+    All rows are written with two UPDATE queries in one transaction, then the
+    batch is power-logged and switched on/off with power_log_many(…) and
+    switch_on_off_many(…).
+    """
+    rows_by_aws_vm_id = {r[1]: r for r in batch}
+    # {aws_vm_id: (state, ip_address, private_ip_address, instance_type)}
+    new_values = {}
+    for vm_id, aws_vm_id, inst_id in batch:
+        inst = instances_by_id.get(inst_id)
+        if inst is None:
+            new_values[aws_vm_id] = 'Error', '', '', None
+        else:
+            new_values[aws_vm_id] = (inst.state, inst.ip_address or '',
+                    inst.private_ip_address or '', inst.instance_type)
+
+    def write_data():
+        now = datetime.datetime.utcnow().replace(tzinfo=utc)
+        existing = dict(AWSVM.objects.filter(id__in=rows_by_aws_vm_id)
+                .values_list('id', 'vm__project_id'))
+        # QuerySet.update() sends no post_save signals, the API response
+        # cache is invalidated below
+        AWSVM.objects.filter(id__in=existing).update(
+                state=case_by_id({k: new_values[k][0] for k in existing},
+                    CharField()),
+                ip_address=case_by_id({k: new_values[k][1] for k in existing},
+                    CharField()),
+                private_ip_address=case_by_id(
+                    {k: new_values[k][2] for k in existing}, CharField()),
+                # fills in VMs created before instance_type was saved
+                instance_type=case_by_id({k: new_values[k][3]
+                    for k in existing if new_values[k][3]}, CharField(),
+                    default=F('instance_type')))
+        VM.objects.filter(id__in=[rows_by_aws_vm_id[k][0] for k in existing]
+                ).update(status_updated_at=now)
+        return existing
+    existing = retry_in_transaction(write_data)
+    invalidate_projects(set(existing.values()))
+
+    # {vm_id: (instance id, new state)}
+    new_states = {rows_by_aws_vm_id[k][0]: (rows_by_aws_vm_id[k][2],
+        new_values[k][0]) for k in existing}
+    publish_vm_events([{'vm': vm_id, 'type': 'state', 'state': state}
+        for vm_id, (inst_id, state) in new_states.items()])
+
+    # {vm_id: powered_on}
+    power_states = {}
+    for vm_id, (inst_id, new_state) in sorted(new_states.items()):
+        if new_state == 'Error':
+            aud.warning('AWS returned no instance {}'.format(inst_id),
+                    vm_id=vm_id)
+        aud.debug('Update state ‘{}’'.format(new_state), vm_id=vm_id)
+        powered_on = _powered_on_in_state(new_state)
+        if powered_on is None:
+            aud.info('Unknown vm state ‘{}’'.format(new_state), vm_id=vm_id)
+        else:
+            power_states[vm_id] = powered_on
+
+    if power_states:
+        vimma.vmutil.power_log_many(power_states)
+        vimma.vmutil.switch_on_off_many({vm_id: powered_on
+            for vm_id, powered_on in power_states.items()
+            if new_states[vm_id][1] != 'terminated'})
+
+
+# Route53 counts an UPSERT as 2 of the 1000 records allowed in one
+# ChangeResourceRecordSets call, which also allows 32000 characters of
+# record values.
+ROUTE53_MAX_UPSERTS_PER_BATCH = 500
+ROUTE53_MAX_BATCH_VALUE_CHARS = 32000
+ROUTE53_RECORD_TTL = 60
+
+# {aws_prov_id: (expires at (time.monotonic()), zone name, public zone id,
+# private zone id)}
+_route53_zone_ids = {}
+
+
+@receiver(post_save, sender=AWSProvider)
+@receiver(post_delete, sender=AWSProvider)
+def _discard_provider_route53_zone_ids(sender, instance, **kwargs):
+    _discard_route53_zone_ids(instance.id)
+
+
+def _discard_route53_zone_ids(aws_prov_id):
+    _route53_zone_ids.pop(aws_prov_id, None)
+
+
+def get_route53_zone_ids(r53_conn, aws_prov_id, zone_name):
+    """
+    Return (public zone id, private zone id) for the AWSProvider's zone_name.
+
+    Either is None if there's no such zone. Listing the zones is slow, so the
+    result is cached for settings.AWS_ROUTE53_ZONE_CACHE_SECS.
+    """
+    now = time.monotonic()
+    entry = _route53_zone_ids.get(aws_prov_id)
+    if entry is not None and entry[0] > now and entry[1] == zone_name:
+        return entry[2:]
+
+    priv_zone_id, pub_zone_id = None, None
+    for z in r53_conn.get_zones():
+        if z.name != zone_name:
+            continue
+        if z.config['PrivateZone'] == 'true':
+            priv_zone_id = z.id
+        elif z.config['PrivateZone'] == 'false':
+            pub_zone_id = z.id
+    _route53_zone_ids[aws_prov_id] = (
+            now + settings.AWS_ROUTE53_ZONE_CACHE_SECS, zone_name,
+            pub_zone_id, priv_zone_id)
+    return pub_zone_id, priv_zone_id
+
+
+def _route53_upsert_batches(records):
+    """
+    Split records, tuples ending in a record value, into lists which fit in
+    one ChangeResourceRecordSets call.
+    """
+    batch, chars = [], 0
+    for r in records:
+        if batch and (len(batch) == ROUTE53_MAX_UPSERTS_PER_BATCH or
+                chars + len(r[-1]) > ROUTE53_MAX_BATCH_VALUE_CHARS):
+            yield batch
+            batch, chars = [], 0
+        batch.append(r)
+        chars += len(r[-1])
+    if batch:
+        yield batch
+
+
+def _route53_upsert(r53_conn, zone_id, records):
+    """
+    Create or replace records, [(name, type, value)], in one API call.
+    """
+    changes = ResourceRecordSets(r53_conn, zone_id, comment='Vimma-generated')
+    for name, record_type, value in records:
+        changes.add_change('UPSERT', name, record_type,
+                ttl=ROUTE53_RECORD_TTL).add_value(value)
+    changes.commit()
+
+
 @app.task(bind=True, max_retries=12, default_retry_delay=10)
 def route53_add(self, vm_id, user_id=None):
     """
@@ -397,12 +793,13 @@ def route53_add(self, vm_id, user_id=None):
 
         aws_prov = vm.provider.awsprovider
         route_53_zone = aws_prov.route_53_zone
-        return aws_vm_id, name, inst_id, route_53_zone
+        return aws_vm_id, name, inst_id, aws_prov.id, route_53_zone
 
     aud_kw = {'vm_id': vm_id, 'user_id': user_id}
-    with aud.celery_retry_ctx_mgr(self, 'add route53 cname', **aud_kw):
-        aws_vm_id, name, inst_id, route_53_zone = retry_in_transaction(
-                read_vars)
+    with aud.celery_retry_ctx_mgr(self, 'add route53 cname', **aud_kw), \
+            vimma.ratelimit.raise_over_max_wait():
+        aws_vm_id, name, inst_id, aws_prov_id, route_53_zone = \
+                retry_in_transaction(read_vars)
         vm_cname = (name + '.' + route_53_zone).lower()
 
         ec2_conn = ec2_connect_to_aws_vm_region(aws_vm_id)
@@ -413,46 +810,42 @@ def route53_add(self, vm_id, user_id=None):
             self.retry()
         instance = instances[0]
 
-        r53_conn = route53_connect_to_aws_vm_region(aws_vm_id)
-        priv_zone, pub_zone = None, None
-        for z in r53_conn.get_zones():
-            if z.name != route_53_zone:
-                continue
-            if z.config['PrivateZone'] == 'true':
-                priv_zone = z
-            elif z.config['PrivateZone'] == 'false':
-                pub_zone = z
+        r53_conn = route53_connect_to_aws_provider(aws_prov_id)
+        pub_zone_id, priv_zone_id = get_route53_zone_ids(r53_conn,
+                aws_prov_id, route_53_zone)
 
-        if pub_zone:
+        if pub_zone_id:
             pub_dns_name = instance.public_dns_name
             if not pub_dns_name:
                 aud.warning('No public DNS name for instance {}'.format(
                     inst_id), **aud_kw)
                 self.retry()
 
-            if pub_zone.get_cname(vm_cname, all=True):
-                pub_zone.delete_cname(vm_cname, all=True)
-                aud.info('Removed existing DNS cname ‘{}’'.format(vm_cname),
-                        **aud_kw)
-            pub_zone.add_cname(vm_cname, pub_dns_name,
-                    comment='Vimma-generated')
+            try:
+                _route53_upsert(r53_conn, pub_zone_id,
+                        [(vm_cname, 'CNAME', pub_dns_name)])
+            except boto.exception.BotoServerError:
+                # maybe the zone was deleted
+                _discard_route53_zone_ids(aws_prov_id)
+                raise
             aud.info('Created DNS cname ‘{}’'.format(vm_cname), **aud_kw)
         else:
             aud.warning('No public DNS zone named ‘{}’'.format(route_53_zone),
                     **aud_kw)
 
-        if priv_zone:
+        if priv_zone_id:
             priv_ip = instance.private_ip_address
             if not priv_ip:
                 aud.warning('No private IP address for instance{}'.format(
                     inst_id), **aud_kw)
                 self.retry()
 
-            if priv_zone.get_a(vm_cname, all=True):
-                priv_zone.delete_a(vm_cname, all=True)
-                aud.info('Removed existing A record ‘{}’'.format(vm_cname),
-                        **aud_kw)
-            priv_zone.add_a(vm_cname, priv_ip, comment='Vimma-generated')
+            try:
+                _route53_upsert(r53_conn, priv_zone_id,
+                        [(vm_cname, 'A', priv_ip)])
+            except boto.exception.BotoServerError:
+                _discard_route53_zone_ids(aws_prov_id)
+                raise
             aud.info('Created A record ‘{}’ {}'.format(vm_cname, priv_ip),
                     **aud_kw)
         else:
@@ -471,49 +864,410 @@ def route53_delete(self, vm_id, user_id=None):
     def read_vars():
         vm = VM.objects.get(id=vm_id)
         aws_vm = vm.awsvm
-        aws_vm_id = aws_vm.id
         name = aws_vm.name
 
         aws_prov = vm.provider.awsprovider
         route_53_zone = aws_prov.route_53_zone
-        return aws_vm_id, name, route_53_zone
+        return name, aws_prov.id, route_53_zone
 
     aud_kw = {'vm_id': vm_id, 'user_id': user_id}
-    with aud.celery_retry_ctx_mgr(self, 'delete route53 cname', **aud_kw):
-        aws_vm_id, name, route_53_zone = retry_in_transaction(read_vars)
+    with aud.celery_retry_ctx_mgr(self, 'delete route53 cname', **aud_kw), \
+            vimma.ratelimit.raise_over_max_wait():
+        name, aws_prov_id, route_53_zone = retry_in_transaction(read_vars)
         vm_cname = (name + '.' + route_53_zone).lower()
 
-        r53_conn = route53_connect_to_aws_vm_region(aws_vm_id)
-        priv_zone, pub_zone = None, None
-        for z in r53_conn.get_zones():
-            if z.name != route_53_zone:
+        r53_conn = route53_connect_to_aws_provider(aws_prov_id)
+        pub_zone_id, priv_zone_id = get_route53_zone_ids(r53_conn,
+                aws_prov_id, route_53_zone)
+
+        for zone_id, record_type, desc, zone_desc in (
+                (pub_zone_id, 'CNAME', 'DNS cname', 'public'),
+                (priv_zone_id, 'A', 'A record', 'private')):
+            if not zone_id:
+                aud.warning('No {} DNS zone named ‘{}’'.format(zone_desc,
+                    route_53_zone), **aud_kw)
                 continue
-            if z.config['PrivateZone'] == 'true':
-                priv_zone = z
-            elif z.config['PrivateZone'] == 'false':
-                pub_zone = z
-
-        if pub_zone:
-            if pub_zone.get_cname(vm_cname, all=True):
-                pub_zone.delete_cname(vm_cname, all=True)
-                aud.info('Removed DNS cname ‘{}’'.format(vm_cname), **aud_kw)
+            zone = Zone(r53_conn, {'Id': zone_id, 'Name': route_53_zone})
+            try:
+                # a DELETE must match the record, so it has to be read first
+                record = zone.find_records(vm_cname, record_type, all=True)
+                if record:
+                    zone.delete_record(record)
+            except boto.exception.BotoServerError:
+                _discard_route53_zone_ids(aws_prov_id)
+                raise
+            if record:
+                aud.info('Removed {} ‘{}’'.format(desc, vm_cname), **aud_kw)
             else:
-                aud.warning('DNS cname ‘{}’ does not exist'.format(vm_cname),
+                aud.warning('{} ‘{}’ does not exist'.format(desc, vm_cname),
                         **aud_kw)
-        else:
-            aud.warning('No public DNS zone named ‘{}’'.format(route_53_zone),
-                    **aud_kw)
 
-        if priv_zone:
-            if priv_zone.get_a(vm_cname, all=True):
-                priv_zone.delete_a(vm_cname, all=True)
-                aud.info('Removed A record ‘{}’'.format(vm_cname), **aud_kw)
-            else:
-                aud.warning('DNS A record ‘{}’ does not exist'.format(
-                    vm_cname), **aud_kw)
+
+# The maximum number of instance ids in one Start/Stop/Reboot/Terminate call.
+INSTANCE_ACTION_BATCH_SIZE = 1000
+
+
+def _instances_action(aws_prov_id, region, vm_ids, user_id, conn_method,
+        single_task, aud_msg):
+    """
+    Call conn_method (e.g. 'stop_instances') for the VMs' instances.
+
+    The VMs must belong to the AWSProvider and region. Makes one API call
+    per batch of INSTANCE_ACTION_BATCH_SIZE instances. If a call fails (e.g.
+    because of one bad instance id, a network error or the rate limit)
+    single_task (e.g. power_off_vm) is queued for each VM in that batch
+    instead, and for each VM whose instance is missing from the call's
+    result.
+    Returns (ids of VMs whose instances were acted on, ids of VMs without
+    an instance or not found in the AWSProvider and region).
+    """
+    def read_vars():
+        return list(AWSVM.objects.filter(vm__id__in=vm_ids,
+            vm__provider__awsprovider__id=aws_prov_id, region=region)
+            .values_list('vm_id', 'instance_id'))
+    rows = retry_in_transaction(read_vars)
+
+    found = {r[0] for r in rows}
+    no_instance = ([r[0] for r in rows if not r[1]] +
+            [vm_id for vm_id in vm_ids if vm_id not in found])
+    rows = [r for r in rows if r[1]]
+    if not rows:
+        return [], no_instance
+
+    conn = ec2_connect_to_aws_provider_region(aws_prov_id, region)
+    done = []
+    for i in range(0, len(rows), INSTANCE_ACTION_BATCH_SIZE):
+        batch = rows[i:i+INSTANCE_ACTION_BATCH_SIZE]
+        try:
+            result = getattr(conn, conn_method)(
+                    instance_ids=[r[1] for r in batch])
+        except Exception as e:
+            aud.warning('{} for {} instances failed: {}'.format(conn_method,
+                len(batch), e), user_id=user_id)
+            for vm_id, inst_id in batch:
+                single_task.delay(vm_id, user_id=user_id)
+            continue
+        # Start/Stop/TerminateInstances return the instances they changed,
+        # RebootInstances returns True.
+        if type(result) is list:
+            returned = {inst.id for inst in result}
         else:
-            aud.warning('No private DNS zone named ‘{}’'.format(route_53_zone),
-                    **aud_kw)
+            returned = {r[1] for r in batch}
+        for vm_id, inst_id in batch:
+            if inst_id not in returned:
+                aud.warning('{} did not return instance {}'.format(
+                    conn_method, inst_id), vm_id=vm_id, user_id=user_id)
+                single_task.delay(vm_id, user_id=user_id)
+                continue
+            aud.info(aud_msg, vm_id=vm_id, user_id=user_id)
+            done.append(vm_id)
+    return done, no_instance
+
+
+def _warn_no_instance(vm_ids, user_id):
+    for vm_id in vm_ids:
+        aud.warning('missing instance_id', vm_id=vm_id, user_id=user_id)
+
+
+@app.task
+def power_on_vms(aws_prov_id, region, vm_ids, user_id=None):
+    """
+    Like power_on_vm for many VMs of an AWSProvider in a region.
+    """
+    with aud.ctx_mgr(user_id=user_id):
+        done, no_instance = _instances_action(aws_prov_id, region, vm_ids,
+                user_id, 'start_instances', power_on_vm, 'Started instance')
+        _warn_no_instance(no_instance, user_id)
+        for vm_id in done:
+            request_route53_add(vm_id, user_id=user_id)
+
+
+@app.task
+def power_off_vms(aws_prov_id, region, vm_ids, user_id=None):
+    """
+    Like power_off_vm for many VMs of an AWSProvider in a region.
+    """
+    with aud.ctx_mgr(user_id=user_id):
+        done, no_instance = _instances_action(aws_prov_id, region, vm_ids,
+                user_id, 'stop_instances', power_off_vm, 'Stopped instance')
+        _warn_no_instance(no_instance, user_id)
+
+
+@app.task
+def reboot_vms(aws_prov_id, region, vm_ids, user_id=None):
+    """
+    Like reboot_vm for many VMs of an AWSProvider in a region.
+    """
+    with aud.ctx_mgr(user_id=user_id):
+        done, no_instance = _instances_action(aws_prov_id, region, vm_ids,
+                user_id, 'reboot_instances', reboot_vm, 'Rebooted instance')
+        _warn_no_instance(no_instance, user_id)
+
+
+@app.task
+def destroy_vms(aws_prov_id, region, vm_ids, user_id=None):
+    """
+    Like destroy_vm for many VMs of an AWSProvider in a region.
+
+    The instances are terminated in batches. Every VM whose instance isn't
+    among the terminated ones gets the terminate_instance task. The security
+    group and Route53 record are deleted by the usual per-VM tasks.
+    """
+    def write_instances_terminated(done):
+        for aws_vm in AWSVM.objects.filter(vm__id__in=done).select_related(
+                'vm'):
+            aws_vm.instance_terminated = True
+            aws_vm.full_clean()
+            aws_vm.save()
+            mark_vm_destroyed_if_needed(aws_vm)
+
+    with aud.ctx_mgr(user_id=user_id):
+        done, no_instance = _instances_action(aws_prov_id, region, vm_ids,
+                user_id, 'terminate_instances', terminate_instance,
+                'Terminated instance')
+        retry_in_transaction(lambda: write_instances_terminated(done))
+        # the VM creation failed to create the instance, or the VM isn't in
+        # this provider and region
+        for vm_id in no_instance:
+            terminate_instance.delay(vm_id, user_id=user_id)
+        for vm_id in vm_ids:
+            delete_security_group.delay(vm_id, user_id=user_id)
+            route53_delete.delay(vm_id, user_id=user_id)
+
+
+_BUFFER_KEY_PREFIX = 'vimma:aws:buffer:'
+
+_redis = None
+
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(settings.AWS_COALESCE_REDIS_URL)
+    return _redis
+
+
+def _buffer_request(key, entry):
+    """
+    Append entry (JSON-serializable) to the Redis buffer key.
+
+    Returns True if the buffer has no flush scheduled, so the caller must
+    schedule one. Raises redis.RedisError.
+    """
+    key = _BUFFER_KEY_PREFIX + key
+    pipe = _get_redis().pipeline()
+    pipe.rpush(key, json.dumps(entry))
+    # expires in case the flush task is lost
+    pipe.set(key + ':flush', 1, ex=60, nx=True)
+    return bool(pipe.execute()[1])
+
+
+def _drain_buffer(key):
+    """
+    Remove and return the entries in the Redis buffer key.
+    """
+    key = _BUFFER_KEY_PREFIX + key
+    # requests added from now on schedule another flush
+    _get_redis().delete(key + ':flush')
+    pipe = _get_redis().pipeline()
+    pipe.lrange(key, 0, -1)
+    pipe.delete(key)
+    return [json.loads(e.decode('utf-8')) for e in pipe.execute()[0]]
+
+
+# {action: (task for one VM, task for many VMs of a provider and region)}
+_POWER_ACTION_TASKS = {
+    'power_on': (power_on_vm, power_on_vms),
+    'power_off': (power_off_vm, power_off_vms),
+    'reboot': (reboot_vm, reboot_vms),
+}
+
+
+def _power_buffer_key(aws_prov_id, region, action):
+    return 'power:{}:{}:{}'.format(aws_prov_id, region, action)
+
+
+def request_power_action(vm_id, action, user_id=None):
+    """
+    Power on, power off or reboot (action is a _POWER_ACTION_TASKS key) a VM.
+
+    The request is added to a Redis buffer per AWSProvider, region and
+    action. The first request in an empty buffer schedules
+    flush_power_requests in settings.AWS_POWER_COALESCE_SECS, which makes
+    one API call for all requests buffered by then. Without coalescing
+    (the setting is None) or without Redis this queues the single-VM task.
+    """
+    single_task = _POWER_ACTION_TASKS[action][0]
+    if settings.AWS_POWER_COALESCE_SECS is None:
+        single_task.delay(vm_id, user_id=user_id)
+        return
+
+    def read_vars():
+        return AWSVM.objects.filter(vm__id=vm_id).values_list(
+                'vm__provider__awsprovider__id', 'region').get()
+    aws_prov_id, region = retry_in_transaction(read_vars)
+
+    try:
+        first = _buffer_request(_power_buffer_key(aws_prov_id, region,
+            action), [vm_id, user_id])
+    except redis.RedisError as e:
+        aud.warning('Can\'t buffer {} request: {}'.format(action, e),
+                vm_id=vm_id, user_id=user_id)
+        single_task.delay(vm_id, user_id=user_id)
+        return
+    if first:
+        flush_power_requests.apply_async(args=(aws_prov_id, region, action),
+                countdown=settings.AWS_POWER_COALESCE_SECS)
+
+
+@app.task
+def flush_power_requests(aws_prov_id, region, action):
+    """
+    Perform the buffered requests for action (see request_power_action).
+
+    The requests are grouped by user, so each VM's Audit shows who asked.
+    Each group is queued as a task, so the requests drained from Redis are
+    kept by the broker until a worker acts on them.
+    """
+    by_user = {}
+    for vm_id, user_id in _drain_buffer(_power_buffer_key(aws_prov_id,
+            region, action)):
+        by_user.setdefault(user_id, set()).add(vm_id)
+    batch_task = _POWER_ACTION_TASKS[action][1]
+    for user_id, vm_ids in by_user.items():
+        batch_task.delay(aws_prov_id, region, sorted(vm_ids), user_id=user_id)
+
+
+def request_route53_add(vm_id, user_id=None):
+    """
+    Add the VM's DNS records, like the route53_add task.
+
+    The request is added to a Redis buffer per AWSProvider. The first
+    request in an empty buffer schedules flush_route53_adds in
+    settings.AWS_ROUTE53_COALESCE_SECS, which writes the records of all VMs
+    buffered by then in as few change batches as possible. Without
+    coalescing (the setting is None) or without Redis this queues
+    route53_add.
+    """
+    if settings.AWS_ROUTE53_COALESCE_SECS is None:
+        route53_add.delay(vm_id, user_id=user_id)
+        return
+
+    def read_vars():
+        return VM.objects.filter(id=vm_id).values_list(
+                'provider__awsprovider__id', flat=True).get()
+    aws_prov_id = retry_in_transaction(read_vars)
+
+    try:
+        first = _buffer_request('route53:{}'.format(aws_prov_id),
+                [vm_id, user_id])
+    except redis.RedisError as e:
+        aud.warning('Can\'t buffer route53 request: {}'.format(e),
+                vm_id=vm_id, user_id=user_id)
+        route53_add.delay(vm_id, user_id=user_id)
+        return
+    if first:
+        flush_route53_adds.apply_async(args=(aws_prov_id,),
+                countdown=settings.AWS_ROUTE53_COALESCE_SECS)
+
+
+@app.task
+def flush_route53_adds(aws_prov_id):
+    """
+    Write the DNS records of the VMs buffered by request_route53_add.
+
+    VMs whose instance has no address yet, or whose change batch fails, get
+    a route53_add task, which retries. So do all VMs not done yet if this
+    task fails, as their requests are no longer in Redis.
+    """
+    user_ids = {}
+    for vm_id, user_id in _drain_buffer('route53:{}'.format(aws_prov_id)):
+        user_ids[vm_id] = user_id
+    if not user_ids:
+        return
+
+    # VMs which got a route53_add task
+    failed = set()
+    def fall_back(vm_ids):
+        for vm_id in vm_ids:
+            route53_add.delay(vm_id, user_id=user_ids[vm_id])
+        failed.update(vm_ids)
+
+    with aud.ctx_mgr():
+        try:
+            _write_route53_adds(aws_prov_id, user_ids, failed, fall_back)
+        except:
+            fall_back(set(user_ids) - failed)
+            raise
+
+
+def _write_route53_adds(aws_prov_id, user_ids, failed, fall_back):
+    """
+    The implementation of flush_route53_adds.
+
+    user_ids is {vm_id: user_id}. VMs in failed are skipped, fall_back(vm_ids)
+    gives VMs a route53_add task and adds them to failed.
+    """
+    def read_vars():
+        aws_prov = AWSProvider.objects.get(id=aws_prov_id)
+        rows = list(AWSVM.objects.filter(vm__id__in=user_ids,
+            vm__provider__awsprovider__id=aws_prov_id).values_list(
+                'vm_id', 'name', 'instance_id', 'region'))
+        return aws_prov.route_53_zone, rows
+    route_53_zone, rows = retry_in_transaction(read_vars)
+
+    fall_back(set(user_ids) - {r[0] for r in rows})
+    # [(vm_id, cname, instance)]
+    found = []
+    by_region = {}
+    for vm_id, name, inst_id, region in rows:
+        by_region.setdefault(region, []).append((vm_id, name, inst_id))
+    for region, items in by_region.items():
+        ec2_conn = ec2_connect_to_aws_provider_region(aws_prov_id, region)
+        inst_ids = [i[2] for i in items if i[2]]
+        instances = {}
+        for i in range(0, len(inst_ids), DESCRIBE_INSTANCES_BATCH_SIZE):
+            for inst in ec2_conn.get_only_instances(instance_ids=inst_ids[
+                    i:i+DESCRIBE_INSTANCES_BATCH_SIZE]):
+                instances[inst.id] = inst
+        for vm_id, name, inst_id in items:
+            inst = instances.get(inst_id)
+            if (inst is None or not inst.public_dns_name or
+                    not inst.private_ip_address):
+                fall_back([vm_id])
+                continue
+            found.append((vm_id, (name + '.' + route_53_zone).lower(),
+                inst))
+    if not found:
+        return
+
+    r53_conn = route53_connect_to_aws_provider(aws_prov_id)
+    pub_zone_id, priv_zone_id = get_route53_zone_ids(r53_conn,
+            aws_prov_id, route_53_zone)
+    for zone_id, record_type, value_attr, msg in (
+            (pub_zone_id, 'CNAME', 'public_dns_name',
+                'Created DNS cname ‘{}’'),
+            (priv_zone_id, 'A', 'private_ip_address',
+                'Created A record ‘{}’ {}')):
+        if not zone_id:
+            aud.warning('No {} DNS zone named ‘{}’'.format(
+                'public' if record_type == 'CNAME' else 'private',
+                route_53_zone))
+            continue
+        records = [(vm_id, cname, record_type, getattr(inst, value_attr))
+                for vm_id, cname, inst in found if vm_id not in failed]
+        for batch in _route53_upsert_batches(records):
+            try:
+                _route53_upsert(r53_conn, zone_id,
+                        [r[1:] for r in batch])
+            except boto.exception.BotoServerError as e:
+                aud.warning('Route53 change batch failed: {}'.format(e))
+                _discard_route53_zone_ids(aws_prov_id)
+                fall_back([r[0] for r in batch])
+                continue
+            for vm_id, cname, record_type, value in batch:
+                aud.info(msg.format(cname, value), vm_id=vm_id,
+                        user_id=user_ids[vm_id])
 
 
 def mark_vm_destroyed_if_needed(awsvm):
@@ -3,6 +3,7 @@ from django.utils.timezone import utc
 
 from vimma.audit import Auditor
 from vimma.celery import app
+from vimma.events import publish_vm_event
 from vimma.models import (
     VM,
     DummyVM,
@@ -56,6 +57,7 @@ def power_on_vm(vm_id, user_id=None):
 
     with aud.ctx_mgr(vm_id=vm_id, user_id=user_id):
         retry_in_transaction(call)
+        publish_vm_event(vm_id, 'state')
         aud.info('Power ON', user_id=user_id, vm_id=vm_id)
 
 
@@ -73,6 +75,7 @@ def power_off_vm(vm_id, user_id=None):
 
     with aud.ctx_mgr(vm_id=vm_id, user_id=user_id):
         retry_in_transaction(call)
+        publish_vm_event(vm_id, 'state')
         aud.info('Power OFF', user_id=user_id, vm_id=vm_id)
 
 
@@ -90,6 +93,7 @@ def reboot_vm(vm_id, user_id=None):
 
     with aud.ctx_mgr(vm_id=vm_id, user_id=user_id):
         retry_in_transaction(call)
+        publish_vm_event(vm_id, 'state')
         aud.info('Reboot', user_id=user_id, vm_id=vm_id)
 
 
@@ -114,11 +118,12 @@ def destroy_vm(vm_id, user_id=None):
 
     with aud.ctx_mgr(vm_id=vm_id, user_id=user_id):
         retry_in_transaction(call)
+        publish_vm_event(vm_id, 'state')
         aud.info('Destroy', user_id=user_id, vm_id=vm_id)
 
 
 @app.task
-def update_vm_status(vm_id):
+def update_vm_status(vm_id, coalesced=False):
     def call():
         """
         Returns the fields destroyed, poweredon from the model.
@@ -133,13 +138,18 @@ def update_vm_status(vm_id):
         aud.debug('Update status ‘{}’'.format(new_status), vm_id=vm_id)
         return dvm.destroyed, dvm.poweredon
 
-    with aud.ctx_mgr(vm_id=vm_id):
-        destroyed, poweredon = retry_in_transaction(call)
-        if destroyed:
-            poweredon = False
-
-        set_vm_status_updated_at_now(vm_id)
-
-        vimma.vmutil.power_log(vm_id, poweredon)
-        if not destroyed:
-            vimma.vmutil.switch_on_off(vm_id, poweredon)
+    try:
+        with aud.ctx_mgr(vm_id=vm_id):
+            destroyed, poweredon = retry_in_transaction(call)
+            publish_vm_event(vm_id, 'state')
+            if destroyed:
+                poweredon = False
+
+            set_vm_status_updated_at_now(vm_id)
+
+            vimma.vmutil.power_log(vm_id, poweredon)
+            if not destroyed:
+                vimma.vmutil.switch_on_off(vm_id, poweredon)
+    finally:
+        if coalesced:
+            vimma.vmutil.status_update_finished(vm_id)
@@ -1,22 +1,31 @@
 import datetime
 from django.conf import settings
 from django.db import transaction
+from django.db.models import DateTimeField, Max
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.utils.timezone import utc
+import redis
 
 from vimma.actions import Actions
+from vimma.apicache import invalidate_projects
+from vimma.archive import archive_audits
 from vimma.audit import Auditor
 from vimma.celery import app
+from vimma.events import publish_vm_event, publish_vm_events
 import vimma.expiry
 from vimma.models import (
-    Provider, VM, User,
+    Provider, Schedule, VM, User,
     Expiration, VMExpiration,
     PowerLog,
     FirewallRule,
 )
 from vimma.util import (
     can_do, retry_in_transaction,
-    vm_at_now, discard_expired_schedule_override,
+    vm_at_now, vm_at_tstamp, discard_expired_schedule_override,
+    next_transition_at, set_vm_next_transition_at, case_by_id,
 )
+import vimma.uptime
 import vimma.vmtype.dummy, vimma.vmtype.aws
 
 
@@ -76,6 +85,8 @@ def create_vm(vmconfig, project, schedule, comment, data, user_id):
                 expires_at=expire_dt)
         expiration.full_clean()
         VMExpiration.objects.create(expiration=expiration, vm=vm).full_clean()
+        vm.next_transition_at = next_transition_at(vm)
+        vm.save(update_fields=['next_transition_at'])
 
         t = prov.type
         if t == Provider.TYPE_DUMMY:
@@ -131,7 +142,7 @@ class VMController():
     def destroy(self, user_id=None):
         raise NotImplementedError()
 
-    def update_status(self):
+    def update_status(self, coalesced=False, priority=None):
         """
         This method is responsible for the following actions (e.g. schedule
         them as asynchronous tasks):
@@ -139,6 +150,9 @@ class VMController():
         mark the timestamp of this update.
         Call power_log() to log the current power state (on or off).
         Call switch_on_off() which turns the vm on or off if needed.
+        If coalesced is True, call status_update_finished() at the end, even
+        if the update fails. priority, if not None, overrides the Celery
+        priority of the tasks (see vimma.celeryconfig).
         """
         raise NotImplementedError()
 
@@ -176,8 +190,9 @@ class DummyVMController(VMController):
     def destroy(self, user_id=None):
         vimma.vmtype.dummy.destroy_vm.delay(self.vm_id, user_id=user_id)
 
-    def update_status(self):
-        vimma.vmtype.dummy.update_vm_status.delay(self.vm_id)
+    def update_status(self, coalesced=False, priority=None):
+        vimma.vmtype.dummy.update_vm_status.apply_async(args=(self.vm_id,),
+                kwargs={'coalesced': coalesced}, priority=priority)
 
 
 class AWSVMController(VMController):
@@ -186,19 +201,23 @@ class AWSVMController(VMController):
     """
 
     def power_on(self, user_id=None):
-        vimma.vmtype.aws.power_on_vm.delay(self.vm_id, user_id=user_id)
+        vimma.vmtype.aws.request_power_action(self.vm_id, 'power_on',
+                user_id=user_id)
 
     def power_off(self, user_id=None):
-        vimma.vmtype.aws.power_off_vm.delay(self.vm_id, user_id=user_id)
+        vimma.vmtype.aws.request_power_action(self.vm_id, 'power_off',
+                user_id=user_id)
 
     def reboot(self, user_id=None):
-        vimma.vmtype.aws.reboot_vm.delay(self.vm_id, user_id=user_id)
+        vimma.vmtype.aws.request_power_action(self.vm_id, 'reboot',
+                user_id=user_id)
 
     def destroy(self, user_id=None):
         vimma.vmtype.aws.destroy_vm.delay(self.vm_id, user_id=user_id)
 
-    def update_status(self):
-        vimma.vmtype.aws.update_vm_status.delay(self.vm_id)
+    def update_status(self, coalesced=False, priority=None):
+        vimma.vmtype.aws.update_vm_status.apply_async(args=(self.vm_id,),
+                kwargs={'coalesced': coalesced}, priority=priority)
 
     def create_firewall_rule(self, data, user_id=None):
         vimma.vmtype.aws.create_firewall_rule(self.vm_id, data,
@@ -208,6 +227,38 @@ class AWSVMController(VMController):
         vimma.vmtype.aws.delete_firewall_rule(fw_rule_id, user_id=user_id)
 
 
+# The actions bulk_vm_action(…) can perform.
+BULK_VM_ACTIONS = ('power-on', 'power-off', 'reboot', 'destroy')
+
+
+def bulk_vm_action(action, vm_ids, user_id=None):
+    """
+    Perform action (see BULK_VM_ACTIONS) on the VMs with the given ids.
+
+    AWS VMs are grouped by AWSProvider and region, with one task per group
+    (see vimma.vmtype.aws.power_on_vms etc.). Other VMs get the same task as
+    get_vm_controller(…).power_on() etc. would queue.
+    """
+    if action not in BULK_VM_ACTIONS:
+        raise ValueError('Unknown action “{}”'.format(action))
+    method = action.replace('-', '_')
+
+    def read():
+        return list(VM.objects.filter(id__in=vm_ids).values_list('id',
+            'provider__type', 'provider__awsprovider__id', 'awsvm__region'))
+
+    aws_groups = {}
+    for vm_id, prov_type, aws_prov_id, region in retry_in_transaction(read):
+        if prov_type == Provider.TYPE_AWS:
+            aws_groups.setdefault((aws_prov_id, region), []).append(vm_id)
+        else:
+            getattr(get_vm_controller(vm_id), method)(user_id=user_id)
+
+    aws_task = getattr(vimma.vmtype.aws, method + '_vms')
+    for (aws_prov_id, region), group in aws_groups.items():
+        aws_task.delay(aws_prov_id, region, group, user_id=user_id)
+
+
 @app.task
 def update_all_vms_status():
     """
@@ -218,39 +269,216 @@ def update_all_vms_status():
     """
     aud.debug('Update status of all non-destroyed VMs')
     with transaction.atomic():
-        vm_ids = map(lambda v: v.id, VM.objects.filter(destroyed_at=None))
+        vms = VM.objects.filter(destroyed_at=None)
+        aws_regions = []
+        if settings.AWS_BATCHED_STATUS_SWEEP:
+            # one task per (AWSProvider, region) instead of one per VM
+            aws_vms = vms.filter(provider__type=Provider.TYPE_AWS)
+            aws_regions = list(aws_vms.values_list(
+                'provider__awsprovider__id', 'awsvm__region').distinct())
+            vms = vms.exclude(provider__type=Provider.TYPE_AWS)
+        vm_ids = list(vms.values_list('id', flat=True))
+    for aws_prov_id, region in aws_regions:
+        vimma.vmtype.aws.update_region_vms_status.delay(aws_prov_id, region)
     for x in vm_ids:
         # don't allow a single VM to break the loop, e.g. with missing
         # foreign keys. Make a separate task for each instead of handling
         # all in this task.
-        update_vm_status.delay(x)
+        request_status_update(x)
 
 
 @app.task
-def update_vm_status(vm_id):
+def dispatch_power_transitions():
+    """
+    Schedule status updates for VMs whose power state is about to change.
+
+    Each status update task runs at the VM's next_transition_at, powers the
+    VM on or off if needed and computes its new next_transition_at. Until
+    then next_transition_at is moved past the task's ETA by
+    settings.POWER_TRANSITION_RETRY_SECS, so a VM whose update fails or is
+    lost is dispatched again. update_all_vms_status remains as a slower
+    reconciliation pass.
+    """
+    now = datetime.datetime.utcnow().replace(tzinfo=utc)
+    horizon = now + datetime.timedelta(
+            seconds=settings.POWER_TRANSITION_LOOKAHEAD_SECS)
+    retry_at = horizon + datetime.timedelta(
+            seconds=settings.POWER_TRANSITION_RETRY_SECS)
+
+    def read():
+        due = VM.objects.filter(destroyed_at=None,
+                next_transition_at__lte=horizon)
+        items = list(due.values_list('id', 'next_transition_at',
+            'project_id'))
+        # Mark them dispatched. The status update sets the next value.
+        due.filter(id__in=[x[0] for x in items]).update(
+                next_transition_at=retry_at)
+        return items
+
+    with aud.ctx_mgr():
+        items = retry_in_transaction(read)
+        invalidate_projects({x[2] for x in items})
+    # Not coalesced by request_status_update(…): these must run at their
+    # ETA, and moving next_transition_at above already queues each once.
+    for vm_id, transition_at, prj_id in items:
+        update_vm_status.apply_async(args=(vm_id,),
+                eta=max(transition_at, now))
+
+
+@receiver(post_save, sender=Schedule)
+def _schedule_saved(sender, instance, **kwargs):
+    """
+    Re-check the VMs using a Schedule, as soon as it changes.
+    """
+    now = datetime.datetime.utcnow().replace(tzinfo=utc)
+    vms = VM.objects.filter(schedule=instance, destroyed_at=None)
+    invalidate_projects(vms.values_list('project_id', flat=True).distinct())
+    vms.update(next_transition_at=now)
+
+
+_STATUS_KEY_PREFIX = 'vimma:status-update:'
+
+# The guard key of a VM is absent (no update), ‘queued’, ‘running’ or
+# ‘rerun’ (running, and another update was requested meanwhile).
+# Returns 1 if the caller must queue the update.
+_REQUEST_STATUS_SCRIPT = '''
+local state = redis.call('GET', KEYS[1])
+if not state then
+    redis.call('SET', KEYS[1], 'queued', 'EX', ARGV[1])
+    return 1
+end
+if state == 'running' then
+    redis.call('SET', KEYS[1], 'rerun', 'EX', ARGV[1])
+end
+return 0
+'''
+# Returns 1 if the caller must queue the trailing update.
+_FINISH_STATUS_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == 'rerun' then
+    redis.call('SET', KEYS[1], 'queued', 'EX', ARGV[1])
+    return 1
+end
+redis.call('DEL', KEYS[1])
+return 0
+'''
+
+_redis = None
+_request_status_script = None
+_finish_status_script = None
+
+
+def _get_redis():
+    global _redis, _request_status_script, _finish_status_script
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(settings.STATUS_UPDATE_REDIS_URL)
+        _request_status_script = _redis.register_script(
+                _REQUEST_STATUS_SCRIPT)
+        _finish_status_script = _redis.register_script(_FINISH_STATUS_SCRIPT)
+    return _redis
+
+
+def request_status_update(vm_id, priority=None):
+    """
+    Queue update_vm_status for a VM, unless one is queued or running.
+
+    priority, if not None, overrides the task's Celery priority, e.g.
+    vimma.celeryconfig.PRIORITY_INTERACTIVE when a user is waiting.
+
+    A request while the update runs makes it queue one trailing update when
+    it finishes, so changes made meanwhile aren't missed. Further requests
+    collapse into that one. The guard is a Redis key expiring after
+    settings.STATUS_UPDATE_GUARD_SECS, in case a task is lost. Without Redis
+    this always queues the task.
+    """
+    try:
+        _get_redis()
+        queue = _request_status_script(keys=[_STATUS_KEY_PREFIX + str(vm_id)],
+                args=[settings.STATUS_UPDATE_GUARD_SECS])
+    except redis.RedisError as e:
+        aud.warning('Can\'t coalesce status update: {}'.format(e),
+                vm_id=vm_id)
+        update_vm_status.apply_async(args=(vm_id,),
+                kwargs={'priority': priority}, priority=priority)
+        return
+    if queue:
+        update_vm_status.apply_async(args=(vm_id,),
+                kwargs={'coalesced': True, 'priority': priority},
+                priority=priority)
+
+
+def status_update_finished(vm_id):
+    """
+    Release the guard of a status update queued by request_status_update(…).
+
+    Queues the trailing update if one was requested while it ran.
+    """
+    try:
+        _get_redis()
+        queue = _finish_status_script(keys=[_STATUS_KEY_PREFIX + str(vm_id)],
+                args=[settings.STATUS_UPDATE_GUARD_SECS])
+    except redis.RedisError as e:
+        # the guard expires on its own
+        aud.warning('Can\'t release status update guard: {}'.format(e),
+                vm_id=vm_id)
+        return
+    if queue:
+        update_vm_status.delay(vm_id, coalesced=True)
+
+
+@app.task
+def update_vm_status(vm_id, coalesced=False, priority=None):
     """
     Check & update the status of the VM.
+
+    Queue it with request_status_update(…), which sets coalesced, except
+    for timed runs (see dispatch_power_transitions). The VM-type-specific
+    task releases the guard. It gets the same priority as this task.
     """
     aud.debug('Request status update', vm_id=vm_id)
 
     with aud.ctx_mgr(vm_id=vm_id):
-        get_vm_controller(vm_id).update_status()
+        if coalesced:
+            try:
+                _get_redis().set(_STATUS_KEY_PREFIX + str(vm_id), 'running',
+                        ex=settings.STATUS_UPDATE_GUARD_SECS)
+            except redis.RedisError as e:
+                aud.warning('Can\'t mark status update running: {}'.format(
+                    e), vm_id=vm_id)
+        try:
+            get_vm_controller(vm_id).update_status(coalesced=coalesced,
+                    priority=priority)
+        except:
+            if coalesced:
+                status_update_finished(vm_id)
+            raise
 
 
 def power_log(vm_id, powered_on):
     """
     PowerLog the current vm state (ON/OFF).
+
+    If the state is the same as in the VM's latest PowerLog, that interval's
+    last_confirmed_at is set to now, else a new PowerLog is created.
     """
     def do_log():
-        vm = VM.objects.get(id=vm_id)
+        vm = VM.objects.select_for_update().get(id=vm_id)
+        latest = (PowerLog.objects.filter(vm=vm).order_by('-timestamp', '-id')
+                .values_list('id', 'powered_on').first())
+        if latest is not None and latest[1] is powered_on:
+            now = datetime.datetime.utcnow().replace(tzinfo=utc)
+            PowerLog.objects.filter(id=latest[0]).update(
+                    last_confirmed_at=now)
+            return False
         PowerLog.objects.create(vm=vm, powered_on=powered_on)
+        return True
 
     with aud.ctx_mgr(vm_id=vm_id):
         if type(powered_on) is not bool:
             raise ValueError('powered_on ‘{}’ has type ‘{}’, want ‘{}’'.format(
                 powered_on, type(powered_on), bool))
 
-        retry_in_transaction(do_log)
+        if retry_in_transaction(do_log):
+            publish_vm_event(vm_id, 'powerlog', powered_on=powered_on)
 
 
 def switch_on_off(vm_id, powered_on):
@@ -271,6 +499,7 @@ def switch_on_off(vm_id, powered_on):
         discard_expired_schedule_override(vm_id)
 
         new_power_state = vm_at_now(vm_id)
+        set_vm_next_transition_at(vm_id)
         if powered_on is new_power_state:
             return
 
@@ -280,6 +509,99 @@ def switch_on_off(vm_id, powered_on):
             get_vm_controller(vm_id).power_off()
 
 
+def _check_powered_on(powered_on_by_vm_id):
+    for powered_on in powered_on_by_vm_id.values():
+        if type(powered_on) is not bool:
+            raise ValueError('powered_on ‘{}’ has type ‘{}’, want ‘{}’'.format(
+                powered_on, type(powered_on), bool))
+
+
+def power_log_many(powered_on_by_vm_id):
+    """
+    power_log(…) several VMs, in one transaction.
+
+    powered_on_by_vm_id maps VM ids to their current state (bool). The latest
+    PowerLogs of unchanged VMs are confirmed with one update, the others are
+    bulk-created.
+    """
+    _check_powered_on(powered_on_by_vm_id)
+
+    def do_log():
+        vm_ids = list(VM.objects.select_for_update().filter(
+            id__in=powered_on_by_vm_id).order_by('id')
+            .values_list('id', flat=True))
+        latest_ids = [x['latest_id'] for x in PowerLog.objects.filter(
+            vm__id__in=vm_ids).values('vm').annotate(latest_id=Max('id'))]
+        latest = {vm_id: (pl_id, powered_on) for pl_id, vm_id, powered_on in
+                PowerLog.objects.filter(id__in=latest_ids).values_list('id',
+                    'vm_id', 'powered_on')}
+
+        confirm_ids, new_vm_ids = [], []
+        for vm_id in vm_ids:
+            powered_on = powered_on_by_vm_id[vm_id]
+            if vm_id in latest and latest[vm_id][1] is powered_on:
+                confirm_ids.append(latest[vm_id][0])
+            else:
+                new_vm_ids.append(vm_id)
+
+        now = datetime.datetime.utcnow().replace(tzinfo=utc)
+        if confirm_ids:
+            PowerLog.objects.filter(id__in=confirm_ids).update(
+                    last_confirmed_at=now)
+        PowerLog.objects.bulk_create([PowerLog(vm_id=vm_id,
+            powered_on=powered_on_by_vm_id[vm_id]) for vm_id in new_vm_ids])
+        return new_vm_ids
+
+    with aud.ctx_mgr():
+        new_vm_ids = retry_in_transaction(do_log)
+        publish_vm_events([{'vm': vm_id, 'type': 'powerlog',
+            'powered_on': powered_on_by_vm_id[vm_id]}
+            for vm_id in new_vm_ids])
+
+
+def switch_on_off_many(powered_on_by_vm_id):
+    """
+    switch_on_off(…) several VMs.
+
+    One transaction discards their expired schedule overrides and saves their
+    next_transition_at, then the VMs whose power state should be different
+    are powered on/off with bulk_vm_action(…).
+    """
+    _check_powered_on(powered_on_by_vm_id)
+
+    def call():
+        now = datetime.datetime.utcnow().replace(tzinfo=utc).timestamp()
+        expired = (VM.objects.filter(id__in=powered_on_by_vm_id,
+            sched_override_tstamp__lt=now)
+            .exclude(sched_override_state=None))
+        discarded = list(expired.values_list('id', flat=True))
+        VM.objects.filter(id__in=discarded).update(sched_override_state=None,
+                sched_override_tstamp=None)
+
+        vms = list(VM.objects.filter(id__in=powered_on_by_vm_id)
+                .select_related('schedule__timezone',
+                    'vmexpiration__expiration'))
+        VM.objects.filter(id__in=[vm.id for vm in vms]).update(
+                next_transition_at=case_by_id(
+                    {vm.id: next_transition_at(vm) for vm in vms},
+                    DateTimeField()))
+        new_states = {vm.id: vm_at_tstamp(vm, now) for vm in vms}
+        return discarded, new_states, {vm.project_id for vm in vms}
+
+    with aud.ctx_mgr():
+        discarded, new_states, prj_ids = retry_in_transaction(call)
+        invalidate_projects(prj_ids)
+        for vm_id in discarded:
+            aud.debug('Discarded expired schedule override', vm_id=vm_id)
+
+        for action, state in (('power-on', True), ('power-off', False)):
+            vm_ids = [vm_id for vm_id, new_state in new_states.items()
+                    if new_state is state and
+                    powered_on_by_vm_id[vm_id] is not state]
+            if vm_ids:
+                bulk_vm_action(action, sorted(vm_ids))
+
+
 @app.task
 def expiration_notify(vm_id):
     """
@@ -310,18 +632,38 @@ def expiration_grace_action(vm_id):
         get_vm_controller(vm_id).destroy()
 
 
+# Expirations read per query by the dispatch_all_expiration_… tasks.
+EXPIRATION_DISPATCH_BATCH_SIZE = 1000
+
+
+def _due_expiration_ids():
+    """
+    Yield the ids of Expirations whose next_due_at has passed, in batches.
+    """
+    now = datetime.datetime.utcnow().replace(tzinfo=utc)
+    last_id = 0
+    while True:
+        def read():
+            return list(Expiration.objects.filter(next_due_at__lte=now,
+                id__gt=last_id).order_by('id').values_list('id', flat=True)
+                [:EXPIRATION_DISPATCH_BATCH_SIZE])
+        ids = retry_in_transaction(read)
+        yield from ids
+        if len(ids) < EXPIRATION_DISPATCH_BATCH_SIZE:
+            return
+        last_id = ids[-1]
+
+
 @app.task
 def dispatch_all_expiration_notifications():
     """
     Check which Expiration items need a notification and run controller.notify.
+
+    Only Expirations whose next_due_at has passed are checked.
     """
     aud.debug('Check which Expiration items need a notification')
     with aud.ctx_mgr():
-        def read():
-            return list(map(lambda e: e.id, Expiration.objects.filter(
-                grace_end_action_performed=False)))
-        ids = retry_in_transaction(read)
-        for x in ids:
+        for x in _due_expiration_ids():
             # don't allow a single item to break the loop (in some corner case).
             # Make a separate task for each instead of handling
             # all in this task.
@@ -345,14 +687,12 @@ def dispatch_expiration_notification(exp_id):
 def dispatch_all_expiration_grace_end_actions():
     """
     Check which Expiration items need a grace-end action and run it.
+
+    Only Expirations whose next_due_at has passed are checked.
     """
     aud.debug('Check which Expiration items need a grace-end action')
     with aud.ctx_mgr():
-        def read():
-            return list(map(lambda e: e.id, Expiration.objects.filter(
-                grace_end_action_performed=False)))
-        ids = retry_in_transaction(read)
-        for x in ids:
+        for x in _due_expiration_ids():
             # don't allow a single item to break the loop (in some corner case).
             # Make a separate task for each instead of handling
             # all in this task.
@@ -362,6 +702,9 @@ def dispatch_all_expiration_grace_end_actions():
 def dispatch_expiration_grace_end_action(exp_id):
     """
     Check the Expiration item and perform the grace end action if needed.
+
+    If no action is due, recompute its next_due_at (it may be stale, e.g.
+    after the notification intervals changed) so it's not dispatched again.
     """
     aud.debug('Checking if Expiration id ' + str(exp_id) +
             ' needs a grace-end action')
@@ -370,6 +713,33 @@ def dispatch_expiration_grace_end_action(exp_id):
         c = vimma.expiry.get_controller(exp_id)
         if c.needs_grace_end_action():
             c.perform_grace_end_action()
+        elif not c.needs_notification():
+            c.update_next_due_at()
+
+
+@app.task
+def update_uptime_rollups():
+    """
+    Update the VMUptime and ProjectUptime rollups with recent PowerLogs.
+    """
+    with aud.ctx_mgr():
+        vimma.uptime.update_uptime_rollups()
+
+
+@app.task
+def archive_old_audits():
+    """
+    Move Audits older than settings.AUDIT_RETENTION_SECS to archive files.
+    """
+    if settings.AUDIT_RETENTION_SECS is None:
+        return
+    with aud.ctx_mgr():
+        now = datetime.datetime.utcnow().replace(tzinfo=utc)
+        before = now - datetime.timedelta(
+                seconds=settings.AUDIT_RETENTION_SECS)
+        n = archive_audits(before, settings.AUDIT_ARCHIVE_DIR,
+                settings.AUDIT_ARCHIVE_BATCH_SIZE)
+        aud.info('Archived {} Audits older than {}'.format(n, before))
 
 
 def delete_firewall_rule(fw_rule_id, user_id=None):
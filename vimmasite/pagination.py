@@ -1,5 +1,141 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import binascii
+from collections import OrderedDict
+from django.db.models import Q
+from django.template import Context, loader
+from django.utils.dateparse import parse_datetime
+import json
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 class VimmaPagination(PageNumberPagination):
     page_size_query_param = 'page_size'
     max_page_size = 100
+
+
+class TimestampKeysetPagination(BasePagination):
+    """
+    Newest first (timestamp, id) keyset pagination, for large log tables.
+
+    A page starts after the (timestamp, id) of the last item on the previous
+    page instead of at an OFFSET, so deep pages are as fast as the first one.
+    The ‘next’ and ‘previous’ links carry opaque cursors.
+    The total ‘count’ needs a COUNT(*) of all matching rows so it's only in
+    the response if the request has count=true.
+    """
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = VimmaPagination.page_size_query_param
+    max_page_size = VimmaPagination.max_page_size
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    template = 'rest_framework/pagination/previous_and_next.html'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def encode_cursor(self, item, reverse):
+        """
+        Return the cursor for the items after (or before, if reverse) item.
+        """
+        data = [item.timestamp.isoformat(), item.id, reverse]
+        return base64.urlsafe_b64encode(
+                json.dumps(data).encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, encoded):
+        """
+        Return (timestamp, id, reverse) from encoded or raise NotFound.
+        """
+        try:
+            data = json.loads(base64.urlsafe_b64decode(
+                encoded.encode('ascii')).decode('utf-8'))
+            tstamp, item_id, reverse = data
+            tstamp = parse_datetime(tstamp)
+            if (tstamp is None or type(item_id) != int or
+                    type(reverse) != bool):
+                raise ValueError()
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise NotFound('Invalid cursor')
+        return tstamp, item_id, reverse
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        self.base_url = remove_query_param(request.build_absolute_uri(),
+                self.count_query_param)
+
+        self.count = None
+        if request.query_params.get(self.count_query_param) == 'true':
+            self.count = queryset.count()
+
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            position, self.reverse = None, False
+        else:
+            tstamp, item_id, self.reverse = self.decode_cursor(encoded)
+            position = tstamp, item_id
+
+        if self.reverse:
+            queryset = queryset.order_by('timestamp', 'id')
+            if position:
+                queryset = queryset.filter(timestamp__gte=position[0]).filter(
+                        Q(timestamp__gt=position[0]) | Q(id__gt=position[1]))
+        else:
+            queryset = queryset.order_by('-timestamp', '-id')
+            if position:
+                queryset = queryset.filter(timestamp__lte=position[0]).filter(
+                        Q(timestamp__lt=position[0]) | Q(id__lt=position[1]))
+
+        # fetch an extra item to see if there are more after this page
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_more = len(results) > len(self.page)
+        if self.reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+
+        if self.has_previous or self.has_next:
+            self.display_page_controls = True
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if not self.page:
+            # Nothing newer than the cursor, start again from the newest.
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return replace_query_param(self.base_url, self.cursor_query_param,
+                self.encode_cursor(self.page[-1], False))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return replace_query_param(self.base_url, self.cursor_query_param,
+                self.encode_cursor(self.page[0], True))
+
+    def get_paginated_response(self, data):
+        fields = []
+        if self.count is not None:
+            fields.append(('count', self.count))
+        fields.extend([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ])
+        return Response(OrderedDict(fields))
+
+    def to_html(self):
+        template = loader.get_template(self.template)
+        return template.render(Context({
+            'previous_url': self.get_previous_link(),
+            'next_url': self.get_next_link(),
+        }))
@@ -113,6 +113,120 @@ VM_NOTIFICATION_INTERVALS = [x*secs_in_day for x in
 # Keep VM for this amount of time after expiration
 VM_GRACE_INTERVAL = secs_in_day*14
 
+# Audit messages below this level ('DEBUG', 'INFO', 'WARNING', 'ERROR') go
+# only to standard logging, not to the DB. Overridable per Auditor name,
+# e.g. {'vimma.vmutil': 'INFO'}, which also applies to 'vimma.vmutil.x'.
+AUDIT_MIN_LEVEL = 'DEBUG'
+AUDIT_MIN_LEVEL_OVERRIDES = {}
+# The fraction (0 to 1) of DEBUG Audit messages saved to the DB.
+AUDIT_DEBUG_SAMPLE_RATE = 1
+
+# Buffer Audit messages in memory and save them in batches, after each
+# request and Celery task and at exit. When the buffer holds
+# AUDIT_BUFFER_MAX_SIZE messages, new ones are dropped ('drop-newest') or
+# the oldest ones are ('drop-oldest'). Standard logging is not buffered.
+AUDIT_BUFFERED = False
+AUDIT_BUFFER_MAX_SIZE = 10000
+AUDIT_BUFFER_OVERFLOW = 'drop-newest'
+
+# Audits older than this are moved to daily gzipped JSON-lines files in
+# AUDIT_ARCHIVE_DIR, in batches, by a daily task and by the archive_audits
+# management command. None keeps all Audits in the DB.
+AUDIT_RETENTION_SECS = None
+AUDIT_ARCHIVE_DIR = os.getenv('AUDIT_ARCHIVE_DIR',
+        os.path.join(BASE_DIR, 'audit-archive'))
+AUDIT_ARCHIVE_BATCH_SIZE = 10000
+
+# Update the status of AWS VMs with one DescribeInstances call per provider
+# and region, instead of one call per VM.
+AWS_BATCHED_STATUS_SWEEP = True
+
+# Close cached AWS API connections unused for this many seconds.
+AWS_CONNECTION_IDLE_SECS = 60*5
+
+# Token buckets for AWS API calls per API family, account (access key id)
+# and region (Route53 is global), shared by all processes through Redis at
+# RATE_LIMIT_REDIS_URL: {family: (tokens per second, burst size)}. A family
+# mapped to None is not limited. The ‘rate_limit_stats’ management command
+# shows the wait times.
+AWS_RATE_LIMITS = {
+    'ec2': (20, 100),
+    # AWS allows 5 requests per second per account
+    'route53': (4, 5),
+}
+RATE_LIMIT_REDIS_URL = os.getenv('RATE_LIMIT_REDIS_URL',
+        os.getenv('BROKER_URL', 'redis://localhost:6379/0'))
+# In the AWS tasks which retry on it (see raise_over_max_wait() in
+# vimma.ratelimit), a call which would wait longer than this for a token
+# raises vimma.ratelimit.RateLimitExceeded and the task retries later,
+# freeing the worker. Other code, and None, waits as long as needed.
+RATE_LIMIT_MAX_WAIT_SECS = 30
+
+# Coalesce AWS power on, power off and reboot requests: requests within
+# AWS_POWER_COALESCE_SECS for the same provider, region and action are
+# buffered in Redis at AWS_COALESCE_REDIS_URL and sent in one API call. None
+# sends each request on its own.
+AWS_POWER_COALESCE_SECS = 0.3
+# Likewise, Route53 records of VMs created or powered on within
+# AWS_ROUTE53_COALESCE_SECS are written in batches. Instances get their
+# addresses a few seconds after starting, so this is longer.
+AWS_ROUTE53_COALESCE_SECS = 15
+AWS_COALESCE_REDIS_URL = os.getenv('AWS_COALESCE_REDIS_URL',
+        os.getenv('BROKER_URL', 'redis://localhost:6379/0'))
+
+# Cache each AWSProvider's Route53 hosted zone ids for this many seconds.
+AWS_ROUTE53_ZONE_CACHE_SECS = 60*10
+
+# Cache each AWSProvider's credentials for this many seconds. Saving the
+# AWSProvider discards them at once only in the process which saved it, so
+# Celery workers see new credentials after at most this long.
+AWS_CREDENTIALS_CACHE_SECS = 60*5
+
+# At most one status update per VM is queued or running at a time. Requests
+# meanwhile collapse into one more update after it, tracked in Redis at
+# STATUS_UPDATE_REDIS_URL. A guard older than STATUS_UPDATE_GUARD_SECS is
+# assumed lost (e.g. a worker died) and ignored.
+STATUS_UPDATE_REDIS_URL = os.getenv('STATUS_UPDATE_REDIS_URL',
+        os.getenv('BROKER_URL', 'redis://localhost:6379/0'))
+STATUS_UPDATE_GUARD_SECS = 60*15
+
+# Power transitions (schedule boundaries, override and expiration ends) due
+# within this many seconds are queued, to run exactly at the boundary.
+POWER_TRANSITION_LOOKAHEAD_SECS = 60*2
+# A dispatched VM is dispatched again this long after its status update was
+# due, unless the update succeeded and set the VM's next transition.
+POWER_TRANSITION_RETRY_SECS = 60*5
+
+# The hourly uptime rollup recomputes the days from this many days before
+# the latest rolled-up day, to include PowerLog intervals confirmed late.
+UPTIME_ROLLUP_LOOKBACK_DAYS = 2
+
+# Hourly price of a VM for the usage projections, by AWS instance type.
+# Other VMs (and AWS VMs with an unlisted type) use VM_DEFAULT_HOURLY_PRICE.
+VM_HOURLY_PRICES = {}
+VM_DEFAULT_HOURLY_PRICE = 0
+PROJECTION_MAX_WEEKS = 52
+
+# Cache the responses of the VM, firewall rule and expiration API endpoints
+# in Redis at API_CACHE_REDIS_URL, shared by users with the same projects.
+# Changes to those objects invalidate the cache for their project, and
+# entries expire after API_CACHE_TTL_SECS.
+API_RESPONSE_CACHE = False
+API_CACHE_REDIS_URL = os.getenv('API_CACHE_REDIS_URL',
+        os.getenv('BROKER_URL', 'redis://localhost:6379/0'))
+API_CACHE_TTL_SECS = 60
+
+# Publish VM changes (AWS/dummy state, PowerLogs, Audits) to Redis pub/sub
+# at EVENT_REDIS_URL and push them to the web UI with Server-Sent Events, so
+# it reloads only what changed. Each stream lasts up to
+# EVENT_STREAM_MAX_SECS, then the browser reconnects. A stream occupies a
+# uwsgi worker while it's open, so size the workers (or use async ones)
+# before turning this on.
+EVENT_STREAM = False
+EVENT_REDIS_URL = os.getenv('EVENT_REDIS_URL',
+        os.getenv('BROKER_URL', 'redis://localhost:6379/0'))
+EVENT_STREAM_MAX_SECS = 60*5
+
 # Firewall rule expiration
 NORMAL_FIREWALL_RULE_EXPIRY_SECS = secs_in_day * 30 * 3
 SPECIAL_FIREWALL_RULE_EXPIRY_SECS = secs_in_day * 7